@@ -0,0 +1,40 @@
+"""Shared helpers for the benchmark scripts.
+
+Benchmarks run against a throwaway SQLite file, so ``use_temp_database`` must be
+called before anything from ``shekkle_bot`` is imported (config reads the
+environment at import time).
+"""
+import os
+import tempfile
+
+# Chat whose economy the benchmarks use. Rows inserted without a chat_id belong to chat 0.
+CHAT_ID = 0
+
+
+def use_temp_database(name="bench"):
+    """Points DB_PATH at a fresh temporary file and returns the path."""
+    tmpdir = tempfile.mkdtemp(prefix="shekkle-bench-")
+    path = os.path.join(tmpdir, f"{name}.db")
+    os.environ["DB_PATH"] = path
+    return path
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def summarize_ms(samples):
+    """Summarizes latency samples given in seconds as milliseconds."""
+    ms = [s * 1000 for s in samples]
+    return {
+        'count': len(ms),
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p90_ms': round(percentile(ms, 90), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'max_ms': round(max(ms), 3) if ms else 0.0,
+    }
@@ -0,0 +1,158 @@
+"""
+Archival: hot-path latency with the whole history in `bets` / `wagers` vs
+after moving old resolved bets to the archive tables.
+
+Generates the db_suite dataset (most bets resolved, up to a year ago), times
+the hot paths, archives every bet resolved more than `--days` ago the way the
+archive_bets job does, then times them again. Reports the archival run
+(bets and wagers per second, the longest single batch, which is how long
+handlers wait for the write lock), row counts and table sizes, and checks that
+nothing was lost: every sampled user's /history walked page by page in both
+directions, user_stats and a rebuild of it from hot and archived wagers must
+come out the same. Exits non-zero otherwise.
+
+Usage: python -m benchmarks.archival [--wagers N] [--days N] [--samples N]
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+from benchmarks._common import use_temp_database, summarize_ms, CHAT_ID
+
+use_temp_database("archival")
+
+import shekkle_bot.database as db  # noqa: E402
+from benchmarks.db_suite import generate, timed  # noqa: E402
+from shekkle_bot.config import ARCHIVE_BATCH  # noqa: E402
+from shekkle_bot.models import Bet, Wager, ArchivedBet, ArchivedWager, UserStats  # noqa: E402
+
+
+def walk_history(user_id):
+    """All wager ids of a user's history, newest first, paging older and then back newer."""
+    older, page = [], db.get_user_history_page(CHAT_ID, user_id)
+    while True:
+        older += [item['wager_id'] for item in page['items']]
+        if page['older'] is None:
+            break
+        page = db.get_user_history_page(CHAT_ID, user_id, before=page['older'])
+    newer = [item['wager_id'] for item in page['items']]
+    while page['newer'] is not None:
+        page = db.get_user_history_page(CHAT_ID, user_id, after=page['newer'])
+        newer = [item['wager_id'] for item in page['items']] + newer
+    return older, newer
+
+
+def user_stats():
+    with db.get_db(readonly=True) as session:
+        return {row.user_id: (row.net_profit, row.bets_placed, row.bets_won) for row in session.query(UserStats)}
+
+
+def snapshot(users):
+    return {
+        'history': {uid: walk_history(uid) for uid in users},
+        'leaderboards': db.get_leaderboard_data(CHAT_ID),
+        'stats': user_stats(),
+    }
+
+
+def counts():
+    with db.get_db(readonly=True) as session:
+        return {table.__tablename__: session.query(table).count() for table in (Bet, Wager, ArchivedBet, ArchivedWager)}
+
+
+def table_mb():
+    """On-disk size of each table with its indexes (SQLite builds with the dbstat table), else None."""
+    try:
+        with db.read_engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT m.tbl_name, SUM(s.pgsize) FROM dbstat s JOIN sqlite_master m ON m.name = s.name "
+                "WHERE m.tbl_name IN ('bets', 'wagers', 'bets_archive', 'wagers_archive') GROUP BY m.tbl_name").all()
+    except Exception:
+        return None
+    return {name: round(size / 2**20, 1) for name, size in rows}
+
+
+def time_hot_paths(data, samples, seed=2):
+    rng = random.Random(seed)
+    users = lambda: rng.choices(data['user_ids'], weights=data['weights'])[0]  # noqa: E731
+    now = int(time.time())
+    calls = {
+        'get_open_bet_page': lambda: db.get_open_bet_page(CHAT_ID, rng.choice(data['open_ids'])),
+        'get_expired_open_bets': lambda: db.get_expired_open_bets(now),
+        'get_open_bet_deadlines': lambda: db.get_open_bet_deadlines(),
+        'get_bet_status': lambda: db.get_bet_status(CHAT_ID, rng.choice(data['open_ids'])),
+        'get_user_history_page': lambda: db.get_user_history_page(CHAT_ID, users()),
+        'get_top_winners': lambda: db.get_top_winners(CHAT_ID, 10),
+    }
+    return {name: summarize_ms(timed([call] * samples)) for name, call in calls.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--bets", type=int, default=5_000)
+    parser.add_argument("--wagers", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=30, help="archive bets resolved more than this many days ago")
+    parser.add_argument("--samples", type=int, default=200, help="calls per hot path")
+    parser.add_argument("--check-users", type=int, default=50, help="users whose history is compared")
+    args = parser.parse_args()
+
+    db.init_db()
+    data = generate(db, {'users': args.users, 'bets': args.bets, 'wagers': args.wagers})
+    rng = random.Random(3)
+    # The heaviest users plus a random sample
+    check = sorted(set(data['user_ids'][:10] + rng.sample(data['user_ids'], args.check_users)))
+
+    before_counts, before_mb = counts(), table_mb()
+    expected = snapshot(check)
+    before = time_hot_paths(data, args.samples)
+
+    cutoff = int(time.time()) - args.days * 24 * 60 * 60
+    batches, t0 = [], time.perf_counter()
+    while True:
+        start = time.perf_counter()
+        moved = db.archive_resolved_bets(cutoff)
+        batches.append(time.perf_counter() - start)
+        if moved['bets'] < ARCHIVE_BATCH:
+            break
+    archive_s = time.perf_counter() - t0
+    start = time.perf_counter()
+    freed = db.reclaim_space()
+    reclaim_s = time.perf_counter() - start
+
+    after_counts, after_mb = counts(), table_mb()
+    actual = snapshot(check)
+    after = time_hot_paths(data, args.samples)
+    history_ok = actual['history'] == expected['history'] and all(
+        older == newer for older, newer in actual['history'].values())
+    leaderboards_ok = actual['leaderboards'] == expected['leaderboards'] and actual['stats'] == expected['stats']
+    db.rebuild_user_stats()
+    rebuild_ok = user_stats() == expected['stats']
+
+    archived_wagers = after_counts['wagers_archive']
+    print(json.dumps({
+        'days': args.days,
+        'rows_before': before_counts,
+        'rows_after': after_counts,
+        'archive': {
+            'seconds': round(archive_s, 2), 'batches': len(batches),
+            'wagers_per_sec': round(archived_wagers / archive_s) if archive_s else 0,
+            'longest_batch_ms': round(max(batches) * 1000, 1),
+            'reclaim_s': round(reclaim_s, 2), 'pages_released': freed,
+        },
+        'table_mb_before': before_mb,
+        'table_mb_after': after_mb,
+        'hot_paths_before': before,
+        'hot_paths_after': after,
+        'history_unchanged': history_ok,
+        'leaderboards_unchanged': leaderboards_ok,
+        'rebuilt_stats_unchanged': rebuild_ok,
+    }, indent=2))
+    if not (history_ok and leaderboards_ok and rebuild_ok):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+/balance throughput with and without the user cache.
+
+Runs the same workload once per setting, each in a fresh process (the cache
+size is read when shekkle_bot.database is imported): concurrent /balance-style
+``get_user`` lookups through ``db.run_async`` for a skewed set of users, while
+a background writer keeps placing wagers and crediting balances. Reports
+lookups per second, latency percentiles and the cache's hit/miss counters, and
+checks at the end that no cached balance differs from the database.
+
+Usage: python -m benchmarks.balance_throughput [--lookups N] [--concurrency N] [--users N]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# The cached run holds a quarter of the users, so the LRU has to evict
+SETTINGS = {"uncached": "0", "cached": "250"}
+
+
+def run_child(args):
+    from benchmarks._common import use_temp_database, summarize_ms, CHAT_ID
+    use_temp_database(f"balance_throughput_{args.setting}")
+    os.environ["USER_CACHE_SIZE"] = SETTINGS[args.setting]
+
+    import shekkle_bot.database as db
+
+    db.init_db()
+    for uid in range(1, args.users + 1):
+        db.add_user(CHAT_ID, uid, f"user{uid}")
+    bet_id = db.create_bet(CHAT_ID, 1, "Bench", "2099-01-01T00:00:00", "Yes", "No")
+
+    stop = threading.Event()
+
+    def writer():
+        rng = random.Random(1)
+        while not stop.is_set():
+            uid = rng.randint(1, args.users)
+            if rng.random() < 0.5:
+                db.place_wager(CHAT_ID, uid, bet_id, rng.choice("AB"), 1)
+            else:
+                db.update_balance(CHAT_ID, uid, 1)
+
+    async def lookups():
+        rng = random.Random(2)
+        # A few active users make most requests
+        weights = [1 / rank for rank in range(1, args.users + 1)]
+        targets = rng.choices(range(1, args.users + 1), weights=weights, k=args.lookups)
+        samples = []
+        queue = iter(targets)
+
+        async def client():
+            for uid in queue:
+                t0 = time.perf_counter()
+                await db.run_async(db.get_user, CHAT_ID, uid)
+                samples.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+        return samples, time.perf_counter() - t0
+
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    try:
+        samples, elapsed = asyncio.run(lookups())
+    finally:
+        stop.set()
+        writer_thread.join()
+
+    cache_stats = db.user_cache.stats()
+    stale = 0
+    for uid in range(1, args.users + 1):
+        cached = db.user_cache.get(CHAT_ID, uid)
+        if cached is not None:
+            with db.get_db(readonly=True) as session:
+                balance = session.query(db.User.balance).filter(db.User.chat_id == CHAT_ID, db.User.user_id == uid).scalar()
+            stale += cached.balance != balance
+
+    result = summarize_ms(samples)
+    result['lookups_per_sec'] = round(len(samples) / elapsed, 1)
+    result['cache'] = cache_stats
+    result['stale_entries'] = stale
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--setting", choices=SETTINGS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.setting:
+        run_child(args)
+        return
+
+    results = {}
+    for setting in SETTINGS:
+        cmd = [sys.executable, "-m", "benchmarks.balance_throughput", "--setting", setting,
+               "--lookups", str(args.lookups), "--concurrency", str(args.concurrency),
+               "--users", str(args.users)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results[setting] = json.loads(out.strip().splitlines()[-1])
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+Stress test for handlers running in parallel: proves balances are conserved.
+
+Calls the real handlers from handlers/general.py, handlers/betting.py and
+handlers/admin.py concurrently on one event loop, as python-telegram-bot does
+with concurrent updates: every user fires several /daily at once, users
+/wager and tap wager buttons on a handful of hot bets (often for more than
+they have), an admin tops up balances with /give and settles bets with
+/resolve and /resolvebatch while wagers on them are still arriving.
+
+Afterwards every Shekel has to be accounted for:
+
+    balances + stakes on unsettled bets + payout rounding on settled bets
+        == starting balances + daily rewards (one per user) + /give amounts
+
+and no balance may be negative, nobody may have been paid the daily reward
+twice, no lock entries may be left behind, and every balance has to match
+the ledger (reconciled while the rounds run, with a checkpoint every
+`--checkpoint-every` entries). Exits non-zero on a violation.
+To run against PostgreSQL, point DATABASE_URL at an empty database.
+tests/test_concurrency.py runs a smaller stress() on every backend.
+
+Usage: python -m benchmarks.concurrency_stress [--users N] [--bets N] [--operations N] [--rounds N]
+                                              [--checkpoint-every N]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+from benchmarks._common import use_temp_database, CHAT_ID
+
+use_temp_database("concurrency_stress")
+ADMIN_ID = 1
+os.environ["ADMIN_IDS"] = str(ADMIN_ID)
+
+from sqlalchemy import func, select  # noqa: E402
+
+import shekkle_bot.database as db  # noqa: E402
+from shekkle_bot.concurrency import locks  # noqa: E402
+from shekkle_bot.config import DAILY_REWARD  # noqa: E402
+from shekkle_bot.handlers import admin, betting, general  # noqa: E402
+from shekkle_bot.models import User, Bet, Wager, LedgerEntry, BalanceCheckpoint  # noqa: E402
+
+START_BALANCE = 200
+DAILY_BURST = 3     # concurrent /daily per user
+
+
+class _Message:
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class _CallbackQuery:
+    def __init__(self, data):
+        self.data = data
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def _user(user_id):
+    return SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"User {user_id}")
+
+
+def command(user_id, *args):
+    update = SimpleNamespace(effective_user=_user(user_id), effective_chat=SimpleNamespace(id=CHAT_ID),
+                             message=_Message())
+    return update, SimpleNamespace(args=[str(a) for a in args])
+
+
+def button(user_id, data):
+    update = SimpleNamespace(effective_user=_user(user_id), effective_chat=SimpleNamespace(id=CHAT_ID),
+                             callback_query=_CallbackQuery(data))
+    return update, SimpleNamespace(args=None)
+
+
+def seed(users):
+    db.init_db()
+    with db.get_db() as session:
+        session.bulk_insert_mappings(User, [
+            {'user_id': uid, 'username': f"user{uid}", 'balance': START_BALANCE} for uid in range(1, users + 1)
+        ])
+        session.commit()
+    db.record_opening_balances()
+
+
+def daily(user_id, replies):
+    update, context = command(user_id)
+    replies.append(update.message.replies)
+    return general.daily(update, context)
+
+
+def round_operations(rng, users, bet_ids, operations, daily_replies):
+    """Returns (label, coroutine factory) pairs for one round in a shuffled order, and the Shekels given."""
+    ops = []
+    given = 0
+    for uid in range(1, users + 1):
+        for _ in range(DAILY_BURST):
+            ops.append(('daily', lambda uid=uid: daily(uid, daily_replies)))
+    for _ in range(operations):
+        uid = rng.randint(1, users)
+        bet_id = rng.choice(bet_ids)
+        choice = rng.choice("AB")
+        roll = rng.random()
+        if roll < 0.45:
+            amount = rng.randint(1, START_BALANCE)
+            ops.append(('wager', lambda u=uid, b=bet_id, c=choice, a=amount: betting.wager(*command(u, b, c, a))))
+        elif roll < 0.9:
+            ops.append(('tap', lambda u=uid, b=bet_id, c=choice:
+                        betting.wager_button(*button(u, f"wager:{b}:{c}"))))
+        else:
+            amount = rng.randint(1, 100)
+            given += amount
+            ops.append(('give', lambda u=uid, a=amount: admin.add_funds(*command(ADMIN_ID, u, a))))
+    rng.shuffle(ops)
+    # Settle most bets while the round is in full swing; the rest stay open
+    settle = bet_ids[:max(len(bet_ids) * 3 // 4, 1)]
+    half = len(settle) // 2
+    middle = len(ops) // 2
+    for bet_id in settle[:half]:
+        ops.insert(rng.randint(middle // 2, middle),
+                   ('resolve', lambda b=bet_id, o=rng.choice("AB"): admin.resolve(*command(ADMIN_ID, b, o))))
+    if settle[half:]:
+        entries = [f"{b}:{rng.choice('AB')}" for b in settle[half:]]
+        ops.insert(middle, ('resolvebatch', lambda e=entries: admin.resolve_batch(*command(ADMIN_ID, *e))))
+    return ops, given
+
+
+async def run(args, rng):
+    given = 0
+    counts = {}
+    daily_replies = []
+    peak_locks = 0
+
+    async def sample_locks(stop):
+        nonlocal peak_locks
+        while not stop.is_set():
+            peak_locks = max(peak_locks, len(locks))
+            await asyncio.sleep(0.001)
+
+    async def reconcile(stop):
+        # Reconcile alongside the handlers, so checkpoints are taken mid-round; handler
+        # transactions take milliseconds, so a second is plenty to let them commit
+        while not stop.is_set():
+            result = await db.run_async(db.reconcile_ledger, checkpoint_every=args.checkpoint_every, settle=1)
+            mismatched.update(result['mismatched'])
+            await asyncio.sleep(0.05)
+
+    mismatched = set()
+    t0 = time.perf_counter()
+    for _ in range(args.rounds):
+        bet_ids = [db.create_bet(CHAT_ID, ADMIN_ID, f"Stress bet {i}", "2099-01-01T00:00:00", "Yes", "No")
+                   for i in range(args.bets)]
+        ops, round_given = round_operations(rng, args.users, bet_ids, args.operations, daily_replies)
+        given += round_given
+        for label, _ in ops:
+            counts[label] = counts.get(label, 0) + 1
+        stop = asyncio.Event()
+        background = [asyncio.create_task(sample_locks(stop)), asyncio.create_task(reconcile(stop))]
+        await asyncio.gather(*(factory() for _, factory in ops))
+        stop.set()
+        await asyncio.gather(*background)
+    paid_daily = sum(1 for replies in daily_replies if replies and replies[0].startswith("💰"))
+    return given, counts, paid_daily, peak_locks, mismatched, time.perf_counter() - t0
+
+
+def reconcile_rest(checkpoint_every):
+    """Reconciles the entries left after the last round; returns the mismatched users."""
+    mismatched = set()
+    while True:
+        # Nothing is writing any more
+        result = db.reconcile_ledger(checkpoint_every=checkpoint_every, settle=0)
+        mismatched.update(result['mismatched'])
+        if not result['entries']:
+            return mismatched
+
+
+def audit(users, given):
+    live = Wager.refunded == 0
+    with db.get_db(readonly=True) as session:
+        balances = session.scalar(select(func.sum(User.balance)))
+        negative = session.scalar(select(func.count()).where(User.balance < 0))
+        claimed = session.scalar(select(func.count()).where(User.last_daily.is_not(None)))
+        open_stakes = session.scalar(
+            select(func.coalesce(func.sum(Wager.amount), 0)).join(Bet, Bet.id == Wager.bet_id)
+            .where(Bet.status != 'RESOLVED', live))
+        # Winners are paid int(amount * ratio), so settled pools keep a few Shekels back
+        rounding = session.scalar(
+            select(func.coalesce(func.sum(Wager.amount - func.coalesce(Wager.payout, 0)), 0))
+            .join(Bet, Bet.id == Wager.bet_id).where(Bet.status == 'RESOLVED', live))
+        wagers = session.scalar(select(func.count()).select_from(Wager))
+        ledger_entries = session.scalar(select(func.count()).select_from(LedgerEntry))
+        checkpoints = session.scalar(select(func.count()).select_from(BalanceCheckpoint))
+    return {
+        'wagers': wagers,
+        'daily_claims': claimed,
+        'given': given,
+        'balances': balances,
+        'open_stakes': open_stakes,
+        'settlement_rounding': rounding,
+        'expected_total': users * START_BALANCE + claimed * DAILY_REWARD + given,
+        'accounted_total': balances + open_stakes + rounding,
+        'negative_balances': negative,
+        'ledger_entries': ledger_entries,
+        'checkpoints': checkpoints,
+    }
+
+
+def stress(users=200, bets=8, operations=3000, rounds=3, checkpoint_every=5, seed_value=17):
+    """Seeds the database, runs the rounds and returns the audit, with 'failures' listing any violation."""
+    seed(users)
+    args = SimpleNamespace(users=users, bets=bets, operations=operations, rounds=rounds,
+                           checkpoint_every=checkpoint_every)
+    given, counts, paid_daily, peak_locks, mismatched, elapsed = asyncio.run(run(args, random.Random(seed_value)))
+    mismatched |= reconcile_rest(checkpoint_every)
+    report = audit(users, given)
+    report.update({
+        'operations': counts,
+        'daily_rewards_paid': paid_daily,
+        'elapsed_s': round(elapsed, 2),
+        'peak_lock_entries': peak_locks,
+        'lock_entries_left': len(locks),
+        'ledger_mismatches': len(mismatched),
+    })
+    failures = []
+    if report['accounted_total'] != report['expected_total']:
+        failures.append("balances are not conserved")
+    if report['negative_balances']:
+        failures.append("negative balances")
+    if report['daily_rewards_paid'] != report['daily_claims']:
+        failures.append("daily reward paid more than once")
+    if report['lock_entries_left']:
+        failures.append("idle lock entries were not evicted")
+    if report['ledger_mismatches']:
+        failures.append("balances differ from the ledger")
+    report['ok'] = not failures
+    report['failures'] = failures
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--bets", type=int, default=8, help="open bets per round; few, so wagers collide")
+    parser.add_argument("--operations", type=int, default=3000, help="wagers, taps and /give per round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--checkpoint-every", type=int, default=5, help="ledger entries per balance checkpoint")
+    args = parser.parse_args()
+
+    report = stress(args.users, args.bets, args.operations, args.rounds, args.checkpoint_every)
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report['failures'] else 0)
+
+
+if __name__ == '__main__':
+    main()
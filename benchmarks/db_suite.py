@@ -0,0 +1,248 @@
+"""
+Database layer benchmark suite on synthetic data.
+
+Generates a realistic dataset through the models.py schema (default 10k users,
+5k bets, 1M wagers), then times the public functions of shekkle_bot.database
+against it: reads first, then place_wager, then resolve_bet on bets reserved
+for it. User activity is skewed (a few users place most wagers), most bets
+are resolved, and a slice of the open bets is past its deadline.
+
+Each scale factor runs in a fresh process and database, so the sizes where a
+function stops scaling show up side by side:
+
+    python -m benchmarks.db_suite --scales 0.01,0.1,1 --output bench.json
+
+Results are JSON: run metadata (git commit, versions, sizes) plus per-function
+latency percentiles and calls per second, for comparing runs across commits.
+To run against PostgreSQL, point DATABASE_URL at an empty database.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+DEFAULTS = {'users': 10_000, 'bets': 5_000, 'wagers': 1_000_000}
+# Share of bets still open; of those, the share already past the deadline
+OPEN_SHARE = 0.1
+EXPIRED_SHARE = 0.2
+INSERT_CHUNK = 10_000
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+def sizes_for(args, scale):
+    return {name: max(int(getattr(args, name) * scale), 10) for name in DEFAULTS}
+
+
+def generate(db, sizes, seed=1):
+    """Fills an empty database and returns ids the benchmarks draw from."""
+    from sqlalchemy import insert
+    from benchmarks._common import CHAT_ID
+    from shekkle_bot.models import User, Bet, Wager, BetRoute
+
+    rng = random.Random(seed)
+    now = int(time.time())
+    users, bets, wagers = sizes['users'], sizes['bets'], sizes['wagers']
+    user_ids = list(range(1, users + 1))
+    # Zipf-like activity: user k is picked with weight 1/k
+    weights = [1 / k for k in user_ids]
+
+    bet_rows, open_ids, expired_ids = [], [], []
+    open_count = max(int(bets * OPEN_SHARE), 2)
+    for bet_id in range(1, bets + 1):
+        created = now - int(rng.uniform(1, 365) * DAY)
+        row = {'id': bet_id, 'creator_id': rng.choice(user_ids), 'description': f"Synthetic bet #{bet_id}",
+               'option_a': "Yes", 'option_b': "No", 'status': 'RESOLVED', 'outcome': rng.choice("AB"),
+               'deadline': created + int(rng.uniform(0.1, 7) * DAY),
+               'resolved_at': None, 'cutoff_at': None}
+        if bet_id > bets - open_count:
+            row['status'], row['outcome'] = 'OPEN', None
+            if rng.random() < EXPIRED_SHARE:
+                row['deadline'] = now - int(rng.uniform(1, 48) * HOUR)
+                expired_ids.append(bet_id)
+            else:
+                row['deadline'] = now + int(rng.uniform(30, 60) * DAY)
+                open_ids.append(bet_id)
+        else:
+            row['resolved_at'] = row['deadline']
+        bet_rows.append(row)
+
+    # Wagers per bet vary a lot too; every bet gets at least one
+    bet_weights = [rng.paretovariate(1.5) for _ in bet_rows]
+    targets = rng.choices(range(bets), weights=bet_weights, k=wagers - bets) + list(range(bets))
+    bettors = rng.choices(user_ids, weights=weights, k=wagers)
+    by_bet = {}
+    for i, bet_index in enumerate(targets):
+        bet = bet_rows[bet_index]
+        placed = bet['deadline'] - int(rng.uniform(0.1, 24) * HOUR)
+        by_bet.setdefault(bet['id'], []).append({
+            'user_id': bettors[i], 'bet_id': bet['id'], 'choice': rng.choice("AB"),
+            'amount': rng.randint(1, 200), 'placed_at': placed, 'refunded': 0, 'payout': None,
+        })
+
+    # Payouts for resolved bets, with resolve_bet's arithmetic
+    for bet in bet_rows:
+        rows = by_bet[bet['id']]
+        if bet['status'] != 'RESOLVED':
+            continue
+        total = sum(w['amount'] for w in rows)
+        winning = sum(w['amount'] for w in rows if w['choice'] == bet['outcome'])
+        for w in rows:
+            if winning == 0:
+                w['refunded'] = 1
+            else:
+                w['payout'] = int(w['amount'] * (total / winning)) if w['choice'] == bet['outcome'] else 0
+
+    with db.get_db() as session:
+        session.execute(insert(BetRoute), [{'bet_id': b['id'], 'chat_id': CHAT_ID} for b in bet_rows])
+        session.commit()
+    with db.get_db(chat_id=CHAT_ID) as session:
+        session.execute(insert(User), [
+            {'user_id': uid, 'username': f"user{uid}", 'balance': 1_000_000,
+             'last_daily': now - int(rng.uniform(0, 48) * HOUR)}
+            for uid in user_ids
+        ])
+        session.execute(insert(Bet), bet_rows)
+        chunk = []
+        for rows in by_bet.values():
+            chunk.extend(rows)
+            if len(chunk) >= INSERT_CHUNK:
+                session.execute(insert(Wager), chunk)
+                chunk = []
+        if chunk:
+            session.execute(insert(Wager), chunk)
+        session.commit()
+
+    db.rebuild_user_stats(db.shard_for_chat(CHAT_ID).name)
+    db.rebuild_bet_pools(db.shard_for_chat(CHAT_ID).name)
+    db.user_cache.clear()
+    return {
+        'user_ids': user_ids, 'weights': weights, 'open_ids': open_ids,
+        'expired_ids': expired_ids, 'all_bet_ids': [b['id'] for b in bet_rows],
+    }
+
+
+def timed(calls):
+    """Runs each zero-argument callable in `calls` and returns latency samples in seconds."""
+    samples = []
+    for call in calls:
+        t0 = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def run_child(args):
+    from benchmarks._common import use_temp_database, summarize_ms, CHAT_ID as chat
+    use_temp_database(f"db_suite_{args.scale}")
+
+    import shekkle_bot.database as db
+
+    sizes = sizes_for(args, args.scale)
+    db.init_db()
+    t0 = time.perf_counter()
+    data = generate(db, sizes)
+    generate_s = time.perf_counter() - t0
+
+    rng = random.Random(2)
+    n = args.samples
+    users = lambda: rng.choices(data['user_ids'], weights=data['weights'])[0]  # noqa: E731
+    now = int(time.time())
+    # Bets reserved for resolve_bet are left out of the place_wager targets
+    resolvable = data['open_ids'][:max(len(data['open_ids']) // 2, 1)]
+    wager_targets = data['open_ids'][len(resolvable):] or resolvable
+
+    benchmarks = {
+        'get_open_bets': lambda: db.get_open_bets(chat),
+        'get_open_bet_page': lambda: db.get_open_bet_page(chat, rng.choice(data['open_ids'])),
+        'get_expired_open_bets': lambda: db.get_expired_open_bets(now),
+        'get_bet_wagers': lambda: db.get_bet_wagers(chat, rng.choice(data['all_bet_ids'])),
+        'get_bet_status': lambda: db.get_bet_status(chat, rng.choice(data['all_bet_ids'])),
+        'get_user_history': lambda: db.get_user_history(chat, users(), limit=5),
+        'get_leaderboard_data': lambda: db.get_leaderboard_data(chat),
+        'get_top_winners': lambda: db.get_top_winners(chat, 10),
+        # Cleared first so this measures the database lookup, not the LRU
+        'get_user': lambda: (db.user_cache.clear(), db.get_user(chat, users())),
+        'place_wager': lambda: db.place_wager(chat, users(), rng.choice(wager_targets), rng.choice("AB"), 10),
+    }
+    results = {}
+    for name, call in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        samples = timed([call] * n)
+        results[name] = summarize_ms(samples)
+        results[name]['calls_per_sec'] = round(len(samples) / sum(samples), 1)
+
+    if not args.only or 'resolve_bet' in args.only:
+        bets = resolvable[:n]
+        samples = timed([lambda bet_id=bet_id: db.resolve_bet(bet_id, rng.choice("AB")) for bet_id in bets])
+        results['resolve_bet'] = summarize_ms(samples)
+        results['resolve_bet']['calls_per_sec'] = round(len(samples) / sum(samples), 1) if samples else 0.0
+
+    print(json.dumps({
+        'scale': args.scale,
+        'sizes': sizes,
+        'generate_s': round(generate_s, 2),
+        'results': results,
+    }))
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import sqlalchemy
+    return {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'database': "DATABASE_URL" if os.getenv("DATABASE_URL") else "sqlite (temporary file)",
+        'samples': args.samples,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=DEFAULTS['users'])
+    parser.add_argument("--bets", type=int, default=DEFAULTS['bets'])
+    parser.add_argument("--wagers", type=int, default=DEFAULTS['wagers'])
+    parser.add_argument("--scales", default="1", help="comma-separated size multipliers, e.g. 0.01,0.1,1")
+    parser.add_argument("--samples", type=int, default=50, help="calls per function")
+    parser.add_argument("--only", nargs="*", help="time only these functions")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--scale", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale is not None:
+        run_child(args)
+        return
+
+    report = {'meta': metadata(args), 'runs': []}
+    for scale in (float(s) for s in args.scales.split(",")):
+        cmd = [sys.executable, "-m", "benchmarks.db_suite", "--scale", str(scale),
+               "--users", str(args.users), "--bets", str(args.bets), "--wagers", str(args.wagers),
+               "--samples", str(args.samples)]
+        if args.only:
+            cmd += ["--only", *args.only]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        report['runs'].append(json.loads(out.strip().splitlines()[-1]))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Winner notifications: sequential sends vs the outbound dispatcher.
+
+Notifies N distinct users through a local fake Bot API that adds a fixed
+round-trip latency and enforces Telegram's rate limits. The sequential
+scenario awaits send_message once per winner, the way /resolve used to; the
+dispatcher scenario enqueues everything to the outbox and lets it deliver.
+Reports how long the admin command is blocked, time until every message is
+delivered, and how many 429s the fake API had to return.
+
+Usage: python -m benchmarks.dispatcher_throughput [--messages N] [--latency S]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks._common import use_temp_database
+
+use_temp_database("dispatcher_throughput")
+
+from telegram import Bot  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+import shekkle_bot.database as db  # noqa: E402
+from shekkle_bot.dispatcher import MessageDispatcher  # noqa: E402
+from shekkle_bot.config import OUTBOX_CONCURRENCY  # noqa: E402
+from benchmarks.fake_bot_api import FakeBotAPI  # noqa: E402
+
+
+def messages_for(count):
+    return [{'chat_id': 10_000 + i, 'text': f"🎉 Bet Won! Payout: {i}", 'parse_mode': 'HTML'} for i in range(count)]
+
+
+async def sequential(bot, messages):
+    t0 = time.perf_counter()
+    for m in messages:
+        try:
+            await bot.send_message(chat_id=m['chat_id'], text=m['text'], parse_mode=m['parse_mode'])
+        except Exception:
+            pass
+    elapsed = time.perf_counter() - t0
+    return {'command_blocked_s': round(elapsed, 3), 'all_delivered_s': round(elapsed, 3)}
+
+
+async def dispatched(bot, messages, api):
+    dispatcher = MessageDispatcher()
+    dispatcher.start(bot)
+    sent_before = len(api.calls_to('sendMessage'))
+    t0 = time.perf_counter()
+    await dispatcher.enqueue(messages)
+    blocked = time.perf_counter() - t0
+    while len(api.calls_to('sendMessage')) - sent_before < len(messages):
+        await asyncio.sleep(0.05)
+    delivered = time.perf_counter() - t0
+    await dispatcher.stop()
+    return {'command_blocked_s': round(blocked, 3), 'all_delivered_s': round(delivered, 3)}
+
+
+async def run(args):
+    db.init_db()
+    results = {}
+    for name in ("sequential", "dispatcher"):
+        api = FakeBotAPI(latency=args.latency, enforce_limits=True)
+        base_url = api.start()
+        bot = Bot("123:fake", base_url=base_url,
+                  request=HTTPXRequest(connection_pool_size=OUTBOX_CONCURRENCY + 4))
+        await bot.initialize()
+        try:
+            if name == "sequential":
+                result = await sequential(bot, messages_for(args.messages))
+            else:
+                result = await dispatched(bot, messages_for(args.messages), api)
+        finally:
+            await bot.shutdown()
+            api.stop()
+        result['rate_limited_429'] = api.rate_limited
+        result['delivered'] = len(api.calls_to('sendMessage'))
+        results[name] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.15, help="simulated Bot API round trip in seconds")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
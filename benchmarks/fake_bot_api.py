@@ -0,0 +1,163 @@
+"""
+Local stand-in for the Telegram Bot API.
+
+Serves the Bot API's HTTP interface on 127.0.0.1 so python-telegram-bot can be
+pointed at it with ``base_url`` (or a whole bot with BOT_API_URL). Every call
+is recorded and can be observed through ``on_call``. Updates queued with
+``push_update`` are served to the bot by long-polling ``getUpdates``.
+Optional artificial latency models the round trip to Telegram, and optional
+rate limiting answers with 429/retry_after like the real API when a bot
+exceeds ~30 messages per second overall or 1 message per second in one chat.
+"""
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+SEND_METHODS = {'sendMessage'}
+
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, enforce_limits=False, global_rate=30, per_chat_interval=1.0, on_call=None):
+        self.latency = latency
+        self.enforce_limits = enforce_limits
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        # on_call(method, params) runs on the server thread after each successful call
+        self.on_call = on_call
+        self.calls = []            # (timestamp, method, params); getUpdates is not recorded
+        self.rate_limited = 0
+        self.polling = threading.Event()
+        self._lock = threading.Lock()
+        self._updates_ready = threading.Condition(self._lock)
+        self._updates = []
+        self._next_update_id = 1
+        self._recent_sends = deque()
+        self._last_chat_send = {}
+        self._message_id = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else ""
+                method = self.path.rsplit('/', 1)[-1]
+                status, payload = api.handle(method, _parse_params(self.headers.get('Content-Type', ''), body))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def calls_to(self, method):
+        with self._lock:
+            return [c for c in self.calls if c[1] == method]
+
+    def push_update(self, update):
+        """Queues an Update (dict without update_id) for getUpdates; returns its update_id."""
+        with self._updates_ready:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append(dict(update, update_id=update_id))
+            self._updates_ready.notify_all()
+        return update_id
+
+    def handle(self, method, params):
+        """Returns (http_status, json_payload) for one Bot API call."""
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if self.latency:
+            time.sleep(self.latency)
+        status, payload = self._handle(method, params)
+        if status == 200 and self.on_call:
+            self.on_call(method, params)
+        return status, payload
+
+    def _get_updates(self, params):
+        self.polling.set()
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        with self._updates_ready:
+            # Updates below the offset have been confirmed by the bot
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            if not self._updates and timeout:
+                self._updates_ready.wait_for(lambda: self._updates, timeout=timeout)
+            return self._updates[:limit]
+
+    def _handle(self, method, params):
+        now = time.monotonic()
+        with self._lock:
+            if method in SEND_METHODS and self.enforce_limits:
+                retry_after = self._check_limits(int(params.get('chat_id', 0)), now)
+                if retry_after:
+                    self.rate_limited += 1
+                    return 429, {
+                        'ok': False, 'error_code': 429,
+                        'description': f"Too Many Requests: retry after {retry_after}",
+                        'parameters': {'retry_after': retry_after},
+                    }
+            self.calls.append((time.time(), method, params))
+            return 200, {'ok': True, 'result': self._result(method, params)}
+
+    def _check_limits(self, chat_id, now):
+        while self._recent_sends and now - self._recent_sends[0] > 1.0:
+            self._recent_sends.popleft()
+        if len(self._recent_sends) >= self.global_rate:
+            return 1
+        # Small tolerance for timer jitter between client and server
+        last = self._last_chat_send.get(chat_id)
+        if last is not None and now - last < self.per_chat_interval * 0.9:
+            return 1
+        self._recent_sends.append(now)
+        self._last_chat_send[chat_id] = now
+        return 0
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': "Fake", 'username': "fake_bot",
+                    'can_join_groups': True, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': False}
+        if method in SEND_METHODS or method == 'editMessageText':
+            self._message_id += 1
+            chat_id = int(params.get('chat_id', 0))
+            return {'message_id': self._message_id, 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+                    'text': params.get('text', "")}
+        return True
+
+
+def _parse_params(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    return {k: v[0] for k, v in parse_qs(body).items()}
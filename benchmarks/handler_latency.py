@@ -0,0 +1,127 @@
+"""
+Handler latency while a long query runs on the same event loop.
+
+Fires a cheap /balance-style lookup every few milliseconds while a long
+query runs back to back, once with the database called directly inside the
+coroutine (the old behaviour) and once through ``db.run_async``. Latency is
+measured from each request's scheduled start, so requests that could not even
+be started while the loop was blocked count too.
+
+The long query is the leaderboard as it was computed before the user_stats
+table: an aggregation over every resolved wager. /leaderboard itself is now
+too cheap to block the loop for long, so this stands in for any slow query
+(`--wagers-per-bet` sizes it; the report includes how long it took).
+
+Usage: python -m benchmarks.handler_latency [--users N] [--bets N] [--wagers-per-bet N]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from benchmarks._common import use_temp_database, summarize_ms, CHAT_ID
+
+use_temp_database("handler_latency")
+
+from sqlalchemy import case, func, select  # noqa: E402
+
+import shekkle_bot.database as db  # noqa: E402
+from shekkle_bot.models import User, Bet, Wager  # noqa: E402
+from shekkle_bot.timestamps import to_epoch  # noqa: E402
+
+
+def seed(users, bets, wagers_per_bet):
+    db.init_db()
+    rng = random.Random(42)
+    with db.get_db() as session:
+        session.bulk_insert_mappings(User, [
+            {'user_id': uid, 'username': f"user{uid}", 'balance': 1000} for uid in range(1, users + 1)
+        ])
+        session.bulk_insert_mappings(Bet, [
+            {'id': bid, 'creator_id': 1, 'description': f"Bet {bid}", 'deadline': to_epoch("2020-01-01T00:00:00"),
+             'option_a': "Yes", 'option_b': "No", 'status': 'RESOLVED', 'outcome': rng.choice("AB")}
+            for bid in range(1, bets + 1)
+        ])
+        session.bulk_insert_mappings(Wager, [
+            {'user_id': rng.randint(1, users), 'bet_id': bid, 'choice': rng.choice("AB"),
+             'amount': rng.randint(1, 100), 'placed_at': to_epoch("2019-12-31T12:00:00"), 'refunded': 0}
+            for bid in range(1, bets + 1) for _ in range(wagers_per_bet)
+        ])
+        session.commit()
+
+
+def full_scan_leaderboard(chat_id):
+    """Net winnings per user from every resolved wager of the chat: a full scan of wagers joined to bets."""
+    won = Wager.choice == Bet.outcome
+    net = func.sum(case((won, Wager.amount), else_=-Wager.amount)).label('net')
+    with db.get_db(readonly=True, chat_id=chat_id) as session:
+        return session.execute(
+            select(Wager.user_id, net, func.count(Wager.id))
+            .join(Bet, Bet.id == Wager.bet_id)
+            .where(Wager.chat_id == chat_id, Bet.status == 'RESOLVED', Wager.refunded == 0)
+            .group_by(Wager.user_id).order_by(net.desc())).all()
+
+
+async def run_scenario(offload, users, duration, interval):
+    async def call(func, *args):
+        if offload:
+            return await db.run_async(func, *args)
+        return func(*args)
+
+    stop_at = time.perf_counter() + duration
+    long_runs = []
+
+    async def long_queries():
+        while time.perf_counter() < stop_at:
+            t0 = time.perf_counter()
+            await call(full_scan_leaderboard, CHAT_ID)
+            long_runs.append(time.perf_counter() - t0)
+            await asyncio.sleep(0)
+
+    latencies = []
+
+    async def short_request(scheduled):
+        await call(db.get_user, CHAT_ID, random.randint(1, users))
+        latencies.append(time.perf_counter() - scheduled)
+
+    async def generator():
+        start = time.perf_counter()
+        tasks = []
+        i = 0
+        while True:
+            scheduled = start + i * interval
+            if scheduled >= stop_at:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(short_request(scheduled)))
+            i += 1
+        await asyncio.gather(*tasks)
+
+    await asyncio.gather(long_queries(), generator())
+    return {
+        'short_requests': summarize_ms(latencies),
+        'long_query': summarize_ms(long_runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--bets", type=int, default=500)
+    parser.add_argument("--wagers-per-bet", type=int, default=400)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per scenario")
+    parser.add_argument("--interval", type=float, default=0.005, help="seconds between short requests")
+    args = parser.parse_args()
+
+    seed(args.users, args.bets, args.wagers_per_bet)
+    results = {}
+    for name, offload in (("blocking", False), ("run_async", True)):
+        results[name] = asyncio.run(run_scenario(offload, args.users, args.duration, args.interval))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
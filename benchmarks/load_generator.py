@@ -0,0 +1,374 @@
+"""
+End-to-end load test of the bot against a local fake Bot API.
+
+Starts benchmarks.fake_bot_api.FakeBotAPI, seeds a temporary database with
+users and open bets, and runs the real bot (``python -m shekkle_bot.main``)
+in a subprocess with BOT_API_URL pointing at the fake server. Simulated users
+then send a configurable mix of commands as updates served via getUpdates.
+Every simulated user has at most one request in flight; a request completes
+when the bot makes the call that answers it. Users talk to the bot in their
+private chats, so every user is in an economy of their own with `--bets` open
+bets:
+
+    wager        /wager <bet> <A|B> <amount>   -> sendMessage
+    tap          inline "wager:<bet>:<A|B>"    -> answerCallbackQuery
+    page         inline "page_bet:<bet>:<pos>" -> editMessageText
+    leaderboard  /leaderboard                  -> sendMessage
+    daily        /daily                        -> sendMessage
+
+With ``--mode webhook`` the bot runs its webhook server instead and updates
+are posted to it directly, as Telegram would. ``--concurrent-updates`` sets
+the bot's CONCURRENT_UPDATES (1 processes updates one at a time). In webhook
+mode, ``--workers N`` runs N bot processes with MULTI_WORKER on the same
+database and posts the updates to them in turn, like a round-robin load
+balancer, so a user's consecutive updates land on different workers.
+
+Reports throughput and latency percentiles per command as JSON, together with
+the bot's own per-handler metrics (SQL statements, time awaiting the database
+and Bot API per call) scraped from its metrics endpoint before it stops.
+
+Usage: python -m benchmarks.load_generator [--users N] [--requests N] [--concurrency N]
+       [--mix wager=20,tap=40,page=20,leaderboard=10,daily=10] [--latency S]
+       [--mode polling|webhook] [--concurrent-updates N] [--workers N]
+"""
+import argparse
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from benchmarks._common import use_temp_database, summarize_ms
+
+DB_FILE = use_temp_database("load_generator")
+
+import shekkle_bot.database as db  # noqa: E402
+from benchmarks.fake_bot_api import FakeBotAPI  # noqa: E402
+from shekkle_bot.models import User, Bet, BetRoute  # noqa: E402
+from shekkle_bot.timestamps import to_epoch  # noqa: E402
+
+DEFAULT_MIX = "wager=20,tap=40,page=20,leaderboard=10,daily=10"
+# Bot API call that completes each kind of request
+COMPLETES_ON = {
+    'wager': 'sendMessage',
+    'tap': 'answerCallbackQuery',
+    'page': 'editMessageText',
+    'leaderboard': 'sendMessage',
+    'daily': 'sendMessage',
+}
+REQUEST_TIMEOUT = 30
+BOT_ID = 1
+WEBHOOK_SECRET = "loadtest-secret"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in COMPLETES_ON:
+            raise SystemExit(f"Unknown command '{name}' in --mix; choose from {', '.join(COMPLETES_ON)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def seed(users, bets):
+    """Seeds every user's private chat with the user and `bets` open bets; returns {user_id: bet ids}."""
+    db.init_db()
+    bet_ids = {1000 + uid: list(range(uid * bets + 1, (uid + 1) * bets + 1)) for uid in range(users)}
+    with db.get_db() as session:
+        session.bulk_insert_mappings(BetRoute, [
+            {'bet_id': bid, 'chat_id': user_id} for user_id, ids in bet_ids.items() for bid in ids
+        ])
+        session.bulk_insert_mappings(User, [
+            {'chat_id': 1000 + uid, 'user_id': 1000 + uid, 'username': f"user{uid}", 'balance': 1_000_000}
+            for uid in range(users)
+        ])
+        session.bulk_insert_mappings(Bet, [
+            {'id': bid, 'chat_id': user_id, 'creator_id': user_id, 'description': f"Load test bet {bid}",
+             'deadline': to_epoch("2099-01-01T00:00:00"), 'option_a': "Yes", 'option_b': "No", 'status': 'OPEN'}
+            for user_id, ids in bet_ids.items() for bid in ids
+        ])
+        session.commit()
+    db.record_opening_balances()
+    return bet_ids
+
+
+class LoadGenerator:
+    def __init__(self, args, bet_ids):
+        self.args = args
+        self.bet_ids = bet_ids
+        self.mix = parse_mix(args.mix)
+        self.api = FakeBotAPI(latency=args.latency, on_call=self._on_call)
+        self._pending = {}          # (method, key) -> [kind, start, threading.Event]
+        self._pending_lock = threading.Lock()
+        self._idle_users = queue.Queue()
+        self._message_ids = itertools.count(1)
+        self._webhook_urls = []
+        self._next_webhook = itertools.count()
+        self._webhooks_set = 0
+        self._webhook_set = threading.Event()
+        self._update_ids = itertools.count(1)
+        self.samples = {kind: [] for kind in self.mix}
+        self.timeouts = {kind: 0 for kind in self.mix}
+
+    def _on_call(self, method, params):
+        if method == 'setWebhook':
+            with self._pending_lock:
+                self._webhooks_set += 1
+                if self._webhooks_set >= self.args.workers:
+                    self._webhook_set.set()
+            return
+        if method == 'answerCallbackQuery':
+            key = (method, str(params.get('callback_query_id')))
+        else:
+            key = (method, int(params.get('chat_id', 0)))
+        with self._pending_lock:
+            request = self._pending.pop(key, None)
+        if request:
+            kind, start, done = request
+            self.samples[kind].append(time.perf_counter() - start)
+            done.set()
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'username': f"user{user_id - 1000}"}
+
+    def _command(self, user_id, text):
+        command = text.split()[0]
+        return {'message': {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        }}
+
+    def _callback(self, user_id, data, query_id):
+        return {'callback_query': {
+            'id': query_id, 'from': self._user(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': {'message_id': next(self._message_ids), 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'text': "Bet page",
+                        'from': {'id': BOT_ID, 'is_bot': True, 'first_name': "Fake"}},
+        }}
+
+    def _request(self, kind, user_id, rng):
+        """Builds the update for one request and the key of the call that completes it."""
+        bet_ids = self.bet_ids[user_id]
+        bet_id = rng.choice(bet_ids)
+        method = COMPLETES_ON[kind]
+        if kind == 'wager':
+            return self._command(user_id, f"/wager {bet_id} {rng.choice('AB')} {rng.randint(1, 20)}"), (method, user_id)
+        if kind == 'leaderboard':
+            return self._command(user_id, "/leaderboard"), (method, user_id)
+        if kind == 'daily':
+            return self._command(user_id, "/daily"), (method, user_id)
+        query_id = f"{user_id}-{rng.getrandbits(48)}"
+        if kind == 'tap':
+            return self._callback(user_id, f"wager:{bet_id}:{rng.choice('AB')}", query_id), (method, query_id)
+        position = bet_ids.index(bet_id) + 1
+        return self._callback(user_id, f"page_bet:{bet_id}:{position}", query_id), (method, user_id)
+
+    def _worker(self, seed, requests):
+        rng = random.Random(seed)
+        kinds, weights = list(self.mix), list(self.mix.values())
+        for _ in range(requests):
+            user_id = self._idle_users.get()
+            kind = rng.choices(kinds, weights=weights)[0]
+            update, key = self._request(kind, user_id, rng)
+            done = threading.Event()
+            with self._pending_lock:
+                self._pending[key] = [kind, time.perf_counter(), done]
+            self._send(update)
+            if not done.wait(REQUEST_TIMEOUT):
+                with self._pending_lock:
+                    self._pending.pop(key, None)
+                self.timeouts[kind] += 1
+            self._idle_users.put(user_id)
+
+    def _send(self, update):
+        if not self._webhook_urls:
+            self.api.push_update(update)
+            return
+        url = self._webhook_urls[next(self._next_webhook) % len(self._webhook_urls)]
+        data = json.dumps(dict(update, update_id=next(self._update_ids))).encode()
+        request = urllib.request.Request(url, data=data, headers={
+            'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET,
+        })
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT):
+            pass
+
+    def _wait_until_ready(self, log_path):
+        if self.args.mode == 'polling':
+            if not self.api.polling.wait(60):
+                raise SystemExit(f"The bot did not start polling; see {log_path}")
+            return
+        if not self._webhook_set.wait(60):
+            raise SystemExit(f"The bot did not set its webhook; see {log_path}")
+        deadline = time.monotonic() + 30
+        for url in self._webhook_urls:
+            host, port = urllib.parse.urlsplit(url).netloc.split(":")
+            while True:
+                try:
+                    socket.create_connection((host, int(port)), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise SystemExit(f"The webhook server is not accepting connections; see {log_path}")
+                    time.sleep(0.1)
+
+    def run(self):
+        base_url = self.api.start()
+        users = list(range(1000, 1000 + self.args.users))
+        random.Random(0).shuffle(users)
+        for user_id in users:
+            self._idle_users.put(user_id)
+
+        metrics_ports, bots = [], []
+        log_path = os.path.join(os.path.dirname(DB_FILE), "bot*.log" if self.args.workers > 1 else "bot.log")
+        for worker in range(self.args.workers):
+            metrics_ports.append(_free_port())
+            env = dict(os.environ, TOKEN="123456:LOADTEST", BOT_API_URL=base_url, DB_PATH=DB_FILE, ADMIN_IDS="",
+                       METRICS_HOST="127.0.0.1", METRICS_PORT=str(metrics_ports[-1]))
+            env.pop("DATABASE_URL", None)
+            if self.args.concurrent_updates is not None:
+                env["CONCURRENT_UPDATES"] = str(self.args.concurrent_updates)
+            if self.args.mode == 'webhook':
+                webhook_port = _free_port()
+                self._webhook_urls.append(f"http://127.0.0.1:{webhook_port}/telegram")
+                env.update(RUN_MODE="webhook", WEBHOOK_URL=self._webhook_urls[-1], WEBHOOK_LISTEN="127.0.0.1",
+                           WEBHOOK_PORT=str(webhook_port), WEBHOOK_SECRET=WEBHOOK_SECRET)
+            else:
+                env["RUN_MODE"] = "polling"
+            if self.args.workers > 1:
+                env.update(MULTI_WORKER="1", WORKER_ID=f"worker{worker}")
+            with open(log_path.replace("*", str(worker)), "w") as log:
+                bots.append(subprocess.Popen([sys.executable, "-m", "shekkle_bot.main"], env=env,
+                                             stdout=log, stderr=subprocess.STDOUT))
+        try:
+            self._wait_until_ready(log_path)
+
+            per_worker, extra = divmod(self.args.requests, self.args.concurrency)
+            threads = [threading.Thread(target=self._worker, args=(i, per_worker + (i < extra)))
+                       for i in range(self.args.concurrency)]
+            t0 = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - t0
+            handler_metrics = scrape_metrics(metrics_ports)
+        finally:
+            for bot in bots:
+                bot.send_signal(signal.SIGINT)
+            for bot in bots:
+                try:
+                    bot.wait(30)
+                except subprocess.TimeoutExpired:
+                    bot.kill()
+            self.api.stop()
+        return self.report(elapsed, handler_metrics)
+
+    def report(self, elapsed, handler_metrics):
+        commands = {}
+        for kind, samples in self.samples.items():
+            stats = summarize_ms(samples)
+            stats['per_sec'] = round(len(samples) / elapsed, 1)
+            stats['timeouts'] = self.timeouts[kind]
+            commands[kind] = stats
+        everything = [s for samples in self.samples.values() for s in samples]
+        total = summarize_ms(everything)
+        total['per_sec'] = round(len(everything) / elapsed, 1)
+        total['timeouts'] = sum(self.timeouts.values())
+        return {
+            'mode': self.args.mode,
+            'concurrent_updates': self.args.concurrent_updates,
+            'workers': self.args.workers,
+            'users': self.args.users,
+            'concurrency': self.args.concurrency,
+            'api_latency_s': self.args.latency,
+            'elapsed_s': round(elapsed, 2),
+            'total': total,
+            'commands': commands,
+            'bot_api_calls': {m: len(self.api.calls_to(m)) for m in sorted({c[1] for c in self.api.calls})},
+            'handlers': handler_metrics,
+        }
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+METRIC_LINE = re.compile(r'^(\w+)\{([^}]*)\} (\S+)$')
+
+
+def scrape_metrics(ports):
+    """Per-handler averages from the bots' metrics endpoints, all workers together: {handler: {...}}."""
+    text = ""
+    for port in ports:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+                text += response.read().decode()
+        except OSError:
+            pass
+    totals = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.groups()
+        handler = dict(re.findall(r'(\w+)="([^"]*)"', labels)).get('handler')
+        if handler is None:
+            continue
+        entry = totals.setdefault(handler, {'calls': 0, 'queries': 0, 'db_s': 0.0, 'telegram_s': 0.0})
+        if name == 'shekkle_handler_duration_seconds_count':
+            entry['calls'] += int(float(value))
+        elif name == 'shekkle_db_queries_total':
+            entry['queries'] += int(float(value))
+        elif name == 'shekkle_db_seconds_total':
+            entry['db_s'] += float(value)
+        elif name == 'shekkle_telegram_seconds_total':
+            entry['telegram_s'] += float(value)
+    return {
+        handler: {
+            'calls': t['calls'],
+            'queries_per_call': round(t['queries'] / t['calls'], 2),
+            'db_ms_per_call': round(t['db_s'] / t['calls'] * 1000, 3),
+            'telegram_ms_per_call': round(t['telegram_s'] / t['calls'] * 1000, 3),
+        }
+        for handler, t in sorted(totals.items()) if t['calls']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000, help="simulated users")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50, help="requests in flight at once")
+    parser.add_argument("--bets", type=int, default=20, help="open bets per chat to page through and wager on")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="comma-separated command=weight pairs")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Bot API round trip in seconds")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling",
+                        help="how updates reach the bot")
+    parser.add_argument("--concurrent-updates", type=int,
+                        help="the bot's CONCURRENT_UPDATES (default: its configured value)")
+    parser.add_argument("--workers", type=int, default=1, help="bot processes sharing the database (webhook mode)")
+    args = parser.parse_args()
+    if args.concurrency > args.users:
+        parser.error("--concurrency cannot exceed --users")
+    if args.workers > 1 and args.mode != 'webhook':
+        parser.error("--workers requires --mode webhook")
+
+    bet_ids = seed(args.users, args.bets)
+    print(json.dumps(LoadGenerator(args, bet_ids).run(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Conversation/user_data persistence: DatabasePersistence vs PicklePersistence.
+
+Stores N users halfway through /createbet (a conversation state plus their
+user_data), then measures, for both persistence classes:
+
+- restart: loading every conversation and all user_data, as Application.initialize does
+- update runs: one persistence run the way Application.update_persistence
+  makes it, with `--active` users who sent an update (their user_data passed
+  in unchanged) of which `--changed` moved their conversation along
+
+PicklePersistence rewrites its whole file for every changed entry; the
+database keeps one row per entry and writes a run's changes in one batch.
+
+Usage: python -m benchmarks.persistence [--users N] [--runs N] [--active N] [--changed N]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from datetime import datetime
+
+from benchmarks._common import use_temp_database, summarize_ms
+
+DB_FILE = use_temp_database("persistence")
+
+from telegram.ext import PersistenceInput, PicklePersistence  # noqa: E402
+
+import shekkle_bot.database as db  # noqa: E402
+from shekkle_bot.persistence import DatabasePersistence  # noqa: E402
+
+NAME = "createbet"
+
+
+def user_data(uid):
+    return {'description': f"Will thing #{uid} happen?", 'deadline': datetime(2099, 1, 1, 12, 0)}
+
+
+async def fill(persistence, users):
+    await asyncio.gather(*(coro for uid in range(1, users + 1) for coro in (
+        persistence.update_conversation(NAME, (uid, uid), 2),
+        persistence.update_user_data(uid, user_data(uid)),
+    )))
+    await persistence.flush()
+
+
+async def restart(make):
+    persistence = make()
+    t0 = time.perf_counter()
+    conversations = await persistence.get_conversations(NAME)
+    data = await persistence.get_user_data()
+    return persistence, time.perf_counter() - t0, len(conversations), len(data)
+
+
+async def update_runs(persistence, args, rng):
+    samples = []
+    for _ in range(args.runs):
+        active = rng.sample(range(1, args.users + 1), args.active)
+        changed = active[:args.changed]
+        coroutines = [persistence.update_user_data(uid, dict(user_data(uid), option_a="Yes") if uid in changed
+                                                   else user_data(uid)) for uid in active]
+        coroutines += [persistence.update_conversation(NAME, (uid, uid), 3) for uid in changed]
+        t0 = time.perf_counter()
+        await asyncio.gather(*coroutines)
+        samples.append(time.perf_counter() - t0)
+        # Put them back so the next run changes them again
+        await asyncio.gather(*(persistence.update_user_data(uid, user_data(uid)) for uid in changed))
+    return samples
+
+
+async def measure(make, args, make_filler=None):
+    await fill((make_filler or make)(), args.users)
+    persistence, load_s, conversations, data = await restart(make)
+    samples = await update_runs(persistence, args, random.Random(5))
+    await persistence.flush()
+    result = {'restart_ms': round(load_s * 1000, 1), 'conversations': conversations, 'user_data': data}
+    result['update_run'] = summarize_ms(samples)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50000, help="users with a conversation in progress")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--active", type=int, default=200, help="users who sent an update since the last run")
+    parser.add_argument("--changed", type=int, default=20, help="of those, users whose state changed")
+    args = parser.parse_args()
+
+    db.init_db()
+    pickle_file = os.path.join(os.path.dirname(DB_FILE), "persistence.pickle")
+    store = PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False)
+    results = {
+        # Filled with on_flush=True, which writes the file once instead of once per entry
+        'pickle': asyncio.run(measure(lambda: PicklePersistence(pickle_file, store_data=store), args,
+                                      lambda: PicklePersistence(pickle_file, store_data=store, on_flush=True))),
+        'database': asyncio.run(measure(DatabasePersistence, args)),
+    }
+    print(json.dumps({'users': args.users, 'active': args.active, 'changed': args.changed, **results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Time to resolve one large bet: per-wager ORM settlement vs set-based SQL.
+
+Seeds a bet with N wagers from a pool of users, then resolves an identical
+copy of it twice: once with the previous ORM implementation (one object per
+wager, a lazy-loaded User per payout, one UPDATE per row) and once with
+``db.resolve_bet``. Both runs use a cutoff that refunds the latest tenth of
+the wagers. Reports wall time and checks that both leave the same balances.
+
+Usage: python -m benchmarks.settlement [--wagers N] [--users N]
+"""
+import argparse
+import json
+import random
+import time
+
+from benchmarks._common import use_temp_database, CHAT_ID
+
+use_temp_database("settlement")
+
+import shekkle_bot.database as db  # noqa: E402
+from shekkle_bot.models import User, Bet, Wager  # noqa: E402
+from shekkle_bot.timestamps import now, to_epoch  # noqa: E402
+
+PLACED_FROM = to_epoch("2030-01-01T00:00:00")
+
+
+def legacy_resolve_bet(bet_id, outcome, cutoff_val):
+    """resolve_bet as it was before set-based settlement (stats and pools left out)."""
+    with db.get_db() as session:
+        bet = session.query(Bet).with_for_update().filter(Bet.id == bet_id).first()
+        wagers = session.query(Wager).filter(Wager.bet_id == bet_id).all()
+        bettor_ids = sorted({w.user_id for w in wagers})
+        session.query(User).with_for_update().filter(User.user_id.in_(bettor_ids)).order_by(User.user_id).all()
+
+        valid_wagers = []
+        for w in wagers:
+            if w.refunded:
+                continue
+            if cutoff_val is not None and w.placed_at > cutoff_val:
+                w.user.balance += w.amount
+                w.refunded = 1
+            else:
+                valid_wagers.append(w)
+
+        total_pool = sum(w.amount for w in valid_wagers)
+        winning_wagers = [w for w in valid_wagers if w.choice == outcome]
+        ratio = total_pool / sum(w.amount for w in winning_wagers)
+        bet.status = 'RESOLVED'
+        bet.outcome = outcome
+        bet.resolved_at = now()
+        for w in winning_wagers:
+            payout = int(w.amount * ratio)
+            w.user.balance += payout
+            w.payout = payout
+        for w in valid_wagers:
+            if w.choice != outcome:
+                w.payout = 0
+        session.commit()
+
+
+def seed(wagers, users):
+    db.init_db()
+    rng = random.Random(11)
+    bet_ids = [db.create_bet(CHAT_ID, 1, "Big bet", "2099-01-01T00:00:00", "Yes", "No") for _ in range(2)]
+    with db.get_db(chat_id=CHAT_ID) as session:
+        session.bulk_insert_mappings(User, [
+            {'chat_id': CHAT_ID, 'user_id': uid, 'username': f"user{uid}", 'balance': 0} for uid in range(1, users + 1)
+        ])
+        rows = [(rng.randint(1, users), rng.choice("AB"), rng.randint(1, 100)) for _ in range(wagers)]
+        for bet_id in bet_ids:
+            session.bulk_insert_mappings(Wager, [
+                {'chat_id': CHAT_ID, 'user_id': uid, 'bet_id': bet_id, 'choice': choice, 'amount': amount,
+                 'placed_at': PLACED_FROM + i, 'refunded': 0}
+                for i, (uid, choice, amount) in enumerate(rows)
+            ])
+        session.commit()
+    db.user_cache.clear()
+    cutoff = PLACED_FROM + int(wagers * 0.9)
+    return bet_ids, cutoff
+
+
+def balances():
+    with db.get_db(readonly=True) as session:
+        return dict(session.query(User.user_id, User.balance).all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wagers", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=2000)
+    args = parser.parse_args()
+
+    (legacy_bet, set_based_bet), cutoff = seed(args.wagers, args.users)
+    start = balances()
+
+    t0 = time.perf_counter()
+    legacy_resolve_bet(legacy_bet, 'A', cutoff)
+    legacy_ms = (time.perf_counter() - t0) * 1000
+    after_legacy = balances()
+
+    t0 = time.perf_counter()
+    db.resolve_bet(set_based_bet, 'A', cutoff)
+    set_based_ms = (time.perf_counter() - t0) * 1000
+    after_set_based = balances()
+
+    legacy_delta = {uid: after_legacy[uid] - start[uid] for uid in start}
+    set_based_delta = {uid: after_set_based[uid] - after_legacy[uid] for uid in start}
+    print(json.dumps({
+        'wagers': args.wagers,
+        'legacy_ms': round(legacy_ms, 1),
+        'set_based_ms': round(set_based_ms, 1),
+        'same_balances': legacy_delta == set_based_delta,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
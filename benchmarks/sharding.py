@@ -0,0 +1,144 @@
+"""
+Write throughput of many chats on one database vs sharded across several.
+
+Runs the same workload once per layout, each in a fresh process (DB_SHARDS is
+read when shekkle_bot.config is imported): `--chats` group economies with
+their own users and open bets, and writer threads that each pick a random
+chat and place a wager or adjust a balance there, while reader threads page
+through the chat's bets and read its leaderboard. With one database every
+write waits for the same writer lock; with `--shards` SQLite files the chats
+are spread across them and only chats on the same file wait for each other.
+
+Reports operations per second and latency percentiles per layout, how many
+chats each database got, and checks that every database's balances still
+match its ledger and holds only the chats routed to it. Exits non-zero
+otherwise.
+
+Usage: python -m benchmarks.sharding [--chats N] [--shards N] [--writers N] [--readers N] [--duration S]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+LAYOUTS = ("single", "sharded")
+
+
+def run_child(args):
+    from benchmarks._common import use_temp_database, summarize_ms
+    path = use_temp_database(f"sharding_{args.layout}")
+    if args.layout == 'sharded':
+        base = os.path.splitext(path)[0]
+        os.environ["DB_SHARDS"] = ",".join(f"s{i}={base}_s{i}.db" for i in range(1, args.shards))
+    else:
+        os.environ.pop("DB_SHARDS", None)
+
+    from sqlalchemy import func, select
+    from sqlalchemy.exc import OperationalError
+    import shekkle_bot.database as db
+    from shekkle_bot.models import User
+
+    db.init_db()
+    chats = [-1000 - i for i in range(args.chats)]
+    bets = {}
+    for chat in chats:
+        for uid in range(1, args.users + 1):
+            db.add_user(chat, uid, f"user{uid}")
+            db.update_balance(chat, uid, 1_000_000)
+        bets[chat] = [db.create_bet(chat, 1, f"Bet {i}", "2099-01-01T00:00:00", "Yes", "No") for i in range(args.bets)]
+
+    reads = [
+        lambda r, chat: db.get_open_bet_page(chat, r.choice(bets[chat])),
+        lambda r, chat: db.get_top_winners(chat, 10),
+        lambda r, chat: db.get_user(chat, r.randint(1, args.users)),
+    ]
+    writes = [
+        lambda r, chat: db.place_wager(chat, r.randint(1, args.users), r.choice(bets[chat]), r.choice("AB"), 1),
+        lambda r, chat: db.update_balance(chat, r.randint(1, args.users), 1),
+    ]
+
+    stop_at = time.perf_counter() + args.duration
+    samples = {'read': [], 'write': []}
+    errors = {'read': 0, 'write': 0}
+    lock = threading.Lock()
+
+    def worker(kind, ops, seed):
+        rng = random.Random(seed)
+        local, failed = [], 0
+        while time.perf_counter() < stop_at:
+            op, chat = rng.choice(ops), rng.choice(chats)
+            t0 = time.perf_counter()
+            try:
+                op(rng, chat)
+                local.append(time.perf_counter() - t0)
+            except OperationalError:
+                failed += 1
+        with lock:
+            samples[kind].extend(local)
+            errors[kind] += failed
+
+    threads = [threading.Thread(target=worker, args=('read', reads, i)) for i in range(args.readers)]
+    threads += [threading.Thread(target=worker, args=('write', writes, 1000 + i)) for i in range(args.writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    result = {}
+    for kind in ('read', 'write'):
+        result[kind] = summarize_ms(samples[kind])
+        result[kind]['ops_per_sec'] = round(len(samples[kind]) / args.duration, 1)
+        result[kind]['errors'] = errors[kind]
+    result['chats_per_database'] = db.get_shard_loads()
+
+    failures = []
+    for name in db.shards:
+        # The load has stopped, so every entry has committed
+        mismatched = db.reconcile_ledger(shard=name, settle=0)['mismatched']
+        if mismatched:
+            failures.append(f"{name}: {len(mismatched)} balances differ from the ledger")
+        routed = {chat for chat in chats if db.shard_for_chat(chat).name == name}
+        with db.get_db(readonly=True, shard=name) as session:
+            stored = set(session.scalars(select(User.chat_id).group_by(User.chat_id)))
+            users = session.scalar(select(func.count()).select_from(User))
+        if stored != routed or users != len(routed) * args.users:
+            failures.append(f"{name}: holds chats {sorted(stored)}, routed {sorted(routed)}")
+    result['failures'] = failures
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=24)
+    parser.add_argument("--shards", type=int, default=4, help="databases in the sharded layout, the main one included")
+    parser.add_argument("--users", type=int, default=50, help="users per chat")
+    parser.add_argument("--bets", type=int, default=5, help="open bets per chat")
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--layout", choices=LAYOUTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.layout:
+        run_child(args)
+        return
+
+    results = {}
+    for layout in LAYOUTS:
+        cmd = [sys.executable, "-m", "benchmarks.sharding", "--layout", layout,
+               "--chats", str(args.chats), "--shards", str(args.shards), "--users", str(args.users),
+               "--bets", str(args.bets), "--writers", str(args.writers), "--readers", str(args.readers),
+               "--duration", str(args.duration)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results[layout] = json.loads(out.strip().splitlines()[-1])
+    print(json.dumps(results, indent=2))
+    if any(result['failures'] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Mixed read/write throughput for the SQLite storage profiles.
+
+Runs the same workload once per profile, each in a fresh process (the profile
+is fixed when shekkle_bot.database is imported): reader threads call /bets,
+/balance and /leaderboard queries while writer threads place wagers and adjust
+balances. Reports operations per second, latency percentiles and the number of
+"database is locked" failures.
+
+Usage: python -m benchmarks.sqlite_profile [--readers N] [--writers N] [--duration S]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import random
+
+PROFILES = ("default", "tuned")
+
+
+def run_child(args):
+    from benchmarks._common import use_temp_database, summarize_ms, CHAT_ID
+    use_temp_database(f"sqlite_profile_{args.profile}")
+    os.environ["SQLITE_PROFILE"] = args.profile
+
+    from sqlalchemy.exc import OperationalError
+    import shekkle_bot.database as db
+
+    db.init_db()
+    for uid in range(1, args.users + 1):
+        db.add_user(CHAT_ID, uid, f"user{uid}")
+        db.update_balance(CHAT_ID, uid, 1_000_000)
+    bet_ids = [db.create_bet(CHAT_ID, 1, f"Bet {i}", "2099-01-01T00:00:00", "Yes", "No") for i in range(args.bets)]
+
+    reads = [
+        lambda r: db.get_open_bets(CHAT_ID),
+        lambda r: db.get_user(CHAT_ID, r.randint(1, args.users)),
+        lambda r: db.get_top_winners(CHAT_ID, 10),
+        lambda r: db.get_bet_wagers(CHAT_ID, r.choice(bet_ids)),
+    ]
+    writes = [
+        lambda r: db.place_wager(CHAT_ID, r.randint(1, args.users), r.choice(bet_ids), r.choice("AB"), r.randint(1, 50)),
+        lambda r: db.update_balance(CHAT_ID, r.randint(1, args.users), 1),
+    ]
+
+    stop_at = time.perf_counter() + args.duration
+    samples = {'read': [], 'write': []}
+    errors = {'read': 0, 'write': 0}
+    lock = threading.Lock()
+
+    def worker(kind, ops, seed):
+        rng = random.Random(seed)
+        local, failed = [], 0
+        while time.perf_counter() < stop_at:
+            op = rng.choice(ops)
+            t0 = time.perf_counter()
+            try:
+                op(rng)
+                local.append(time.perf_counter() - t0)
+            except OperationalError:
+                failed += 1
+        with lock:
+            samples[kind].extend(local)
+            errors[kind] += failed
+
+    threads = [threading.Thread(target=worker, args=('read', reads, i)) for i in range(args.readers)]
+    threads += [threading.Thread(target=worker, args=('write', writes, 1000 + i)) for i in range(args.writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    result = {}
+    for kind in ('read', 'write'):
+        result[kind] = summarize_ms(samples[kind])
+        result[kind]['ops_per_sec'] = round(len(samples[kind]) / args.duration, 1)
+        result[kind]['errors'] = errors[kind]
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--bets", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--profile", choices=PROFILES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.profile:
+        run_child(args)
+        return
+
+    results = {}
+    for profile in PROFILES:
+        cmd = [sys.executable, "-m", "benchmarks.sqlite_profile", "--profile", profile,
+               "--readers", str(args.readers), "--writers", str(args.writers),
+               "--users", str(args.users), "--bets", str(args.bets), "--duration", str(args.duration)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        results[profile] = json.loads(out.strip().splitlines()[-1])
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
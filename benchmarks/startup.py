@@ -0,0 +1,117 @@
+"""
+Cold start: time from launching the bot to answering its first update.
+
+Runs the real bot (``python -m shekkle_bot.main``) against the fake Bot API
+with a /start already waiting in getUpdates, as after a systemd restart, and
+measures for every boot, from the moment the process is spawned:
+
+- first_api_call_s: imports, database setup and building the application,
+  up to the bot's first Bot API call (getMe)
+- polling_s: until the first getUpdates
+- first_reply_s: until the reply to the waiting /start is sent
+
+together with the setMyCommands calls the boot made. All boots use the same
+database: the first is a fresh install, the others are ordinary restarts.
+`--latency` models the round trip to Telegram (a Raspberry Pi at home is
+typically 50-150 ms away).
+
+Usage: python -m benchmarks.startup [--boots N] [--admins N] [--latency S]
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks._common import use_temp_database
+
+DB_FILE = use_temp_database("startup")
+
+from benchmarks.fake_bot_api import FakeBotAPI  # noqa: E402
+
+CHAT_ID = 4242
+BOOT_TIMEOUT = 60
+
+
+class BootObserver:
+    """Timestamps the Bot API calls one boot makes."""
+
+    def __init__(self):
+        self.first = {}
+        self.set_my_commands = 0
+        self.replied = threading.Event()
+
+    def on_call(self, method, params):
+        self.first.setdefault(method, time.perf_counter())
+        if method == 'setMyCommands':
+            self.set_my_commands += 1
+        if method == 'sendMessage' and int(params.get('chat_id', 0)) == CHAT_ID:
+            self.replied.set()
+
+
+def start_update():
+    return {'message': {
+        'message_id': 1, 'date': int(time.time()), 'chat': {'id': CHAT_ID, 'type': 'private'},
+        'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': "Restart"}, 'text': "/start",
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    }}
+
+
+def boot(api, env, log_path):
+    observer = BootObserver()
+    api.on_call = observer.on_call
+    api.polling.clear()
+    api.push_update(start_update())
+
+    with open(log_path, "a") as log:
+        t0 = time.perf_counter()
+        bot = subprocess.Popen([sys.executable, "-m", "shekkle_bot.main"], env=env,
+                               stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not api.polling.wait(BOOT_TIMEOUT):
+            raise SystemExit(f"The bot did not start polling; see {log_path}")
+        polling = time.perf_counter()
+        if not observer.replied.wait(BOOT_TIMEOUT):
+            raise SystemExit(f"The bot did not answer /start; see {log_path}")
+        replied = time.perf_counter()
+        # Let background startup work (command registration) finish before stopping
+        time.sleep(max(api.latency * 4, 0.2))
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+    return {
+        'first_api_call_s': round(observer.first['getMe'] - t0, 3),
+        'polling_s': round(polling - t0, 3),
+        'first_reply_s': round(replied - t0, 3),
+        'set_my_commands_calls': observer.set_my_commands,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boots", type=int, default=4, help="boots against the same database")
+    parser.add_argument("--admins", type=int, default=3, help="ADMIN_IDS, each with its own command menu")
+    parser.add_argument("--latency", type=float, default=0.1, help="simulated Bot API round trip in seconds")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency)
+    base_url = api.start()
+    env = dict(os.environ, TOKEN="123456:STARTUP", BOT_API_URL=base_url, DB_PATH=DB_FILE, METRICS_PORT="0",
+               RUN_MODE="polling", ADMIN_IDS=",".join(str(100 + i) for i in range(args.admins)))
+    env.pop("DATABASE_URL", None)
+    log_path = os.path.join(os.path.dirname(DB_FILE), "bot.log")
+    try:
+        boots = [boot(api, env, log_path) for _ in range(args.boots)]
+    finally:
+        api.stop()
+    print(json.dumps({'latency_s': args.latency, 'admins': args.admins, 'boots': boots}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Wagers per second: the previous wager path vs the single-transaction one.
+
+The previous path is what a "Bet 50 on A" tap used to do: look the user up,
+register them if missing, then run the ORM place_wager that loads the Bet and
+User rows into objects and checks the balance in Python before writing it.
+It is rebuilt here with today's side effects (chat scoping, the ledger entry,
+pool aggregates and the user cache), so both paths do the same work. The
+atomic path is today's ``db.place_wager(..., register=True)``. Both run from a
+pool of threads like the bot's DB executor, with a mix of new and returning
+users spread over a few open bets. After each run the totals are checked:
+every debited shekkle must be in a wager and in the bet pools, and the ledger
+must add up to the balances.
+
+Usage: python -m benchmarks.wager_throughput [--wagers N] [--threads N] [--users N] [--bets N]
+"""
+import argparse
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks._common import use_temp_database, CHAT_ID
+
+use_temp_database("wager_throughput")
+
+from sqlalchemy import func  # noqa: E402
+
+import shekkle_bot.database as db  # noqa: E402
+from shekkle_bot.config import INITIAL_BALANCE  # noqa: E402
+from shekkle_bot.cache import CachedUser  # noqa: E402
+from shekkle_bot.models import User, Bet, Wager, BetPool, BetPoolEntry, LedgerEntry  # noqa: E402
+from shekkle_bot.timestamps import now  # noqa: E402
+
+AMOUNT = 5
+
+
+def legacy_place_wager(chat_id, user_id, bet_id, choice, amount):
+    """place_wager as it was before the single-transaction path: read, check in Python, write."""
+    with db.get_db(chat_id=chat_id) as session:
+        bet = session.query(Bet).with_for_update().filter(Bet.id == bet_id, Bet.chat_id == chat_id).first()
+        if not bet:
+            return False, "Bet not found."
+        if bet.status != 'OPEN':
+            return False, "Bet is not open."
+        placed_at = now()
+        if placed_at > bet.deadline:
+            return False, "Deadline has passed."
+        user = (session.query(User).with_for_update()
+                .filter(User.chat_id == chat_id, User.user_id == user_id).first())
+        if not user or user.balance < amount:
+            return False, "Insufficient funds."
+        user.balance -= amount
+        wager = Wager(chat_id=chat_id, user_id=user_id, bet_id=bet_id, choice=choice, amount=amount,
+                      placed_at=placed_at)
+        session.add(wager)
+        session.flush()
+        db._record(session, chat_id, user_id, -amount, 'wager', wager.id, created_at=placed_at)
+        db._add_to_pool(session, bet_id, user_id, choice, amount)
+        session.commit()
+        db._cache_users(session, [CachedUser(chat_id, user_id, user.username, user.balance, user.last_daily)])
+        return True, "Wager placed successfully."
+
+
+def legacy_tap(user_id, bet_id, choice):
+    if not db.get_user(CHAT_ID, user_id):
+        db.add_user(CHAT_ID, user_id, f"user{user_id}")
+    return legacy_place_wager(CHAT_ID, user_id, bet_id, choice, AMOUNT)
+
+
+def atomic_tap(user_id, bet_id, choice):
+    return db.place_wager(CHAT_ID, user_id, bet_id, choice, AMOUNT, register=True, username=f"user{user_id}")
+
+
+def reset(bets):
+    with db.get_db() as session:
+        for model in (LedgerEntry, Wager, BetPoolEntry, BetPool, User, Bet):
+            session.query(model).delete()
+        session.commit()
+    db.user_cache.clear()
+    return [db.create_bet(CHAT_ID, 1, f"Bet {i}", "2099-01-01T00:00:00", "Yes", "No") for i in range(bets)]
+
+
+def check_totals():
+    with db.get_db(readonly=True) as session:
+        users = session.query(func.count(User.user_id)).scalar()
+        balances = session.query(func.coalesce(func.sum(User.balance), 0)).scalar()
+        wagered = session.query(func.coalesce(func.sum(Wager.amount), 0)).scalar()
+        pooled = session.query(func.coalesce(func.sum(BetPool.amount_a + BetPool.amount_b), 0)).scalar()
+        ledger = session.query(func.coalesce(func.sum(LedgerEntry.amount), 0)).scalar()
+    return balances + wagered == users * INITIAL_BALANCE and pooled == wagered and ledger == balances
+
+
+def run(tap, args):
+    bet_ids = reset(args.bets)
+    rng = random.Random(7)
+    taps = [(rng.randint(1, args.users), rng.choice(bet_ids), rng.choice("AB")) for _ in range(args.wagers)]
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(lambda t: tap(*t), taps))
+    elapsed = time.perf_counter() - t0
+    placed = sum(1 for ok, _ in results if ok)
+    return {
+        'wagers_per_sec': round(len(taps) / elapsed, 1),
+        'placed': placed,
+        'rejected': len(taps) - placed,
+        'totals_consistent': check_totals(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wagers", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--bets", type=int, default=5)
+    args = parser.parse_args()
+
+    db.init_db()
+    results = {'legacy': run(legacy_tap, args), 'atomic': run(atomic_tap, args)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
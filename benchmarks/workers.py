@@ -0,0 +1,273 @@
+"""
+Several bot workers on one database: throughput scaling, leader failover and
+exactly-once background jobs.
+
+Scaling runs benchmarks.load_generator in webhook mode once per worker count
+in `--workers` and reports requests per second against one worker. By default
+each worker handles one update at a time (`--concurrent-updates 1`) against a
+Bot API with a 50 ms round trip, so a worker's throughput is bound by its own
+waiting rather than by the CPU and the scaling shows on any machine; raise
+`--concurrent-updates` on a host with a core per worker to measure CPU-bound
+scaling instead.
+
+Failover starts three workers with MULTI_WORKER and two admins, then:
+
+  - walks one /createbet conversation across all three workers, one step per
+    worker, and checks the bet it creates;
+  - adds bets with deadlines a few seconds out behind the workers' backs and
+    waits for the leader to lock them (it picks them up on its deadline rescan);
+  - SIGKILLs the leader and times until another worker holds the lease;
+  - adds more expiring bets and waits for the new leader to lock them;
+  - stops the new leader with SIGINT and times the handover, which it
+    releases the lease for.
+
+Every expired bet must produce exactly one "Bet Expired" message per admin
+and the command menus must be registered once. Exits non-zero otherwise.
+tests/test_leader.py checks the same takeover and handover, and that only the
+leader runs jobs, with elections on one event loop.
+
+Usage: python -m benchmarks.workers [--workers 1,2,4] [--requests N] [--latency S]
+       [--concurrent-updates N] [--lease-seconds S] [--skip-scaling] [--skip-failover]
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from benchmarks._common import use_temp_database
+
+DB_FILE = use_temp_database("workers")
+
+import shekkle_bot.database as db  # noqa: E402
+from benchmarks.fake_bot_api import FakeBotAPI  # noqa: E402
+from benchmarks.load_generator import _free_port  # noqa: E402
+from shekkle_bot.leader import LEASE_NAME  # noqa: E402
+from shekkle_bot.timestamps import now  # noqa: E402
+
+ADMINS = (900, 901)
+FAILOVER_WORKERS = 3
+WEBHOOK_SECRET = "workers-secret"
+CHAT_ID = -100500
+USER_ID = 4242
+
+
+def run_scaling(args):
+    results = {}
+    for workers in args.workers:
+        cmd = [sys.executable, "-m", "benchmarks.load_generator", "--mode", "webhook", "--workers", str(workers),
+               "--users", str(args.users), "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+               "--latency", str(args.latency), "--concurrent-updates", str(args.concurrent_updates)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        total = json.loads(out)['total']
+        results[workers] = {'per_sec': total['per_sec'], 'p50_ms': total['p50_ms'],
+                            'p99_ms': total['p99_ms'], 'timeouts': total['timeouts']}
+    base = results[args.workers[0]]['per_sec']
+    for result in results.values():
+        result['speedup'] = round(result['per_sec'] / base, 2) if base else None
+    return results
+
+
+class Cluster:
+    """Bot workers with MULTI_WORKER on DB_FILE, all talking to one fake Bot API."""
+
+    def __init__(self, count, lease_seconds):
+        self.api = FakeBotAPI()
+        self.count = count
+        self.lease_seconds = lease_seconds
+        self.workers = {}           # worker id -> (Popen, webhook url)
+        self.log_dir = os.path.dirname(DB_FILE)
+
+    def start(self):
+        base_url = self.api.start()
+        for i in range(self.count):
+            worker_id, port = f"worker{i}", _free_port()
+            url = f"http://127.0.0.1:{port}/telegram"
+            env = dict(os.environ, TOKEN="123456:WORKERS", BOT_API_URL=base_url, DB_PATH=DB_FILE,
+                       ADMIN_IDS=",".join(map(str, ADMINS)), METRICS_PORT="0", RUN_MODE="webhook",
+                       WEBHOOK_URL=url, WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(port),
+                       WEBHOOK_SECRET=WEBHOOK_SECRET, MULTI_WORKER="1", WORKER_ID=worker_id,
+                       LEADER_LEASE_SECONDS=str(self.lease_seconds))
+            env.pop("DATABASE_URL", None)
+            with open(os.path.join(self.log_dir, f"{worker_id}.log"), "w") as log:
+                process = subprocess.Popen([sys.executable, "-m", "shekkle_bot.main"], env=env,
+                                           stdout=log, stderr=subprocess.STDOUT)
+            self.workers[worker_id] = (process, url)
+        wait_for(lambda: len(self.api.calls_to('setWebhook')) >= self.count, 60, "all workers to set their webhook")
+        return self.wait_for_leader()
+
+    def stop(self):
+        for process, _ in self.workers.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process, _ in self.workers.values():
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.api.stop()
+
+    def alive(self):
+        return [worker_id for worker_id, (process, _) in self.workers.items() if process.poll() is None]
+
+    def wait_for_leader(self, other_than=None, timeout=60):
+        """The live worker holding an unexpired lease, once there is one (that isn't `other_than`)."""
+        def leader():
+            lease = db.get_lease(LEASE_NAME)
+            if lease and lease['expires_at'] > now() and lease['holder'] != other_than \
+                    and lease['holder'] in self.alive():
+                return lease['holder']
+        return wait_for(leader, timeout, "a leader")
+
+    def post(self, worker_id, update_id, text):
+        """Posts a message from USER_ID in CHAT_ID to one worker and waits for its reply."""
+        replies = len(self.api.calls_to('sendMessage'))
+        command = text.split()[0] if text.startswith("/") else None
+        message = {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': CHAT_ID, 'type': 'group', 'title': "Workers"},
+            'from': {'id': USER_ID, 'is_bot': False, 'first_name': "Tester", 'username': "tester"},
+        }
+        if command:
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        request = urllib.request.Request(self.workers[worker_id][1], headers={
+            'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET,
+        }, data=json.dumps({'update_id': update_id, 'message': message}).encode())
+        with urllib.request.urlopen(request, timeout=30):
+            pass
+        wait_for(lambda: len(self.api.calls_to('sendMessage')) > replies, 30, f"a reply to {text!r}")
+        return self.api.calls_to('sendMessage')[-1][2]['text']
+
+
+def wait_for(predicate, timeout, what):
+    deadline = time.monotonic() + timeout
+    while True:
+        result = predicate()
+        if result:
+            return result
+        if time.monotonic() > deadline:
+            raise SystemExit(f"Timed out waiting for {what}; see the worker logs in {os.path.dirname(DB_FILE)}")
+        time.sleep(0.05)
+
+
+def expiring_bets(count, seconds):
+    """Bets whose deadline is `seconds` away, created without any worker knowing."""
+    return [db.create_bet(CHAT_ID, USER_ID, f"Expiring bet {i}", now() + seconds, "Yes", "No") for i in range(count)]
+
+
+def wait_until_locked(bet_ids, timeout):
+    def locked():
+        bets = [db.get_bet(CHAT_ID, bet_id) for bet_id in bet_ids]
+        return all(bet['status'] == 'LOCKED' for bet in bets)
+    wait_for(locked, timeout, "expired bets to be locked")
+
+
+def expiry_notices(api):
+    """{bet_id: number of "Bet Expired" messages} sent so far."""
+    counts = {}
+    for _, _, params in api.calls_to('sendMessage'):
+        text = params.get('text', "")
+        if "Bet Expired" in text:
+            bet_id = int(text.split("<code>")[1].split("</code>")[0])
+            counts[bet_id] = counts.get(bet_id, 0) + 1
+    return counts
+
+
+def run_failover(args):
+    from shekkle_bot.config import DEADLINE_RESCAN_INTERVAL
+
+    db.init_db()
+    db.add_user(CHAT_ID, USER_ID, "tester")
+    cluster = Cluster(FAILOVER_WORKERS, args.lease_seconds)
+    failures = []
+    result = {'workers': FAILOVER_WORKERS, 'lease_seconds': args.lease_seconds}
+    expiring = []
+    # Leader lock, rescan and outbox poll, with room to spare
+    settle = args.lease_seconds + DEADLINE_RESCAN_INTERVAL + 10
+    try:
+        leader = cluster.start()
+        result['first_leader'] = leader
+
+        # One conversation, each step on the next worker
+        steps = ["/createbet", "Will it scale?", "2099-01-01 12:00", "Yes", "No"]
+        worker_ids = list(cluster.workers)
+        for i, text in enumerate(steps):
+            reply = cluster.post(worker_ids[i % len(worker_ids)], i + 1, text)
+        created = [bet for bet in db.get_open_bets(CHAT_ID) if bet['description'] == "Will it scale?"]
+        if len(created) != 1:
+            failures.append(f"/createbet across workers created {len(created)} bets; last reply: {reply!r}")
+        result['conversation_across_workers'] = len(created) == 1
+
+        expiring += expiring_bets(args.bets, 3)
+        wait_until_locked(expiring, settle)
+        wait_for(lambda: sum(expiry_notices(cluster.api).values()) >= len(expiring) * len(ADMINS), settle,
+                 "the expiry notices")
+
+        # The leader dies without a word
+        killed_at = time.monotonic()
+        cluster.workers[leader][0].kill()
+        leader = cluster.wait_for_leader(other_than=leader, timeout=args.lease_seconds * 3)
+        result['failover_after_kill_s'] = round(time.monotonic() - killed_at, 2)
+
+        more = expiring_bets(args.bets, 3)
+        expiring += more
+        wait_until_locked(more, settle)
+        wait_for(lambda: sum(expiry_notices(cluster.api).values()) >= len(expiring) * len(ADMINS), settle,
+                 "the expiry notices after failover")
+
+        # The next leader shuts down cleanly and hands over
+        stopped_at = time.monotonic()
+        cluster.workers[leader][0].send_signal(signal.SIGINT)
+        leader = cluster.wait_for_leader(other_than=leader, timeout=args.lease_seconds * 3)
+        result['handover_after_shutdown_s'] = round(time.monotonic() - stopped_at, 2)
+        result['last_leader'] = leader
+
+        # Give any duplicate a chance to show up
+        time.sleep(2)
+    finally:
+        cluster.stop()
+
+    notices = expiry_notices(cluster.api)
+    wrong = {bet_id: notices.get(bet_id, 0) for bet_id in expiring if notices.get(bet_id, 0) != len(ADMINS)}
+    if wrong:
+        failures.append(f"bets without exactly {len(ADMINS)} expiry notices: {wrong}")
+    result['expired_bets'] = len(expiring)
+    result['expiry_notices'] = sum(notices.values())
+    registrations = len(cluster.api.calls_to('setMyCommands'))
+    # One per scope: everyone plus each admin
+    if registrations != 1 + len(ADMINS):
+        failures.append(f"command menus were registered {registrations} times")
+    result['failures'] = failures
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts to compare")
+    parser.add_argument("--users", type=int, default=400)
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--concurrency", type=int, default=40, help="requests in flight at once")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated Bot API round trip in seconds")
+    parser.add_argument("--concurrent-updates", type=int, default=1, help="CONCURRENT_UPDATES of each worker")
+    parser.add_argument("--bets", type=int, default=5, help="expiring bets per leader in the failover test")
+    parser.add_argument("--lease-seconds", type=int, default=5, help="LEADER_LEASE_SECONDS in the failover test")
+    parser.add_argument("--skip-scaling", action="store_true")
+    parser.add_argument("--skip-failover", action="store_true")
+    args = parser.parse_args()
+    args.workers = [int(n) for n in args.workers.split(",")]
+
+    results = {}
+    if not args.skip_scaling:
+        results['scaling'] = run_scaling(args)
+    if not args.skip_failover:
+        results['failover'] = run_failover(args)
+    print(json.dumps(results, indent=2))
+    if results.get('failover', {}).get('failures'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
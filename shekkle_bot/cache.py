@@ -0,0 +1,109 @@
+"""
+In-process cache of user rows.
+
+/balance, /start, /daily and the wager flow all look up the caller's user row,
+so the database layer keeps the hottest rows here, keyed by (chat_id, user_id)
+and bounded with LRU eviction. Writers update entries after they commit
+(write-through). Every write is stamped from a global counter, and a
+read-through fill is dropped if its user was written after the read began, so
+a slow reader can never put a stale balance back after a writer updated it.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+# Immutable snapshot of a user row, safe to hand out to any thread
+CachedUser = namedtuple('CachedUser', ['chat_id', 'user_id', 'username', 'balance', 'last_daily'])
+
+def _key(entry):
+    return entry.chat_id, entry.user_id
+
+class UserCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        # Write counter, and the counter value of each user's last write. Users
+        # dropped from _written were last written at or before _pruned_at.
+        self._clock = 0
+        self._written = {}
+        self._pruned_at = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, chat_id, user_id):
+        """Returns the cached CachedUser or None, counting a hit or a miss."""
+        with self._lock:
+            entry = self._entries.get((chat_id, user_id))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((chat_id, user_id))
+            self.hits += 1
+            return entry
+
+    def generation(self):
+        """Token to pass to fill() for a read-through that is about to query the database."""
+        with self._lock:
+            return self._clock
+
+    def fill(self, entry, generation):
+        """Caches a row read from the database unless it was written since `generation`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._written.get(_key(entry), self._pruned_at) > generation:
+                return
+            self._store(entry)
+
+    def put(self, entry):
+        """Write-through: caches the committed row."""
+        with self._lock:
+            self._mark_written(_key(entry))
+            if self.enabled:
+                self._store(entry)
+
+    def invalidate(self, chat_id, user_id):
+        """Drops a row whose new value the caller does not know."""
+        with self._lock:
+            self._mark_written((chat_id, user_id))
+            self._entries.pop((chat_id, user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._clock += 1
+            self._pruned_at = self._clock
+            self._written.clear()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _store(self, entry):
+        self._entries[_key(entry)] = entry
+        self._entries.move_to_end(_key(entry))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _mark_written(self, key):
+        self._clock += 1
+        self._written[key] = self._clock
+        if len(self._written) > 2 * max(self.max_size, 1000):
+            # Forget old write stamps; fills that began before now are rejected
+            # for every forgotten user, which only costs a cache miss.
+            self._pruned_at = self._clock
+            self._written.clear()
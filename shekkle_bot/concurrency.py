@@ -0,0 +1,116 @@
+"""
+Concurrency helpers for processing updates in parallel.
+
+With concurrent updates enabled, python-telegram-bot runs every update as its
+own task. The createbet conversation relies on one user's messages being seen
+in the order they were sent, so updates are ordered per (chat, user) - the
+same key the ConversationHandler tracks state by - while different users'
+updates run side by side.
+
+Handlers that change balances additionally hold keyed locks on the users and
+bets they touch (``locks.hold(user_key(uid), bet_key(bet_id))``), so
+operations on the same user or bet serialize across chats while unrelated
+ones proceed in parallel.
+"""
+import asyncio
+import contextlib
+
+from telegram.ext import BaseUpdateProcessor
+
+# Updates admitted past PTB's own semaphore. They queue on their (chat, user)
+# key first and only then take one of the `max_concurrent` slots, so a user
+# with a backlog of updates cannot occupy the slots everyone else needs.
+ADMITTED_UPDATES = 1024
+
+def update_key(update):
+    """(chat_id, user_id) of an update, or None for updates without either."""
+    chat = getattr(update, 'effective_chat', None)
+    user = getattr(update, 'effective_user', None)
+    if chat is None and user is None:
+        return None
+    return (chat.id if chat else None, user.id if user else None)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes up to `max_concurrent` updates at once, but updates with the same
+    (chat, user) key one at a time and in arrival order.
+    """
+    def __init__(self, max_concurrent):
+        super().__init__(max(ADMITTED_UPDATES, max_concurrent))
+        self._slots = asyncio.BoundedSemaphore(max_concurrent)
+        self._queues = {}   # key -> [asyncio.Lock, updates waiting or running]
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._queues.get(key)
+        if entry is None:
+            entry = self._queues[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters in FIFO order
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._queues[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def user_key(user_id):
+    return ('user', user_id)
+
+def bet_key(bet_id):
+    return ('bet', bet_id)
+
+class KeyedLocks:
+    """
+    asyncio locks created on demand per key and dropped again as soon as no
+    task holds or waits for them, so idle users and bets cost nothing.
+    """
+    def __init__(self):
+        self._locks = {}    # key -> [asyncio.Lock, tasks holding or waiting]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def _release(self, key, entry, acquired):
+        if acquired:
+            entry[0].release()
+        entry[1] -= 1
+        if not entry[1]:
+            del self._locks[key]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        """
+        Holds the locks for all `keys` for the duration of the block. They are
+        taken in sorted order, so tasks locking overlapping sets cannot deadlock.
+        """
+        held = []
+        try:
+            for key in sorted(set(keys)):
+                entry = self._locks.get(key)
+                if entry is None:
+                    entry = self._locks[key] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                try:
+                    await entry[0].acquire()
+                except BaseException:
+                    self._release(key, entry, acquired=False)
+                    raise
+                held.append((key, entry))
+            yield
+        finally:
+            for key, entry in reversed(held):
+                self._release(key, entry, acquired=True)
+
+locks = KeyedLocks()
@@ -1,165 +1,601 @@
+import asyncio
+import collections
+import contextvars
+import functools
 import logging
-from datetime import datetime, timedelta
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, scoped_session
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, event, select, insert, update, delete, func, case, cast, and_, or_, tuple_, bindparam, literal, union_all, text, Integer, BigInteger, Float, String
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import aliased, sessionmaker, scoped_session
+import contextlib
 from contextlib import contextmanager
 
-from shekkle_bot.config import DB_PATH
-from shekkle_bot.models import Base, User, Bet, Wager
+from shekkle_bot.config import (
+    DATABASE_URL, DB_SHARDS, DB_WORKERS, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+    SQLITE_PROFILE, INITIAL_BALANCE, USER_CACHE_SIZE, LEDGER_CHECKPOINT_EVERY, RECONCILE_BATCH,
+    LEDGER_SETTLE_SECONDS, ARCHIVE_BATCH, ARCHIVE_VACUUM_PAGES, MULTI_WORKER,
+)
+from shekkle_bot import metrics, migrations, timestamps
+from shekkle_bot.cache import CachedUser, UserCache
+from shekkle_bot.models import (
+    User, Bet, Wager, UserStats, BetPool, BetPoolEntry, OutboxMessage, ConversationState, UserData,
+    LedgerEntry, BalanceCheckpoint, JobCursor, BotSetting, ArchivedBet, ArchivedWager, ChatShard, BetRoute, Lease,
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # SQLAlchemy setup
-# Use absolute path for sqlite
-engine = create_engine(f"sqlite:///{DB_PATH}", connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-ScopedSession = scoped_session(SessionLocal)
 
-def init_db():
-    """Initializes the database tables."""
-    Base.metadata.create_all(bind=engine)
-    try:
-        with engine.begin() as conn:
-            conn.execute(text("ALTER TABLE wagers ADD COLUMN payout INTEGER;"))
-    except Exception:
-        pass
-    logger.info(f"Database initialized at {DB_PATH}")
+# Pragmas applied to every connection in the "tuned" SQLite storage profile
+SQLITE_PRAGMAS = {
+    'auto_vacuum': 'INCREMENTAL', # new files only: lets reclaim_space() shrink them after archiving
+    'journal_mode': 'WAL',       # readers and the writer no longer block each other
+    'synchronous': 'NORMAL',     # fsync at checkpoints only; still crash-safe in WAL mode
+    'busy_timeout': 5000,        # wait up to 5s for another process's lock
+    'cache_size': -16000,        # 16 MB page cache per connection
+    'mmap_size': 67108864,       # 64 MB memory-mapped reads
+    'temp_store': 'MEMORY',
+}
 
-@contextmanager
-def get_db():
-    """Context manager for database sessions."""
-    db = ScopedSession()
+class _FairLock:
+    """
+    FIFO lock. threading.Lock gives no ordering guarantee, and with a single
+    writer connection a busy thread can re-acquire it indefinitely while
+    others starve; this hands the lock to waiters in arrival order.
+    """
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._waiters = collections.deque()
+        self._locked = False
+
+    def __enter__(self):
+        with self._mutex:
+            if not self._locked:
+                self._locked = True
+                return self
+            turn = threading.Event()
+            self._waiters.append(turn)
+        turn.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._mutex:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._locked = False
+
+def _create_sqlite_engine(url, writer):
+    """
+    Tuned SQLite engine. The writer engine holds exactly one connection, so
+    in-process writes queue on the pool instead of failing with "database is
+    locked", and starts every transaction with BEGIN IMMEDIATE so it never has
+    to upgrade a read lock. Readers get a pool of their own.
+    """
+    if writer:
+        pool_args = {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 30}
+    else:
+        pool_args = {'pool_size': DB_WORKERS, 'max_overflow': DB_WORKERS}
+    sqlite_engine = create_engine(url, connect_args={"check_same_thread": False}, **pool_args)
+
+    @event.listens_for(sqlite_engine, "connect")
+    def _apply_pragmas(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+        if writer:
+            # Let SQLAlchemy's "begin" event issue BEGIN instead of pysqlite
+            dbapi_conn.isolation_level = None
+
+    if writer:
+        @event.listens_for(sqlite_engine, "begin")
+        def _begin_immediate(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return sqlite_engine
+
+def _create_engines(url):
+    """
+    Creates (write_engine, read_engine) for DATABASE_URL. They are the same
+    engine except for SQLite with the "tuned" storage profile.
+    """
+    if make_url(url).get_backend_name() == 'sqlite':
+        if SQLITE_PROFILE == 'tuned':
+            return _create_sqlite_engine(url, writer=True), _create_sqlite_engine(url, writer=False)
+        sqlite_engine = create_engine(url, connect_args={"check_same_thread": False})
+        return sqlite_engine, sqlite_engine
+    # Server backends (PostgreSQL) get a bounded pool sized for the DB thread pool,
+    # with pre-ping so connections dropped by the server are replaced transparently.
+    server_engine = create_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+    return server_engine, server_engine
+
+class Shard:
+    """
+    One database holding the economies of some chats: its engines, thread-local
+    sessions and, on SQLite, the turn its writers take.
+    """
+    def __init__(self, name, url):
+        self.name = name
+        self.engine, self.read_engine = _create_engines(url)
+        self.Session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=self.engine))
+        self.ReadSession = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=self.read_engine))
+        # SQLite allows one writer at a time. Write sessions take turns in-process
+        # (on the single writer connection with the tuned profile), so parallel
+        # updates queue here instead of failing with "database is locked" or
+        # deadlocking when two deferred transactions both try to upgrade their
+        # read locks. Each shard is a file of its own with a turn of its own.
+        self.writer_turn = _FairLock() if self.engine.dialect.name == 'sqlite' else None
+        for target in {self.engine, self.read_engine}:
+            event.listen(target, "before_cursor_execute", metrics.count_query)
+
+# The main database (DATABASE_URL) is a shard too, and the only one with the
+# chat directory, the outbox, bot state and settings.
+MAIN_SHARD = 'main'
+shards = {MAIN_SHARD: Shard(MAIN_SHARD, DATABASE_URL)}
+shards.update((name, Shard(name, url)) for name, url in DB_SHARDS.items() if name != MAIN_SHARD)
+engine, read_engine = shards[MAIN_SHARD].engine, shards[MAIN_SHARD].read_engine
+
+# Handlers run on the asyncio event loop, so blocking database calls are
+# offloaded to a small bounded pool. Shard sessions are thread-local, which gives
+# every worker thread its own session; with concurrent updates, handlers beyond
+# DB_WORKERS wait here for a thread rather than sharing one.
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="shekkle-db")
+
+async def run_async(func, *args, **kwargs):
+    """Runs a blocking database function in the DB thread pool and awaits the result.
+
+    Usage from a handler: ``user = await db.run_async(db.get_user, user_id)``
+    """
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context so queries are attributed to its handler
+    context = contextvars.copy_context()
+    start = time.perf_counter()
     try:
-        yield db
-    except Exception:
-        db.rollback()
-        raise
+        return await loop.run_in_executor(_executor, context.run, functools.partial(func, *args, **kwargs))
     finally:
-        db.close()
+        metrics.record_db_time(time.perf_counter() - start)
 
-# --- User Functions ---
+def init_db():
+    """Brings every shard's schema up to date and runs any backfills it requires."""
+    for shard in shards.values():
+        backfills = migrations.upgrade(shard.engine)
+        if 'user_stats' in backfills:
+            rebuild_user_stats(shard.name)
+        if 'bet_pools' in backfills:
+            rebuild_bet_pools(shard.name)
+        if 'ledger' in backfills:
+            record_opening_balances(shard.name)
+        logger.info(f"Database '{shard.name}' initialized at {shard.engine.url.render_as_string(hide_password=True)}")
 
-def add_user(user_id, username):
-    with get_db() as db:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            new_user = User(user_id=user_id, username=username)
-            db.add(new_user)
+def _insert(db, model):
+    """INSERT for the session's backend, supporting ON CONFLICT clauses."""
+    # Imported here: loading a dialect module adds noticeably to startup, and only one is used
+    if db.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(model)
+
+def _to_int(db, expr):
+    """Truncating float-to-int cast, matching Python's int() for positive values."""
+    if db.get_bind().dialect.name == 'postgresql':
+        # PostgreSQL rounds when casting to integer
+        expr = func.trunc(expr)
+    return cast(expr, Integer)
+
+@contextmanager
+def get_db(readonly=False, chat_id=None, shard=None):
+    """
+    Context manager for database sessions: on the shard holding `chat_id`'s
+    economy, on the shard named `shard`, or else on the main database.
+    Pass readonly=True for queries that never write, so they use the reader pool.
+    """
+    # Only writes give a chat seen for the first time a shard
+    target = shard_for_chat(chat_id, assign=not readonly) if chat_id is not None else shards[shard or MAIN_SHARD]
+    if readonly or target.writer_turn is None:
+        turn = contextlib.nullcontext()
+    else:
+        turn = target.writer_turn
+    with turn:
+        db = target.ReadSession() if readonly else target.Session()
+        try:
+            yield db
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+# --- Chat Routing ---
+
+# chat_id -> shard name. In one process a chat's route only changes through
+# move_chat, which updates it here. With MULTI_WORKER another worker may move a
+# chat this one has seen, so routes are read from the directory every time.
+_chat_routes = {}
+
+def shard_for_chat(chat_id, assign=True):
+    """
+    The Shard holding `chat_id`'s economy. A chat seen for the first time is
+    assigned one if `assign` is set; otherwise it is left unrouted and the main
+    database, which has no rows of it, is returned.
+    """
+    name = _chat_routes.get(chat_id)
+    if name is None:
+        name = _route_chat(chat_id, assign)
+        if name is None:
+            return shards[MAIN_SHARD]
+        if not MULTI_WORKER:
+            _chat_routes[chat_id] = name
+    return shards[name]
+
+def _route_chat(chat_id, assign):
+    with get_db(readonly=True) as db:
+        name = db.scalar(select(ChatShard.shard).where(ChatShard.chat_id == chat_id))
+    if name is None:
+        if not assign:
+            return None
+        with get_db() as db:
+            # The least loaded shard, by chats; the main database wins ties
+            loads = dict(db.execute(select(ChatShard.shard, func.count()).group_by(ChatShard.shard)).all())
+            least = min(shards, key=lambda shard: (loads.get(shard, 0), shard != MAIN_SHARD, shard))
+            db.execute(_insert(db, ChatShard).values(chat_id=chat_id, shard=least, created_at=timestamps.now())
+                       .on_conflict_do_nothing(index_elements=['chat_id']))
+            # Another process may have routed the chat first
+            name = db.scalar(select(ChatShard.shard).where(ChatShard.chat_id == chat_id))
             db.commit()
-            return True
-        return False
+        logger.info(f"Chat {chat_id} assigned to database '{name}'")
+    if name not in shards:
+        raise RuntimeError(f"Chat {chat_id} is stored in database '{name}', which is not configured in DB_SHARDS")
+    return name
 
-def get_user(user_id):
-    """Returns User object or None. Note: detached from session."""
+def _new_bet_id(chat_id):
+    """Allocates a bet id, unique across all shards, for a new bet in `chat_id`."""
     with get_db() as db:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if user:
-            # We strictly only need the balance/last_daily usually
-            # Returning a dict avoids DetachedInstanceError if we access lazy props often
-            # But for simple scalars it is usually fine. Let's return a simple object or DTO.
-            # To be safe against DetachedInstanceError on relationships:
-            db.refresh(user) 
-            return user 
+        bet_id = db.execute(insert(BetRoute).values(chat_id=chat_id)).inserted_primary_key[0]
+        db.commit()
+    return bet_id
+
+def chat_for_bet(bet_id):
+    """The chat a bet was created in, or None for an unknown bet id."""
+    with get_db(readonly=True) as db:
+        return db.scalar(select(BetRoute.chat_id).where(BetRoute.bet_id == bet_id))
+
+def get_shard_loads():
+    """{shard name: number of chats}, for every configured shard and any the directory still names."""
+    with get_db(readonly=True) as db:
+        loads = dict(db.execute(select(ChatShard.shard, func.count()).group_by(ChatShard.shard)).all())
+    return {**{name: 0 for name in shards}, **loads}
+
+# Tables whose rows belong to one chat's economy
+_CHAT_TABLES = (User, UserStats, Bet, Wager, LedgerEntry, BalanceCheckpoint, ArchivedBet, ArchivedWager)
+
+def _has_economy(shard, chat_id):
+    with get_db(readonly=True, shard=shard) as db:
+        return db.execute(select(User.user_id).where(User.chat_id == chat_id)
+                          .union_all(select(Bet.id).where(Bet.chat_id == chat_id)).limit(1)).first() is not None
+
+# Chat the economy of a database from before per-chat economies was migrated to
+LEGACY_CHAT_ID = 0
+# False once that economy has been handed to a group; it never comes back
+_legacy_economy = None
+
+def has_unassigned_economy():
+    """
+    True while LEGACY_CHAT_ID still holds the economy from before per-chat
+    economies: the migration can't tell which group it belonged to, so an
+    admin has to run `manage move-chat 0 <group chat id>`.
+    """
+    global _legacy_economy
+    if _legacy_economy is not False:
+        with get_db(readonly=True) as db:
+            shard = db.scalar(select(ChatShard.shard).where(ChatShard.chat_id == LEGACY_CHAT_ID))
+        _legacy_economy = shard in shards and _has_economy(shard, LEGACY_CHAT_ID)
+    return _legacy_economy
+
+class EconomyUnassigned(Exception):
+    """A new chat economy was refused while LEGACY_CHAT_ID's waits for its group."""
+
+def _check_economy_assigned(chat_id):
+    """
+    Raises EconomyUnassigned if `chat_id` has no economy yet and the one from
+    before per-chat economies hasn't been handed to a group: the chat's first
+    user or bet would start an economy, and move_chat then refuses to hand the
+    old one to this chat.
+    """
+    if chat_id == LEGACY_CHAT_ID or not has_unassigned_economy():
+        return
+    with get_db(readonly=True) as db:
+        shard = db.scalar(select(ChatShard.shard).where(ChatShard.chat_id == chat_id))
+    if shard is None or not _has_economy(shard, chat_id):
+        raise EconomyUnassigned(chat_id)
+
+def move_chat(from_chat_id, to_chat_id):
+    """
+    Re-keys a chat's economy under another chat id, in the same shard: when
+    Telegram turns a group into a supergroup (which gets a new id), or to hand
+    the economy from before per-chat economies (chat 0) to a group.
+    Returns the number of users moved, or None if `to_chat_id` already has an
+    economy of its own.
+    """
+    with get_db(readonly=True) as db:
+        routes = dict(db.execute(select(ChatShard.chat_id, ChatShard.shard)
+                                 .where(ChatShard.chat_id.in_([from_chat_id, to_chat_id]))).all())
+    if from_chat_id not in routes:
+        return 0
+    source = routes[from_chat_id]
+    if to_chat_id in routes and routes[to_chat_id] in shards and _has_economy(routes[to_chat_id], to_chat_id):
         return None
 
-def get_user_by_username(username):
-    """Returns User object or None by username. Note: detached from session."""
     with get_db() as db:
-        # Strip '@' if provided
-        username_clean = username.lstrip('@')
-        user = db.query(User).filter(User.username == username_clean).first()
-        if user:
-            db.refresh(user) 
-            return user 
+        stmt = _insert(db, ChatShard)
+        db.execute(stmt.values(chat_id=to_chat_id, shard=source, created_at=timestamps.now())
+                   .on_conflict_do_update(index_elements=['chat_id'], set_={'shard': stmt.excluded.shard}))
+        db.execute(update(BetRoute).where(BetRoute.chat_id == from_chat_id).values(chat_id=to_chat_id))
+        db.commit()
+    if not MULTI_WORKER:
+        _chat_routes[to_chat_id] = source
+    with get_db(shard=source) as db:
+        moved = {model: db.execute(update(model).where(model.chat_id == from_chat_id)
+                                   .values(chat_id=to_chat_id)
+                                   .execution_options(synchronize_session=False)).rowcount
+                 for model in _CHAT_TABLES}
+        db.commit()
+    user_cache.clear()
+    _invalidate_open_bet_count()
+    logger.info(f"Moved chat {from_chat_id} to {to_chat_id}: {moved[User]} users, {moved[Bet]} bets")
+    return moved[User]
+
+# --- User Cache ---
+
+# Other workers' writes would not reach this process's cache, so it is off with MULTI_WORKER
+user_cache = UserCache(0 if MULTI_WORKER else USER_CACHE_SIZE)
+metrics.watch_user_cache(user_cache)
+
+def _cache_users(db, users):
+    """
+    Write-through for users changed by the transaction that just committed.
+    Call it inside the same get_db() block, after commit. On SQLite writes are
+    serialized, so the committed rows are cached as they are; otherwise
+    concurrent writers may finish in any order and the entries are dropped
+    instead, to be read through again.
+    """
+    serialized = db.get_bind().dialect.name == 'sqlite'
+    for user in users:
+        if serialized:
+            user_cache.put(user)
+        else:
+            user_cache.invalidate(user.chat_id, user.user_id)
+
+# Columns of a CachedUser, in order
+_USER_COLUMNS = (User.chat_id, User.user_id, User.username, User.balance, User.last_daily)
+
+def _user_key(chat_id, user_id):
+    return and_(User.chat_id == chat_id, User.user_id == user_id)
+
+def _get_cached_user(chat_id, user_id):
+    """Read-through lookup. Returns a CachedUser or None."""
+    user = user_cache.get(chat_id, user_id)
+    if user is not None:
+        return user
+    return _read_user(chat_id, _user_key(chat_id, user_id))
+
+def _read_user(chat_id, condition):
+    """The first user of the chat matching `condition`, read from the database into the cache, or None."""
+    generation = user_cache.generation()
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        row = db.execute(select(*_USER_COLUMNS).where(condition).limit(1)).first()
+    if row is None:
         return None
+    user = CachedUser(*row)
+    user_cache.fill(user, generation)
+    return user
 
-def get_all_users():
-    with get_db() as db:
-        users = db.query(User).all()
+# --- User Functions ---
+# Users, balances, bets and stats all belong to one chat's economy: the
+# functions take the chat_id first, and only touch that chat's shard.
+
+def add_user(chat_id, user_id, username):
+    """Registers the user with INITIAL_BALANCE; raises EconomyUnassigned (see _check_economy_assigned)."""
+    _check_economy_assigned(chat_id)
+    with get_db(chat_id=chat_id) as db:
+        stmt = (_insert(db, User)
+                .values(chat_id=chat_id, user_id=user_id, username=username, balance=INITIAL_BALANCE)
+                .on_conflict_do_nothing(index_elements=['chat_id', 'user_id']))
+        created = db.execute(stmt).rowcount == 1
+        if created:
+            _record(db, chat_id, user_id, INITIAL_BALANCE, 'signup')
+        db.commit()
+        if created:
+            _cache_users(db, [CachedUser(chat_id, user_id, username, INITIAL_BALANCE, None)])
+        return created
+
+def get_user(chat_id, user_id):
+    """Returns the user's (chat_id, user_id, username, balance, last_daily) snapshot or None."""
+    return _get_cached_user(chat_id, user_id)
+
+def get_user_by_username(chat_id, username):
+    """Returns the user's snapshot, like get_user(), by username with or without '@', or None."""
+    # The cache is keyed by user id, so this always reads, and caches what it finds
+    return _read_user(chat_id, and_(User.chat_id == chat_id, User.username == username.lstrip('@')))
+
+def get_all_users(chat_id):
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        users = db.query(User).filter(User.chat_id == chat_id).all()
         return [u.user_id for u in users]
 
-def update_balance(user_id, amount):
-    with get_db() as db:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if user:
-            user.balance += amount
-            db.commit()
-            return True
-        return False
+def update_balance(chat_id, user_id, amount, reason='adjustment', ref_id=None):
+    """Adds `amount` (may be negative) to the balance, recorded in the ledger under `reason`."""
+    with get_db(chat_id=chat_id) as db:
+        row = db.execute(update(User).where(_user_key(chat_id, user_id))
+                         .values(balance=User.balance + amount)
+                         .returning(*_USER_COLUMNS)).first()
+        if row is None:
+            return False
+        _record(db, chat_id, user_id, amount, reason, ref_id)
+        db.commit()
+        _cache_users(db, [CachedUser(*row)])
+        return True
 
 # --- Daily Reward Functions ---
 
-def check_daily_claim(user_id):
-    with get_db() as db:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user:
-            return False
-        
-        if not user.last_daily:
-            return True
-            
-        last_daily = datetime.fromisoformat(user.last_daily)
-        if datetime.now() - last_daily >= timedelta(hours=24):
-            return True
+DAILY_CLAIM_INTERVAL = 24 * 60 * 60
+
+def check_daily_claim(chat_id, user_id):
+    user = _get_cached_user(chat_id, user_id)
+    if not user:
         return False
 
-def perform_daily_claim(user_id, amount):
-    with get_db() as db:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if user:
-            user.balance += amount
-            user.last_daily = datetime.now().isoformat()
-            db.commit()
-            db.refresh(user)
-            return user.balance
-        return 0
+    if not user.last_daily:
+        return True
 
-def get_daily_time_remaining_str(user_id):
-    with get_db() as db:
-        user = db.query(User).filter(User.user_id == user_id).first()
-        if not user or not user.last_daily:
-            return "00:00"
-        
-        last_daily = datetime.fromisoformat(user.last_daily)
-        next_claim = last_daily + timedelta(hours=24)
-        remaining = next_claim - datetime.now()
-        
-        if remaining.total_seconds() <= 0:
-            return "00:00"
-            
-        hours, remainder = divmod(remaining.seconds, 3600)
-        minutes, _ = divmod(remainder, 60)
-        return f"{hours:02}:{minutes:02}"
+    return timestamps.now() - user.last_daily >= DAILY_CLAIM_INTERVAL
+
+def perform_daily_claim(chat_id, user_id, amount):
+    """
+    Credits the daily reward if the last claim is at least 24 hours old. The
+    check is part of the UPDATE, so two claims racing each other cannot both
+    pass it. Returns the new balance, or None if the user doesn't exist or
+    has already claimed.
+    """
+    now = timestamps.now()
+    with get_db(chat_id=chat_id) as db:
+        row = db.execute(
+            update(User)
+            .where(_user_key(chat_id, user_id),
+                   or_(User.last_daily.is_(None), User.last_daily <= now - DAILY_CLAIM_INTERVAL))
+            .values(balance=User.balance + amount, last_daily=now)
+            .returning(*_USER_COLUMNS)
+        ).first()
+        if row is None:
+            return None
+        _record(db, chat_id, user_id, amount, 'daily', created_at=now)
+        db.commit()
+        updated = CachedUser(*row)
+        _cache_users(db, [updated])
+        return updated.balance
+
+def get_daily_time_remaining_str(chat_id, user_id):
+    user = _get_cached_user(chat_id, user_id)
+    if not user or not user.last_daily:
+        return "00:00"
+
+    remaining = user.last_daily + DAILY_CLAIM_INTERVAL - timestamps.now()
+    if remaining <= 0:
+        return "00:00"
+
+    hours, remainder = divmod(remaining, 3600)
+    minutes, _ = divmod(remainder, 60)
+    return f"{hours:02}:{minutes:02}"
 
 # --- Betting Functions ---
 
-def create_bet(creator_id, description, deadline, option_a, option_b):
-    with get_db() as db:
+def create_bet(chat_id, creator_id, description, deadline, option_a, option_b):
+    """
+    Creates an OPEN bet in the chat; `deadline` is a local datetime, ISO string or epoch.
+    Raises EconomyUnassigned (see _check_economy_assigned).
+    """
+    _check_economy_assigned(chat_id)
+    bet_id = _new_bet_id(chat_id)
+    with get_db(chat_id=chat_id) as db:
         new_bet = Bet(
+            id=bet_id,
+            chat_id=chat_id,
             creator_id=creator_id,
             description=description,
-            deadline=deadline,
+            deadline=timestamps.to_epoch(deadline),
             option_a=option_a,
             option_b=option_b
         )
         db.add(new_bet)
         db.commit()
-        db.refresh(new_bet)
-        return new_bet.id
+    _invalidate_open_bet_count(chat_id)
+    return bet_id
 
-def get_open_bets():
-    with get_db() as db:
-        bets = db.query(Bet).filter(Bet.status == 'OPEN').all()
+def get_open_bets(chat_id):
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        bets = db.query(Bet).filter(Bet.chat_id == chat_id, Bet.status == 'OPEN').all()
         return [{
             'id': b.id, 'creator_id': b.creator_id, 'description': b.description,
             'deadline': b.deadline, 'option_a': b.option_a, 'option_b': b.option_b
         } for b in bets]
 
-def get_bet(bet_id):
-    with get_db() as db:
-        bet = db.query(Bet).filter(Bet.id == bet_id).first()
+# Number of open bets shown on a chat's /bets pager. Cached briefly because it
+# only changes when bets are created, locked or resolved, which invalidate it;
+# not cached with MULTI_WORKER, where the change may happen in another worker.
+OPEN_BET_COUNT_TTL = 0 if MULTI_WORKER else 30
+_open_bet_counts = {} # chat_id -> (count, expires)
+_open_bet_count_lock = threading.Lock()
+
+def _invalidate_open_bet_count(chat_id=None):
+    """Drops the chat's cached count, or every chat's when None."""
+    with _open_bet_count_lock:
+        if chat_id is None:
+            _open_bet_counts.clear()
+        else:
+            _open_bet_counts.pop(chat_id, None)
+
+def count_open_bets(chat_id):
+    with _open_bet_count_lock:
+        count, expires = _open_bet_counts.get(chat_id, (None, 0.0))
+        if count is not None and time.monotonic() < expires:
+            return count
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        count = db.query(func.count(Bet.id)).filter(Bet.chat_id == chat_id, Bet.status == 'OPEN').scalar()
+    with _open_bet_count_lock:
+        _open_bet_counts[chat_id] = (count, time.monotonic() + OPEN_BET_COUNT_TTL)
+    return count
+
+def get_open_bet_page(chat_id, bet_id=None):
+    """
+    Keyset page of the chat's open bets list, ordered by id.
+    Returns the open bet `bet_id` (or the first open bet when None) with the ids
+    of its open neighbours: {'bet': {...}, 'prev_id', 'next_id', 'count'}.
+    If `bet_id` has closed in the meantime, the next open bet after it is shown
+    instead (or the last one). Returns None when there are no open bets.
+    """
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        open_bets = db.query(Bet).filter(Bet.chat_id == chat_id, Bet.status == 'OPEN')
+        bet = None
+        if bet_id is not None:
+            bet = open_bets.filter(Bet.id >= bet_id).order_by(Bet.id.asc()).first()
+            if bet is None:
+                bet = open_bets.filter(Bet.id < bet_id).order_by(Bet.id.desc()).first()
+        else:
+            bet = open_bets.order_by(Bet.id.asc()).first()
+        if bet is None:
+            return None
+
+        prev_id = (db.query(Bet.id).filter(Bet.chat_id == chat_id, Bet.status == 'OPEN', Bet.id < bet.id)
+                   .order_by(Bet.id.desc()).limit(1).scalar())
+        next_id = (db.query(Bet.id).filter(Bet.chat_id == chat_id, Bet.status == 'OPEN', Bet.id > bet.id)
+                   .order_by(Bet.id.asc()).limit(1).scalar())
+        page = {
+            'bet': {
+                'id': bet.id, 'creator_id': bet.creator_id, 'description': bet.description,
+                'deadline': bet.deadline, 'option_a': bet.option_a, 'option_b': bet.option_b
+            },
+            'prev_id': prev_id,
+            'next_id': next_id,
+        }
+    page['count'] = count_open_bets(chat_id)
+    return page
+
+def get_bet(chat_id, bet_id):
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        bet = db.query(Bet).filter(Bet.id == bet_id, Bet.chat_id == chat_id).first()
         if bet:
             return {
                 'id': bet.id, 'description': bet.description, 'status': bet.status,
@@ -167,215 +603,1027 @@ def get_bet(bet_id):
             }
         return None
 
-def place_wager(user_id, bet_id, choice, amount):
-    with get_db() as db:
-        bet = db.query(Bet).with_for_update().filter(Bet.id == bet_id).first()
+def place_wager(chat_id, user_id, bet_id, choice, amount, register=False, username=None):
+    """
+    Places a wager in one short transaction: registers the user first when
+    `register` is set (a no-op for existing users), checks the bet is open, debits the stake with a
+    conditional UPDATE and records the wager and pool aggregates.
+    Bets of other chats are not found. Returns (success, message); raises
+    EconomyUnassigned when registering (see _check_economy_assigned).
+    """
+    if register:
+        _check_economy_assigned(chat_id)
+    with get_db(chat_id=chat_id) as db:
+        registered = False
+        if register:
+            registered = db.execute(_insert(db, User)
+                                    .values(chat_id=chat_id, user_id=user_id, username=username,
+                                            balance=INITIAL_BALANCE)
+                                    .on_conflict_do_nothing(index_elements=['chat_id', 'user_id'])).rowcount == 1
+            if registered:
+                _record(db, chat_id, user_id, INITIAL_BALANCE, 'signup')
+
+        # The bet row lock serializes wagers on one bet against each other and
+        # against locking/resolving it
+        bet = db.execute(select(Bet.status, Bet.deadline)
+                         .where(Bet.id == bet_id, Bet.chat_id == chat_id).with_for_update()).first()
+        now = timestamps.now()
         if not bet:
-            return False, "Bet not found."
-        
-        if bet.status != 'OPEN':
-            return False, "Bet is not open."
-            
-        if datetime.now().isoformat() > bet.deadline:
-            return False, "Deadline has passed."
-
-        user = db.query(User).with_for_update().filter(User.user_id == user_id).first()
-        if not user or user.balance < amount:
-            return False, "Insufficient funds."
-
-        user.balance -= amount
-        
-        wager = Wager(
-            user_id=user_id,
-            bet_id=bet_id,
-            choice=choice,
-            amount=amount,
-            placed_at=datetime.now().isoformat()
-        )
-        db.add(wager)
+            error = "Bet not found."
+        elif bet.status != 'OPEN':
+            error = "Bet is not open."
+        elif now > bet.deadline:
+            error = "Deadline has passed."
+        else:
+            debited = db.execute(update(User)
+                                 .where(_user_key(chat_id, user_id), User.balance >= amount)
+                                 .values(balance=User.balance - amount)
+                                 .returning(*_USER_COLUMNS)
+                                 .execution_options(synchronize_session=False)).first()
+            error = None if debited else "Insufficient funds."
+        if error:
+            # Keep the user registration, if any
+            db.commit()
+            if registered:
+                _cache_users(db, [CachedUser(chat_id, user_id, username, INITIAL_BALANCE, None)])
+            return False, error
+
+        wager_id = db.execute(insert(Wager).values(chat_id=chat_id, user_id=user_id, bet_id=bet_id, choice=choice,
+                                                   amount=amount, placed_at=now)).inserted_primary_key[0]
+        _record(db, chat_id, user_id, -amount, 'wager', wager_id, created_at=now)
+        _add_to_pool(db, bet_id, user_id, choice, amount)
         db.commit()
+        _cache_users(db, [CachedUser(*debited)])
         return True, "Wager placed successfully."
 
-def get_bet_wagers(bet_id):
-    with get_db() as db:
-        wagers = db.query(Wager).filter(Wager.bet_id == bet_id, Wager.refunded == 0).all()
-        result = []
-        for w in wagers:
-            result.append({
-                'user_id': w.user_id,
-                'choice': w.choice,
-                'amount': w.amount,
-                'username': w.user.username if w.user else "Unknown"
-            })
-        return result
-
-def get_expired_open_bets(current_time_iso):
-    with get_db() as db:
-        bets = db.query(Bet).filter(Bet.status == 'OPEN', Bet.deadline <= current_time_iso).all()
-        return [{'id': b.id, 'description': b.description} for b in bets]
+# --- Pool Aggregate Functions ---
 
-def update_bet_status(bet_id, status):
-    with get_db() as db:
-        bet = db.query(Bet).filter(Bet.id == bet_id).first()
+def _add_to_pool(db, bet_id, user_id, choice, amount):
+    """
+    Adds a stake to the bet's pool aggregates in the caller's transaction.
+    The caller must hold the bet row lock, which serializes pool updates per bet.
+    """
+    new_bettor = db.execute(_insert(db, BetPoolEntry)
+                            .values(bet_id=bet_id, choice=choice, user_id=user_id, amount=amount)
+                            .on_conflict_do_nothing()).rowcount == 1
+    if not new_bettor:
+        db.execute(update(BetPoolEntry)
+                   .where(BetPoolEntry.bet_id == bet_id, BetPoolEntry.choice == choice,
+                          BetPoolEntry.user_id == user_id)
+                   .values(amount=BetPoolEntry.amount + amount)
+                   .execution_options(synchronize_session=False))
+
+    side = {'amount_a': 0, 'amount_b': 0, 'bettors_a': 0, 'bettors_b': 0}
+    side['amount_a' if choice == 'A' else 'amount_b'] = amount
+    side['bettors_a' if choice == 'A' else 'bettors_b'] = int(new_bettor)
+    stmt = _insert(db, BetPool).values(bet_id=bet_id, **side)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['bet_id'],
+        set_={column: getattr(BetPool, column) + getattr(stmt.excluded, column) for column in side},
+    ))
+
+def _rebuild_pools(db, bet_id=None):
+    """Recomputes pool aggregates from non-refunded wagers, for one bet or all bets."""
+    # Pending refunds must be visible to the INSERT ... SELECT below
+    db.flush()
+    entries = db.query(BetPoolEntry)
+    pools = db.query(BetPool)
+    stakes = (select(Wager.bet_id, Wager.choice, Wager.user_id, func.sum(Wager.amount))
+              .where(Wager.refunded == 0)
+              .group_by(Wager.bet_id, Wager.choice, Wager.user_id))
+    totals = (select(BetPoolEntry.bet_id,
+                     func.sum(case((BetPoolEntry.choice == 'A', BetPoolEntry.amount), else_=0)),
+                     func.sum(case((BetPoolEntry.choice == 'B', BetPoolEntry.amount), else_=0)),
+                     func.sum(case((BetPoolEntry.choice == 'A', 1), else_=0)),
+                     func.sum(case((BetPoolEntry.choice == 'B', 1), else_=0)))
+              .group_by(BetPoolEntry.bet_id))
+    if bet_id is not None:
+        entries = entries.filter(BetPoolEntry.bet_id == bet_id)
+        pools = pools.filter(BetPool.bet_id == bet_id)
+        stakes = stakes.where(Wager.bet_id == bet_id)
+        totals = totals.where(BetPoolEntry.bet_id == bet_id)
+
+    entries.delete(synchronize_session=False)
+    pools.delete(synchronize_session=False)
+    db.execute(insert(BetPoolEntry).from_select(['bet_id', 'choice', 'user_id', 'amount'], stakes))
+    db.execute(insert(BetPool).from_select(['bet_id', 'amount_a', 'amount_b', 'bettors_a', 'bettors_b'], totals))
+
+def rebuild_bet_pools(shard=MAIN_SHARD):
+    """Recomputes the pool aggregates of every bet in a shard. Used to backfill existing databases."""
+    with get_db(shard=shard) as db:
+        _rebuild_pools(db)
+        db.commit()
+        count = db.query(func.count(BetPool.bet_id)).scalar()
+    logger.info(f"Rebuilt pool aggregates for {count} bets")
+    return count
+
+def get_bet_status(chat_id, bet_id, limit=20):
+    """
+    Bet details plus pool aggregates for the status view, or None if the chat
+    has no such bet. Each side lists at most `limit` bettors, biggest stake first.
+    """
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        bet = db.get(Bet, bet_id)
+        if not bet or bet.chat_id != chat_id:
+            return _get_archived_bet_status(db, chat_id, bet_id, limit)
+        pool = db.get(BetPool, bet_id)
+        status = {
+            'id': bet.id, 'description': bet.description, 'status': bet.status,
+            'option_a': bet.option_a, 'option_b': bet.option_b, 'deadline': bet.deadline,
+            'amount_a': pool.amount_a if pool else 0,
+            'amount_b': pool.amount_b if pool else 0,
+            'bettors_a': pool.bettors_a if pool else 0,
+            'bettors_b': pool.bettors_b if pool else 0,
+        }
+        for choice in ('A', 'B'):
+            rows = (db.query(BetPoolEntry.user_id, BetPoolEntry.amount, User.username)
+                    .outerjoin(User, _user_key(chat_id, BetPoolEntry.user_id))
+                    .filter(BetPoolEntry.bet_id == bet_id, BetPoolEntry.choice == choice)
+                    .order_by(BetPoolEntry.amount.desc())
+                    .limit(limit)
+                    .all())
+            status[f"top_{choice.lower()}"] = [
+                {'user_id': r.user_id, 'amount': r.amount, 'username': r.username} for r in rows
+            ]
+        return status
+
+def _get_archived_bet_status(db, chat_id, bet_id, limit):
+    """get_bet_status for an archived bet; bettors are summed from its archived wagers."""
+    bet = db.get(ArchivedBet, bet_id)
+    if not bet or bet.chat_id != chat_id:
+        return None
+    status = {
+        'id': bet.id, 'description': bet.description, 'status': bet.status,
+        'option_a': bet.option_a, 'option_b': bet.option_b, 'deadline': bet.deadline,
+        'amount_a': bet.amount_a, 'amount_b': bet.amount_b,
+        'bettors_a': bet.bettors_a, 'bettors_b': bet.bettors_b,
+    }
+    for choice in ('A', 'B'):
+        stake = func.sum(ArchivedWager.amount)
+        rows = (db.query(ArchivedWager.user_id, stake.label('amount'), User.username)
+                .outerjoin(User, _user_key(chat_id, ArchivedWager.user_id))
+                .filter(ArchivedWager.bet_id == bet_id, ArchivedWager.choice == choice,
+                        ArchivedWager.refunded == 0)
+                .group_by(ArchivedWager.user_id, User.username)
+                .order_by(stake.desc())
+                .limit(limit)
+                .all())
+        status[f"top_{choice.lower()}"] = [
+            {'user_id': r.user_id, 'amount': r.amount, 'username': r.username} for r in rows
+        ]
+    return status
+
+def get_bet_wagers(chat_id, bet_id):
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        rows = db.execute(select(Wager.user_id, Wager.choice, Wager.amount, User.username,
+                                 User.user_id.label('registered'))
+                          .outerjoin(User, _user_key(chat_id, Wager.user_id))
+                          .where(Wager.bet_id == bet_id, Wager.chat_id == chat_id, Wager.refunded == 0)
+                          .order_by(Wager.id)).all()
+    return [{'user_id': r.user_id, 'choice': r.choice, 'amount': r.amount,
+             'username': r.username if r.registered is not None else "Unknown"} for r in rows]
+
+def get_expired_open_bets(now):
+    """OPEN bets of every chat whose deadline has passed."""
+    expired = []
+    for name in shards:
+        with get_db(readonly=True, shard=name) as db:
+            bets = db.query(Bet).filter(Bet.status == 'OPEN', Bet.deadline <= now).all()
+            expired += [{'id': b.id, 'chat_id': b.chat_id, 'description': b.description} for b in bets]
+    return expired
+
+def get_open_bet_deadlines():
+    """Distinct deadlines of all OPEN bets in every chat, used to re-arm deadline timers on startup."""
+    deadlines = set()
+    for name in shards:
+        with get_db(readonly=True, shard=name) as db:
+            deadlines.update(r.deadline for r in db.query(Bet.deadline).filter(Bet.status == 'OPEN').distinct())
+    return sorted(deadlines)
+
+def lock_expired_bets(now):
+    """
+    Moves every OPEN bet whose deadline has passed to LOCKED, in one
+    transaction per shard, and marks its expiry notice pending (see
+    get_pending_expiry_notices). Returns the bets that were locked by this call.
+    """
+    locked = []
+    for name in shards:
+        with get_db(shard=name) as db:
+            bets = (db.query(Bet).with_for_update()
+                    .filter(Bet.status == 'OPEN', Bet.deadline <= now)
+                    .all())
+            for b in bets:
+                b.status = 'LOCKED'
+                b.expiry_pending = 1
+                locked.append({'id': b.id, 'chat_id': b.chat_id, 'description': b.description})
+            db.commit()
+    if locked:
+        _invalidate_open_bet_count()
+    return locked
+
+def get_pending_expiry_notices():
+    """
+    LOCKED bets of every chat whose expiry notice has not been queued yet:
+    those just locked, and any whose notice failed to queue before.
+    """
+    pending = []
+    for name in shards:
+        with get_db(readonly=True, shard=name) as db:
+            rows = db.execute(select(Bet.id, Bet.chat_id, Bet.description)
+                              .where(Bet.expiry_pending == 1, Bet.status == 'LOCKED')
+                              .order_by(Bet.id)).all()
+            pending += [{'id': r.id, 'chat_id': r.chat_id, 'description': r.description} for r in rows]
+    return pending
+
+def clear_expiry_notices(bets):
+    """Marks the expiry notices of `bets` (as returned by get_pending_expiry_notices) queued."""
+    by_shard = collections.defaultdict(list)
+    for bet in bets:
+        by_shard[shard_for_chat(bet['chat_id']).name].append(bet['id'])
+    for name, bet_ids in by_shard.items():
+        with get_db(shard=name) as db:
+            db.execute(update(Bet).where(Bet.id.in_(bet_ids)).values(expiry_pending=0)
+                       .execution_options(synchronize_session=False))
+            db.commit()
+
+def update_bet_status(chat_id, bet_id, status):
+    with get_db(chat_id=chat_id) as db:
+        bet = db.query(Bet).filter(Bet.id == bet_id, Bet.chat_id == chat_id).first()
         if bet:
             bet.status = status
             db.commit()
+            _invalidate_open_bet_count(chat_id)
 
 def resolve_bet(bet_id, outcome, cutoff_dt=None):
     """
-    Resolves a bet.
+    Resolves a bet, whichever chat it is in. Wagers placed after `cutoff_dt`
+    (local datetime, ISO string or epoch), if given, are refunded.
     Returns: (success, message, winners_list)
     winners_list: [{'user_id': int, 'payout': int, 'profit': int}, ...]
     """
     if outcome not in ('A', 'B'):
         return False, "Outcome must be A or B", []
 
+    cutoff_val = timestamps.to_epoch(cutoff_dt)
+    chat_id = chat_for_bet(bet_id)
+    if chat_id is None:
+        return False, "Bet not found", []
+
+    with get_db(chat_id=chat_id) as db:
+        bets = _lock_for_settlement(db, [bet_id])
+        error = _settlement_error(bets.get(bet_id))
+        if error:
+            return False, error, []
+        message, winners_list = _settle_bet(db, bet_id, outcome, cutoff_val)
+        updated = _bettor_snapshots(db, [bet_id])
+        db.commit()
+        _cache_users(db, updated)
+    _invalidate_open_bet_count(chat_id)
+    return True, message, winners_list
+
+def resolve_bets(resolutions):
+    """
+    Resolves several bets in one transaction: either all of them are settled or
+    none is, so they must all be stored in the same database.
+    resolutions: [(bet_id, outcome), ...]
+    Returns: (success, messages, winners) where messages is [(bet_id, message)]
+    and winners maps bet_id to its winners_list (see resolve_bet). On failure
+    messages holds the offending bet and winners is empty.
+    """
+    bet_ids = [bet_id for bet_id, _ in resolutions]
+    if len(set(bet_ids)) != len(bet_ids):
+        return False, [(None, "A bet can only be resolved once per batch")], {}
+    for bet_id, outcome in resolutions:
+        if outcome not in ('A', 'B'):
+            return False, [(bet_id, "Outcome must be A or B")], {}
+
+    with get_db(readonly=True) as db:
+        chats = dict(db.execute(select(BetRoute.bet_id, BetRoute.chat_id).where(BetRoute.bet_id.in_(bet_ids))).all())
+    for bet_id in bet_ids:
+        if bet_id not in chats:
+            return False, [(bet_id, "Bet not found")], {}
+    shard = shard_for_chat(chats[bet_ids[0]])
+    for bet_id in bet_ids:
+        if shard_for_chat(chats[bet_id]) is not shard:
+            return False, [(bet_id, "Bet is stored in another database than the first bet; resolve it separately")], {}
+
+    with get_db(shard=shard.name) as db:
+        bets = _lock_for_settlement(db, bet_ids)
+        for bet_id in bet_ids:
+            error = _settlement_error(bets.get(bet_id))
+            if error:
+                return False, [(bet_id, error)], {}
+
+        messages, winners = [], {}
+        for bet_id, outcome in resolutions:
+            message, winners[bet_id] = _settle_bet(db, bet_id, outcome)
+            messages.append((bet_id, message))
+        updated = _bettor_snapshots(db, bet_ids)
+        db.commit()
+        _cache_users(db, updated)
+    _invalidate_open_bet_count()
+    return True, messages, winners
+
+def _lock_for_settlement(db, bet_ids):
+    """
+    Locks the bets, then every bettor's user row, each in id order, so that
+    settlement cannot deadlock with wagers (which lock bet, then user) on
+    backends that honour row locks. Returns {bet_id: status}.
+    """
+    bets = dict(db.execute(select(Bet.id, Bet.status).where(Bet.id.in_(bet_ids))
+                           .order_by(Bet.id).with_for_update()).all())
+    if bets:
+        bettors = select(Wager.chat_id, Wager.user_id).where(Wager.bet_id.in_(list(bets)))
+        db.execute(select(User.user_id).where(tuple_(User.chat_id, User.user_id).in_(bettors))
+                   .order_by(User.chat_id, User.user_id).with_for_update()).all()
+    return bets
+
+def _settlement_error(status):
+    if status is None:
+        return "Bet not found"
+    if status == 'RESOLVED':
+        return "Bet already resolved"
+    return None
+
+def _bettor_snapshots(db, bet_ids):
+    """Current rows of everyone who wagered on the bets, for the user cache."""
+    bettors = select(Wager.chat_id, Wager.user_id).where(Wager.bet_id.in_(bet_ids))
+    rows = db.execute(select(*_USER_COLUMNS).where(tuple_(User.chat_id, User.user_id).in_(bettors))).all()
+    return [CachedUser(*row) for row in rows]
+
+def _credit_users(db, amount, wager_filter, reason):
+    """
+    Adds sum(`amount`) over the wagers matching `wager_filter` to each bettor's
+    balance, with one ledger entry per wager.
+    """
+    # UPDATE ... FROM a grouped subquery: one aggregation pass instead of a
+    # correlated subquery per user
+    credits = (select(Wager.chat_id, Wager.user_id, func.sum(amount).label('credit'))
+               .where(wager_filter).group_by(Wager.chat_id, Wager.user_id).subquery())
+    db.execute(update(User)
+               .where(User.chat_id == credits.c.chat_id, User.user_id == credits.c.user_id)
+               .values(balance=User.balance + credits.c.credit)
+               .execution_options(synchronize_session=False))
+    db.execute(insert(LedgerEntry).from_select(
+        ['chat_id', 'user_id', 'amount', 'reason', 'ref_id', 'created_at'],
+        select(Wager.chat_id, Wager.user_id, amount, literal(reason, String), Wager.id,
+               literal(timestamps.now(), BigInteger)).where(wager_filter)))
+
+def _refund_wagers(db, wager_filter):
+    """Credits and marks refunded the non-refunded wagers matching `wager_filter`."""
+    _credit_users(db, Wager.amount, wager_filter, 'refund')
+    db.execute(update(Wager).where(wager_filter).values(refunded=1)
+               .execution_options(synchronize_session=False))
+
+def _settle_bet(db, bet_id, outcome, cutoff_val=None):
+    """
+    Settles one bet with set-based statements in the caller's transaction.
+    The caller must hold the settlement locks. Returns (message, winners_list).
+    """
+    active = and_(Wager.bet_id == bet_id, Wager.refunded == 0)
+
+    refund_count, refund_gross = 0, 0
+    if cutoff_val is not None:
+        late = and_(active, Wager.placed_at > cutoff_val)
+        refund_count, refund_gross = db.execute(
+            select(func.count(Wager.id), func.coalesce(func.sum(Wager.amount), 0)).where(late)).one()
+        if refund_count:
+            _refund_wagers(db, late)
+
+    won = Wager.choice == outcome
+    total_pool, winning_pool = db.execute(
+        select(func.coalesce(func.sum(Wager.amount), 0),
+               func.coalesce(func.sum(case((won, Wager.amount), else_=0)), 0)).where(active)).one()
+
+    values = {'status': 'RESOLVED', 'outcome': outcome, 'resolved_at': timestamps.now()}
+    if cutoff_val is not None:
+        values['cutoff_at'] = cutoff_val
+    db.execute(update(Bet).where(Bet.id == bet_id).values(**values)
+               .execution_options(synchronize_session=False))
+
+    msg_prefix = ""
+    if refund_count > 0:
+        msg_prefix = f"⚠️ Refunded {refund_count} wagers ({refund_gross}) after cutoff.\n"
+
+    if winning_pool == 0:
+        _refund_wagers(db, active)
+        _rebuild_pools(db, bet_id)
+        return f"{msg_prefix}No winners. All refunded.", []
+
+    # Same arithmetic as before: int(amount * (total_pool / winning_pool))
+    ratio = total_pool / winning_pool
+    db.execute(update(Wager).where(active)
+               .values(payout=case((won, _to_int(db, Wager.amount * ratio)), else_=0))
+               .execution_options(synchronize_session=False))
+    _credit_users(db, Wager.payout, and_(active, won), 'payout')
+
+    _apply_stats_deltas(db, select(Wager.chat_id, Wager.user_id,
+                                   func.sum(case((won, Wager.payout - Wager.amount), else_=-Wager.amount)),
+                                   func.count(Wager.id),
+                                   func.sum(case((won, 1), else_=0)))
+                        .where(active).group_by(Wager.chat_id, Wager.user_id))
+
+    winners_list = [
+        {'user_id': user_id, 'payout': payout, 'profit': payout - amount}
+        for user_id, payout, amount in db.execute(
+            select(Wager.user_id, Wager.payout, Wager.amount).where(active, won).order_by(Wager.id))
+    ]
+    if refund_count:
+        _rebuild_pools(db, bet_id)
+    return f"{msg_prefix}Resolved {outcome}. {len(winners_list)} winners (x{ratio:.2f}).", winners_list
+
+def get_user_history(chat_id, user_id, limit=10):
+    """Returns the most recent resolved wagers for a user in the chat."""
+    return get_user_history_page(chat_id, user_id, limit=limit)['items']
+
+def _history_rows(db, wagers, bets, chat_id, user_id, cursor_key, after, limit, *extra_columns):
+    """Up to `limit` resolved wagers of a user from `wagers` joined to `bets`, continuing from cursor_key."""
+    key = tuple_(wagers.placed_at, wagers.id)
+    query = (select(wagers.id, wagers.bet_id, bets.description, wagers.amount, wagers.choice, bets.outcome,
+                    func.coalesce(wagers.payout, 0), wagers.refunded, wagers.placed_at, *extra_columns)
+             .join(bets, bets.id == wagers.bet_id)
+             .where(wagers.chat_id == chat_id, wagers.user_id == user_id, bets.status == 'RESOLVED'))
+    if after is not None:
+        query = query.where(key > cursor_key).order_by(wagers.placed_at.asc(), wagers.id.asc())
+    else:
+        if cursor_key is not None:
+            query = query.where(key < cursor_key)
+        query = query.order_by(wagers.placed_at.desc(), wagers.id.desc())
+    return db.execute(query.limit(limit)).all()
+
+def get_user_history_page(chat_id, user_id, before=None, after=None, limit=5):
+    """
+    Keyset page of a user's resolved wagers in the chat, newest first by
+    (placed_at, id). `before` / `after` is a wager id to continue from: the
+    page of older wagers before it, or of newer wagers after it. Each page is
+    one projected query along ix_wagers_chat_user_placed_id, however many wagers the user has;
+    the archive is read as well only when archived wagers could be on the page.
+    Returns {'items': [...], 'newer': wager_id, 'older': wager_id}, where
+    `newer` / `older` are the cursors for the neighbouring pages (None at either end).
+    """
+    cursor = after if after is not None else before
+    cursor_key = None
+    if cursor is not None:
+        # The wager paged from may have been archived since
+        cursor_placed = func.coalesce(select(Wager.placed_at).where(Wager.id == cursor).scalar_subquery(),
+                                      select(ArchivedWager.placed_at).where(ArchivedWager.id == cursor)
+                                      .scalar_subquery())
+        cursor_key = tuple_(cursor_placed, cursor)
+
+    # One row more than the page tells whether there is another page that way
+    # The archive watermark rides along with the page, saving a round trip
+    watermark = (select(BotSetting.value).where(BotSetting.name == ARCHIVE_WATERMARK)
+                 .scalar_subquery().label('watermark'))
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        rows = _history_rows(db, Wager, Bet, chat_id, user_id, cursor_key, after, limit + 1, watermark)
+        # Archived wagers were all placed at or before the watermark: they can
+        # only be on this page if it reaches back that far
+        if not rows or (rows[0].watermark is not None and (
+                after is not None or len(rows) <= limit or rows[-1].placed_at <= int(rows[0].watermark))):
+            rows += _history_rows(db, ArchivedWager, ArchivedBet, chat_id, user_id, cursor_key, after, limit + 1)
+            rows.sort(key=lambda row: (row.placed_at, row.id), reverse=after is None)
+            rows = rows[:limit + 1]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if after is not None:
+        rows.reverse()
+
+    items = [
+        {'wager_id': wager_id, 'bet_id': bet_id, 'description': description, 'amount': amount,
+         'choice': choice, 'outcome': outcome, 'payout': payout, 'refunded': refunded}
+        for wager_id, bet_id, description, amount, choice, outcome, payout, refunded, *_ in rows
+    ]
+    page = {'items': items, 'newer': None, 'older': None}
+    if items:
+        first, last = items[0]['wager_id'], items[-1]['wager_id']
+        # The wager the page continued from lies the other way
+        if after is not None:
+            page.update(newer=first if more else None, older=last)
+        else:
+            page.update(newer=first if before is not None else None, older=last if more else None)
+    return page
+
+def _apply_stats_deltas(db, per_user):
+    """
+    Adds a settlement's per-user deltas to user_stats within the caller's transaction.
+    per_user: SELECT of (chat_id, user_id, net_profit, bets_placed, bets_won) rows.
+    """
+    stmt = _insert(db, UserStats).from_select(['chat_id', 'user_id', 'net_profit', 'bets_placed', 'bets_won'],
+                                              per_user)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['chat_id', 'user_id'],
+        set_={
+            'net_profit': UserStats.net_profit + stmt.excluded.net_profit,
+            'bets_placed': UserStats.bets_placed + stmt.excluded.bets_placed,
+            'bets_won': UserStats.bets_won + stmt.excluded.bets_won,
+        }
+    )
+    db.execute(stmt)
+
+def _stats_per_user(db, wagers, bets):
+    """SELECT of (chat_id, user_id, net_profit, bets_placed, bets_won) over the resolved wagers in `wagers`."""
+    valid = and_(bets.status == 'RESOLVED', wagers.refunded == 0)
+    won = wagers.choice == bets.outcome
+
+    pools = (select(wagers.bet_id.label('bet_id'),
+                    func.sum(wagers.amount).label('total_pool'),
+                    func.sum(case((won, wagers.amount), else_=0)).label('winning_pool'))
+             .join(bets, bets.id == wagers.bet_id)
+             .where(valid)
+             .group_by(wagers.bet_id)
+             .subquery())
+
+    # Same arithmetic as resolve_bet: int(amount * (total_pool / winning_pool))
+    payout = _to_int(db, wagers.amount * (cast(pools.c.total_pool, Float) / pools.c.winning_pool))
+
+    return (select(wagers.chat_id.label('chat_id'), wagers.user_id.label('user_id'),
+                   func.sum(case((won, payout - wagers.amount), else_=-wagers.amount)).label('net_profit'),
+                   func.count(wagers.id).label('bets_placed'),
+                   func.sum(case((won, 1), else_=0)).label('bets_won'))
+            .join(bets, bets.id == wagers.bet_id)
+            .join(pools, pools.c.bet_id == wagers.bet_id)
+            .join(User, and_(User.chat_id == wagers.chat_id, User.user_id == wagers.user_id))
+            .where(valid, pools.c.winning_pool > 0)
+            .group_by(wagers.chat_id, wagers.user_id))
+
+def rebuild_user_stats(shard=MAIN_SHARD):
+    """
+    Recomputes user_stats of every chat in a shard from all resolved wagers,
+    archived ones included, in two set-based statements. Used to backfill
+    existing databases; returns the number of users with stats.
+    """
+    with get_db(shard=shard) as db:
+        both = union_all(_stats_per_user(db, Wager, Bet), _stats_per_user(db, ArchivedWager, ArchivedBet)).subquery()
+        per_user = (select(both.c.chat_id, both.c.user_id, func.sum(both.c.net_profit),
+                           func.sum(both.c.bets_placed), func.sum(both.c.bets_won))
+                    .group_by(both.c.chat_id, both.c.user_id))
+
+        db.execute(delete(UserStats))
+        db.execute(insert(UserStats).from_select(
+            ['chat_id', 'user_id', 'net_profit', 'bets_placed', 'bets_won'], per_user))
+        db.commit()
+        count = db.query(func.count(UserStats.user_id)).scalar()
+    logger.info(f"Rebuilt user_stats for {count} users in database '{shard}'")
+    return count
+
+def _stats_rows(rows):
+    return [{
+        'username': username,
+        'net_profit': s.net_profit, 'bets_placed': s.bets_placed, 'bets_won': s.bets_won
+    } for s, username in rows]
+
+def _ranked_stats(chat_id, order, limit):
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        rows = (db.query(UserStats, User.username)
+                .join(User, and_(User.chat_id == UserStats.chat_id, User.user_id == UserStats.user_id))
+                .filter(UserStats.chat_id == chat_id, UserStats.bets_placed > 0)
+                .order_by(order)
+                .limit(limit)
+                .all())
+        return _stats_rows(rows)
+
+def get_top_winners(chat_id, limit=10):
+    """Users of the chat with the highest net profit, best first."""
+    return _ranked_stats(chat_id, UserStats.net_profit.desc(), limit)
+
+def get_top_losers(chat_id, limit=10):
+    """Users of the chat with the lowest net profit, worst first."""
+    return _ranked_stats(chat_id, UserStats.net_profit.asc(), limit)
+
+def get_leaderboard_data(chat_id, limit=None):
+    """Returns the chat's (winners, losers) from user_stats, optionally capped at `limit` each."""
+    return get_top_winners(chat_id, limit), get_top_losers(chat_id, limit)
+
+# --- Ledger Functions ---
+
+LEDGER_RECONCILE_CURSOR = 'ledger_reconcile'
+
+def _record(db, chat_id, user_id, amount, reason, ref_id=None, created_at=None):
+    """
+    Appends a ledger entry in the caller's transaction. Call it after the
+    UPDATE of users.balance: the row lock it takes then orders each user's
+    entries by id in commit order, which checkpoints rely on.
+    """
+    db.execute(insert(LedgerEntry).values(chat_id=chat_id, user_id=user_id, amount=amount, reason=reason,
+                                         ref_id=ref_id, created_at=created_at or timestamps.now()))
+
+def record_opening_balances(shard=MAIN_SHARD):
+    """
+    Gives every user without ledger entries an 'opening' entry for their
+    current balance. Backfill for databases that predate the ledger; returns
+    the number of users opened.
+    """
+    now = timestamps.now()
+    unrecorded = ~select(LedgerEntry.id).where(LedgerEntry.chat_id == User.chat_id,
+                                               LedgerEntry.user_id == User.user_id).exists()
+    with get_db(shard=shard) as db:
+        count = db.execute(insert(LedgerEntry).from_select(
+            ['chat_id', 'user_id', 'amount', 'reason', 'created_at'],
+            select(User.chat_id, User.user_id, func.coalesce(User.balance, 0), literal('opening', String),
+                   literal(now, BigInteger)).where(unrecorded))).rowcount
+        db.commit()
+    logger.info(f"Recorded opening balances for {count} users")
+    return count
+
+def _balance_at(db, chat_id, user_id, when):
+    """
+    (balance, ledger_id) of the user after the last entry at or before the
+    epoch `when`: the nearest checkpoint before it plus the entries up to the
+    next checkpoint, so at most one checkpoint interval is summed.
+    """
+    own = and_(BalanceCheckpoint.chat_id == chat_id, BalanceCheckpoint.user_id == user_id)
+    start = db.execute(select(BalanceCheckpoint.ledger_id, BalanceCheckpoint.balance)
+                       .where(own, BalanceCheckpoint.as_of <= when)
+                       .order_by(BalanceCheckpoint.ledger_id.desc()).limit(1)).first()
+    start_id, balance = start if start else (0, 0)
+    end_id = db.scalar(select(BalanceCheckpoint.ledger_id)
+                       .where(own, BalanceCheckpoint.as_of > when)
+                       .order_by(BalanceCheckpoint.ledger_id.asc()).limit(1))
+    tail = (select(func.coalesce(func.sum(LedgerEntry.amount), 0), func.max(LedgerEntry.id))
+            .where(LedgerEntry.chat_id == chat_id, LedgerEntry.user_id == user_id, LedgerEntry.id > start_id,
+                   LedgerEntry.created_at <= when))
+    if end_id is not None:
+        tail = tail.where(LedgerEntry.id <= end_id)
+    amount, last_id = db.execute(tail).one()
+    return balance + amount, last_id or start_id
+
+def get_balance_at(chat_id, user_id, when):
+    """The user's balance at `when` (local datetime, ISO string or epoch); 0 before their first entry."""
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        return _balance_at(db, chat_id, user_id, timestamps.to_epoch(when))[0]
+
+def get_balance_history(chat_id, user_id, since, until=None, limit=1000):
+    """
+    Balance over time: the balance at `since`, then every ledger entry up to
+    `until` (default now) with the balance after it, oldest first.
+    Returns [{'at', 'balance', 'amount', 'reason', 'ref_id'}]; the first item
+    is the starting point, with amount 0 and reason None.
+    """
+    since = timestamps.to_epoch(since)
+    until = timestamps.to_epoch(until) if until else timestamps.now()
+    with get_db(readonly=True, chat_id=chat_id) as db:
+        balance, last_id = _balance_at(db, chat_id, user_id, since)
+        rows = db.execute(select(LedgerEntry.created_at, LedgerEntry.amount, LedgerEntry.reason, LedgerEntry.ref_id)
+                          .where(LedgerEntry.chat_id == chat_id, LedgerEntry.user_id == user_id,
+                                 LedgerEntry.id > last_id,
+                                 LedgerEntry.created_at <= until)
+                          .order_by(LedgerEntry.id).limit(limit)).all()
+    history = [{'at': since, 'balance': balance, 'amount': 0, 'reason': None, 'ref_id': None}]
+    for created_at, amount, reason, ref_id in rows:
+        balance += amount
+        history.append({'at': created_at, 'balance': balance, 'amount': amount, 'reason': reason, 'ref_id': ref_id})
+    return history
+
+def reconcile_ledger(batch=RECONCILE_BATCH, checkpoint_every=LEDGER_CHECKPOINT_EVERY, shard=MAIN_SHARD,
+                     settle=LEDGER_SETTLE_SECONDS):
+    """
+    Checks users.balance against the ledger, in one shard, for the users with
+    entries since the last run, up to `batch` entries, and takes a checkpoint
+    for those with `checkpoint_every` entries since their last one. Each user's
+    ledger balance is their latest checkpoint plus the entries after it, so the
+    cost depends on recent activity, never on the size of the ledger.
+
+    The cursor stops before the first entry less than `settle` seconds old. On
+    PostgreSQL, concurrent transactions can commit their ids out of order, so
+    an entry just past the cursor may still be followed by a lower id that
+    commits later; waiting until entries are `settle` seconds old keeps those
+    from being skipped as long as no transaction that writes the ledger runs
+    that long. With SQLite's single writer, ids commit in order and `settle=0`
+    is exact.
+    Returns {'entries', 'users', 'mismatched': [(chat_id, user_id), ...], 'checkpoints'}.
+    """
+    with get_db(readonly=True, shard=shard) as db:
+        position = db.scalar(select(JobCursor.position).where(JobCursor.name == LEDGER_RECONCILE_CURSOR)) or 0
+        unsettled = (select(func.min(LedgerEntry.id))
+                     .where(LedgerEntry.id > position, LedgerEntry.created_at > timestamps.now() - settle)
+                     .scalar_subquery())
+        window = (select(LedgerEntry.id)
+                  .where(LedgerEntry.id > position, or_(unsettled.is_(None), LedgerEntry.id < unsettled))
+                  .order_by(LedgerEntry.id).limit(batch).subquery())
+        entries, upper = db.execute(select(func.count(), func.max(window.c.id))).one()
+        if not entries:
+            return {'entries': 0, 'users': 0, 'mismatched': [], 'checkpoints': 0}
+
+        touched = (select(LedgerEntry.chat_id, LedgerEntry.user_id)
+                   .where(LedgerEntry.id > position, LedgerEntry.id <= upper).distinct())
+        latest = (select(BalanceCheckpoint.chat_id, BalanceCheckpoint.user_id,
+                         func.max(BalanceCheckpoint.ledger_id).label('ledger_id'))
+                  .where(tuple_(BalanceCheckpoint.chat_id, BalanceCheckpoint.user_id).in_(touched))
+                  .group_by(BalanceCheckpoint.chat_id, BalanceCheckpoint.user_id).subquery())
+        base = (select(User.chat_id, User.user_id, User.balance,
+                       func.coalesce(BalanceCheckpoint.ledger_id, 0).label('cp_id'),
+                       func.coalesce(BalanceCheckpoint.balance, 0).label('cp_balance'))
+                .outerjoin(latest, and_(latest.c.chat_id == User.chat_id, latest.c.user_id == User.user_id))
+                .outerjoin(BalanceCheckpoint, and_(BalanceCheckpoint.chat_id == latest.c.chat_id,
+                                                   BalanceCheckpoint.user_id == latest.c.user_id,
+                                                   BalanceCheckpoint.ledger_id == latest.c.ledger_id))
+                .where(tuple_(User.chat_id, User.user_id).in_(touched))
+                .subquery())
+        # One statement, so balances and ledger are read from the same snapshot
+        rows = db.execute(
+            select(base.c.chat_id, base.c.user_id, base.c.balance, base.c.cp_balance,
+                   func.coalesce(func.sum(LedgerEntry.amount), 0), func.count(LedgerEntry.id),
+                   func.max(LedgerEntry.id), func.max(LedgerEntry.created_at))
+            .outerjoin(LedgerEntry, and_(LedgerEntry.chat_id == base.c.chat_id,
+                                         LedgerEntry.user_id == base.c.user_id, LedgerEntry.id > base.c.cp_id))
+            .group_by(base.c.chat_id, base.c.user_id, base.c.balance, base.c.cp_balance)).all()
+
+    mismatched, checkpoints = [], []
+    for chat_id, user_id, balance, cp_balance, tail, count, last_id, last_at in rows:
+        ledger_balance = cp_balance + tail
+        if balance != ledger_balance:
+            mismatched.append((chat_id, user_id))
+            logger.error(f"Ledger mismatch for user {user_id} in chat {chat_id}: balance {balance}, "
+                         f"ledger says {ledger_balance}")
+        elif count >= checkpoint_every:
+            checkpoints.append({'chat_id': chat_id, 'user_id': user_id, 'ledger_id': last_id,
+                                'balance': ledger_balance, 'as_of': last_at})
+
+    with get_db(shard=shard) as db:
+        if checkpoints:
+            db.execute(_insert(db, BalanceCheckpoint).on_conflict_do_nothing(
+                index_elements=['chat_id', 'user_id', 'ledger_id']), checkpoints)
+        stmt = _insert(db, JobCursor)
+        db.execute(stmt.values(name=LEDGER_RECONCILE_CURSOR, position=upper)
+                   .on_conflict_do_update(index_elements=['name'], set_={'position': stmt.excluded.position}))
+        db.commit()
+    return {'entries': entries, 'users': len(rows), 'mismatched': mismatched, 'checkpoints': len(checkpoints)}
+
+# --- Archive Functions ---
+
+# bot_settings entry: the latest placed_at of any archived wager
+ARCHIVE_WATERMARK = 'archive_placed_at'
+
+# Archived bets are RESOLVED, so no expiry notice can be pending for them
+_BET_COLUMNS = [column.name for column in Bet.__table__.columns if column.name != 'expiry_pending']
+_WAGER_COLUMNS = [column.name for column in Wager.__table__.columns]
+
+def _archive_watermark(db):
+    value = db.scalar(select(BotSetting.value).where(BotSetting.name == ARCHIVE_WATERMARK))
+    return None if value is None else int(value)
+
+def archive_resolved_bets(before, batch=ARCHIVE_BATCH, shard=MAIN_SHARD):
+    """
+    Moves up to `batch` bets of a shard RESOLVED before `before` (an epoch), and
+    their wagers, into bets_archive and wagers_archive in one transaction. Their
+    pool totals move onto the archived bet; user_stats and the ledger keep
+    what they contributed, and wager ids are kept, so ledger ref_ids and
+    /history cursors still find them.
+    Returns {'bets': n, 'wagers': n} moved; fewer than `batch` bets means none are left.
+    """
+    with get_db(shard=shard) as db:
+        # SQLite hands out max(id) + 1 for new rows, so the bet holding the
+        # newest wager stays put, or archived wager ids could be reused (bet
+        # ids come from bet_routes, which keeps them all)
+        newest_wager = select(func.max(Wager.id)).scalar_subquery()
+        bet_ids = db.scalars(
+            select(Bet.id)
+            .where(Bet.status == 'RESOLVED', Bet.resolved_at < before,
+                   Bet.id != func.coalesce(select(Wager.bet_id).where(Wager.id == newest_wager).scalar_subquery(), 0))
+            .order_by(Bet.id)
+            .limit(batch)
+        ).all()
+        if not bet_ids:
+            return {'bets': 0, 'wagers': 0}
+
+        bets = (select(*(getattr(Bet, name) for name in _BET_COLUMNS),
+                       func.coalesce(BetPool.amount_a, 0), func.coalesce(BetPool.amount_b, 0),
+                       func.coalesce(BetPool.bettors_a, 0), func.coalesce(BetPool.bettors_b, 0))
+                .outerjoin(BetPool, BetPool.bet_id == Bet.id)
+                .where(Bet.id.in_(bet_ids)))
+        db.execute(insert(ArchivedBet).from_select(
+            _BET_COLUMNS + ['amount_a', 'amount_b', 'bettors_a', 'bettors_b'], bets))
+        wagers = select(*(getattr(Wager, name) for name in _WAGER_COLUMNS)).where(Wager.bet_id.in_(bet_ids))
+        db.execute(insert(ArchivedWager).from_select(_WAGER_COLUMNS, wagers))
+
+        newest_placed = db.scalar(select(func.max(ArchivedWager.placed_at)).where(ArchivedWager.bet_id.in_(bet_ids)))
+        moved = db.execute(delete(Wager).where(Wager.bet_id.in_(bet_ids))).rowcount
+        db.execute(delete(BetPoolEntry).where(BetPoolEntry.bet_id.in_(bet_ids)))
+        db.execute(delete(BetPool).where(BetPool.bet_id.in_(bet_ids)))
+        db.execute(delete(Bet).where(Bet.id.in_(bet_ids)))
+
+        watermark = _archive_watermark(db)
+        if newest_placed is not None and (watermark is None or newest_placed > watermark):
+            _set_setting(db, ARCHIVE_WATERMARK, str(newest_placed))
+        db.commit()
+    return {'bets': len(bet_ids), 'wagers': moved}
+
+@contextmanager
+def _sqlite_maintenance_cursor(shard):
+    """A raw cursor on the shard's writer connection, outside any transaction, for PRAGMAs and VACUUM."""
+    with shards[shard].writer_turn or contextlib.nullcontext():
+        conn = shards[shard].engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            yield cursor
+            cursor.close()
+        finally:
+            conn.close()
+
+def reclaim_space(pages=ARCHIVE_VACUUM_PAGES, shard=MAIN_SHARD):
+    """
+    Gives the space freed by archiving back after a run. SQLite files in
+    auto_vacuum=INCREMENTAL mode (new files, or older ones after
+    vacuum_database) return up to `pages` free pages to the filesystem;
+    elsewhere freed pages are simply reused for new rows. PostgreSQL gets a
+    VACUUM ANALYZE of the hot tables. Returns the number of pages released
+    (0 when there is nothing to do on SQLite, None on PostgreSQL).
+    """
+    shard_engine = shards[shard].engine
+    if shard_engine.dialect.name == 'postgresql':
+        # VACUUM can't run inside a transaction block
+        with shard_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM (ANALYZE) wagers, bets, bet_pools, bet_pool_entries"))
+        return None
+    with _sqlite_maintenance_cursor(shard) as cursor:
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        free = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        # Every step of incremental_vacuum frees one page: executescript runs it
+        # to the end, execute() would stop after the first
+        cursor.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return free - cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+def vacuum_database(shard=MAIN_SHARD):
+    """
+    Rewrites a shard's SQLite file compactly and switches it to auto_vacuum=INCREMENTAL,
+    which a file created before that pragma needs once. Takes the write lock for
+    as long as rewriting the whole file takes.
+    """
+    with _sqlite_maintenance_cursor(shard) as cursor:
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cursor.execute("VACUUM")
+
+# --- Outbox Functions ---
+
+def enqueue_outbox(messages):
+    """
+    Persists outgoing messages for the dispatcher.
+    messages: [{'chat_id': int, 'text': str, 'parse_mode': str|None}, ...]
+    """
+    if not messages:
+        return 0
+    now = timestamps.now()
     with get_db() as db:
-        bet = db.query(Bet).with_for_update().filter(Bet.id == bet_id).first()
-        if not bet:
-            return False, "Bet not found", []
-        
-        if bet.status == 'RESOLVED':
-            return False, "Bet already resolved", []
-
-        wagers = db.query(Wager).filter(Wager.bet_id == bet_id).all()
-        valid_wagers = []
-        refund_count = 0
-        refund_gross = 0
-
-        cutoff_val = None
-        if cutoff_dt:
-            cutoff_val = cutoff_dt.isoformat() if isinstance(cutoff_dt, datetime) else cutoff_dt
-
-        for w in wagers:
-            if w.refunded:
-                continue
-            
-            should_keep = True
-            if cutoff_val and w.placed_at and w.placed_at > cutoff_val:
-                should_keep = False
-            
-            if should_keep:
-                valid_wagers.append(w)
-            else:
-                w.user.balance += w.amount
-                w.refunded = 1
-                refund_count += 1
-                refund_gross += w.amount
-
-        total_pool = sum(w.amount for w in valid_wagers)
-        winning_wagers = [w for w in valid_wagers if w.choice == outcome]
-        winning_pool = sum(w.amount for w in winning_wagers)
-
-        bet.status = 'RESOLVED'
-        bet.outcome = outcome
-        bet.resolved_at = datetime.now().isoformat()
-        if cutoff_val:
-            bet.cutoff_at = cutoff_val
-
-        msg_prefix = ""
-        if refund_count > 0:
-            msg_prefix = f"⚠️ Refunded {refund_count} wagers ({refund_gross}) after cutoff.\n"
-
-        winners_list = []
-
-        if winning_pool == 0:
-            for w in valid_wagers:
-                w.user.balance += w.amount
-                w.refunded = 1
-            
-            db.commit()
-            return True, f"{msg_prefix}No winners. All refunded.", []
-
-        ratio = total_pool / winning_pool
-        count = 0
-        
-        for w in winning_wagers:
-            payout = int(w.amount * ratio)
-            w.user.balance += payout
-            w.payout = payout
-            
-            profit = payout - w.amount
-            winners_list.append({
-                'user_id': w.user_id,
-                'payout': payout,
-                'profit': profit
-            })
-            count += 1
-
-        for w in valid_wagers:
-            if w.choice != outcome:
-                w.payout = 0
+        db.execute(insert(OutboxMessage), [{
+            'chat_id': m['chat_id'], 'text': m['text'], 'parse_mode': m.get('parse_mode'),
+            'attempts': 0, 'next_attempt_at': now, 'created_at': now
+        } for m in messages])
+        db.commit()
+    return len(messages)
 
+def get_due_outbox(limit=500):
+    """
+    Returns up to `limit` outbox messages that are due for (re)delivery, oldest
+    first. A message waiting for a retry holds back the later ones to its chat,
+    so each chat's messages go out in order.
+    """
+    now = timestamps.now()
+    earlier = aliased(OutboxMessage)
+    waiting_before = (select(earlier.id)
+                      .where(earlier.chat_id == OutboxMessage.chat_id, earlier.id < OutboxMessage.id,
+                             earlier.next_attempt_at > now)
+                      .exists())
+    with get_db(readonly=True) as db:
+        rows = (db.query(OutboxMessage)
+                .filter(OutboxMessage.next_attempt_at <= now, ~waiting_before)
+                .order_by(OutboxMessage.id)
+                .limit(limit)
+                .all())
+        return [{
+            'id': m.id, 'chat_id': m.chat_id, 'text': m.text,
+            'parse_mode': m.parse_mode, 'attempts': m.attempts
+        } for m in rows]
+
+def delete_outbox(message_ids):
+    """Removes delivered (or abandoned) messages from the outbox."""
+    if not message_ids:
+        return
+    with get_db() as db:
+        db.query(OutboxMessage).filter(OutboxMessage.id.in_(message_ids)).delete(synchronize_session=False)
         db.commit()
-        return True, f"{msg_prefix}Resolved {outcome}. {count} winners (x{ratio:.2f}).", winners_list
 
-def get_user_history(user_id, limit=10):
-    """Returns the most recent resolved wagers for a user."""
+def retry_outbox_later(message_id, delay_seconds):
+    """Records a failed delivery attempt and pushes the message back by `delay_seconds`."""
+    # Rounded up, so a retry never comes early
+    next_attempt = timestamps.now() + math.ceil(delay_seconds)
     with get_db() as db:
-        wagers = (db.query(Wager)
-                  .join(Bet)
-                  .filter(Wager.user_id == user_id, Bet.status == 'RESOLVED')
-                  .order_by(Wager.placed_at.desc())
-                  .limit(limit)
-                  .all())
-        
-        history = []
-        for w in wagers:
-            wager_info = {
-                'bet_id': w.bet.id,
-                'description': w.bet.description,
-                'amount': w.amount,
-                'choice': w.choice,
-                'outcome': w.bet.outcome,
-                'payout': w.payout or 0,
-                'refunded': w.refunded
-            }
-            history.append(wager_info)
-        return history
+        db.query(OutboxMessage).filter(OutboxMessage.id == message_id).update({
+            OutboxMessage.attempts: OutboxMessage.attempts + 1,
+            OutboxMessage.next_attempt_at: next_attempt,
+        }, synchronize_session=False)
+        db.commit()
 
-def get_leaderboard_data():
+# --- Bot State Functions (see persistence.py) ---
+
+def load_conversations(name):
+    """Returns {key_json: state_json} for the ConversationHandler called `name`."""
+    with get_db(readonly=True) as db:
+        return dict(db.execute(select(ConversationState.key, ConversationState.state)
+                               .where(ConversationState.name == name)).all())
+
+def load_user_data():
+    """Returns {user_id: pickled user_data} for every user with stored data."""
+    with get_db(readonly=True) as db:
+        return dict(db.execute(select(UserData.user_id, UserData.data)).all())
+
+def load_update_state(conversations, user_id):
+    """
+    The stored state of one update, for workers that share the database:
+    ({(name, key_json): state_json} of those `conversations` that have a state,
+    pickled user_data of `user_id` or None).
+    """
+    with get_db(readonly=True) as db:
+        states = {}
+        if conversations:
+            rows = db.execute(select(ConversationState.name, ConversationState.key, ConversationState.state)
+                              .where(tuple_(ConversationState.name, ConversationState.key).in_(conversations)))
+            states = {(name, key): state for name, key, state in rows}
+        data = None
+        if user_id is not None:
+            data = db.scalar(select(UserData.data).where(UserData.user_id == user_id))
+        return states, data
+
+def save_bot_state(conversations, user_data):
+    """
+    Writes a batch of persistence changes in one transaction.
+    conversations: {(name, key_json): state_json, or None to delete}
+    user_data: {user_id: pickled data, or None to delete}
+    """
     with get_db() as db:
-        users = db.query(User).all()
-        stats = {}
-        
-        for u in users:
-            stats[u.user_id] = {
-                'username': u.username,
-                'net_profit': 0, 'bets_placed': 0, 'bets_won': 0
-            }
+        upserts = [{'name': name, 'key': key, 'state': state}
+                   for (name, key), state in conversations.items() if state is not None]
+        if upserts:
+            stmt = _insert(db, ConversationState)
+            db.execute(stmt.on_conflict_do_update(index_elements=['name', 'key'],
+                                                  set_={'state': stmt.excluded.state}), upserts)
+        ended = [{'n': name, 'k': key} for (name, key), state in conversations.items() if state is None]
+        if ended:
+            table = ConversationState.__table__
+            db.execute(delete(table).where(table.c.name == bindparam('n'), table.c.key == bindparam('k')), ended)
+
+        upserts = [{'user_id': uid, 'data': data} for uid, data in user_data.items() if data is not None]
+        if upserts:
+            stmt = _insert(db, UserData)
+            db.execute(stmt.on_conflict_do_update(index_elements=['user_id'],
+                                                  set_={'data': stmt.excluded.data}), upserts)
+        dropped = [uid for uid, data in user_data.items() if data is None]
+        if dropped:
+            db.execute(delete(UserData).where(UserData.user_id.in_(dropped)))
+        db.commit()
+
+# --- Settings Functions ---
+
+def get_setting(name):
+    """Returns the stored value of a bot setting, or None."""
+    with get_db(readonly=True) as db:
+        return db.scalar(select(BotSetting.value).where(BotSetting.name == name))
+
+def _set_setting(db, name, value):
+    stmt = _insert(db, BotSetting)
+    db.execute(stmt.values(name=name, value=value)
+               .on_conflict_do_update(index_elements=['name'], set_={'value': stmt.excluded.value}))
+
+def set_setting(name, value):
+    with get_db() as db:
+        _set_setting(db, name, value)
+        db.commit()
+
+# --- Lease Functions (see leader.py) ---
+
+def acquire_lease(name, holder, seconds):
+    """
+    Takes the lease `name` for `holder`, or renews it, for `seconds` from now,
+    unless another holder's lease has not expired yet. Returns True if
+    `holder` holds the lease afterwards.
+    """
+    now = timestamps.now()
+    with get_db() as db:
+        stmt = _insert(db, Lease).values(name=name, holder=holder, acquired_at=now, expires_at=now + seconds)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=['name'],
+            set_={
+                'holder': stmt.excluded.holder,
+                'acquired_at': case((Lease.holder == stmt.excluded.holder, Lease.acquired_at),
+                                    else_=stmt.excluded.acquired_at),
+                'expires_at': stmt.excluded.expires_at,
+            },
+            where=or_(Lease.holder == holder, Lease.expires_at <= now),
+        ))
+        current = db.scalar(select(Lease.holder).where(Lease.name == name))
+        db.commit()
+    return current == holder
+
+def release_lease(name, holder):
+    """Gives up `holder`'s lease, so another worker can take it right away."""
+    with get_db() as db:
+        db.execute(update(Lease).where(Lease.name == name, Lease.holder == holder).values(expires_at=0))
+        db.commit()
 
-        bets = db.query(Bet).filter(Bet.status == 'RESOLVED').all()
-        
-        for bet in bets:
-            outcome = bet.outcome
-            wagers = [w for w in bet.wagers if not w.refunded]
-            if not wagers: continue
-
-            total_pool = sum(w.amount for w in wagers)
-            winning_wagers = [w for w in wagers if w.choice == outcome]
-            winning_pool = sum(w.amount for w in winning_wagers)
-            
-            if winning_pool == 0: continue
-            
-            ratio = total_pool / winning_pool
-
-            for w in wagers:
-                if w.user_id not in stats: continue
-                
-                s = stats[w.user_id]
-                s['bets_placed'] += 1
-                
-                if w.choice == outcome:
-                    payout = int(w.amount * ratio)
-                    profit = payout - w.amount
-                    s['bets_won'] += 1
-                    s['net_profit'] += profit
-                else:
-                    s['net_profit'] -= w.amount
-
-        active_stats = [s for s in stats.values() if s['bets_placed'] > 0]
-        winners = sorted(active_stats, key=lambda x: x['net_profit'], reverse=True)
-        losers = sorted(active_stats, key=lambda x: x['net_profit'])
-
-        return winners, losers
+def get_lease(name):
+    """{'holder', 'acquired_at', 'expires_at'} of the lease `name`, or None if nobody ever took it."""
+    with get_db(readonly=True) as db:
+        lease = db.get(Lease, name)
+        if lease is None:
+            return None
+        return {'holder': lease.holder, 'acquired_at': lease.acquired_at, 'expires_at': lease.expires_at}
@@ -0,0 +1,194 @@
+"""
+Outbound message dispatcher.
+
+Notifications (winner payouts, expired-bet alerts) are written to the outbox
+table first and delivered by a background task, so a command that notifies
+hundreds of users returns immediately and a restart does not lose anything
+still queued. Delivery runs concurrently within Telegram's limits: a global
+messages-per-second budget plus a minimum interval per chat. Messages to the
+same chat are sent in order. RetryAfter pauses all sending for the requested
+time; other failures are retried with backoff up to OUTBOX_MAX_ATTEMPTS, and
+hold back the later messages to that chat until the retry has gone out (or
+been given up).
+Delivery is at-least-once: a crash between sending and deleting the outbox
+row resends that message on the next start.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import shekkle_bot.database as db
+from shekkle_bot.config import (
+    OUTBOX_GLOBAL_RATE, OUTBOX_PRIVATE_CHAT_INTERVAL, OUTBOX_GROUP_CHAT_INTERVAL,
+    OUTBOX_CONCURRENCY, OUTBOX_MAX_ATTEMPTS, MULTI_WORKER,
+)
+
+logger = logging.getLogger(__name__)
+
+# How often the dispatcher looks for retries that became due without being woken.
+# With MULTI_WORKER, messages queued by the other workers are only found this way.
+POLL_INTERVAL = 0.5 if MULTI_WORKER else 5.0
+# How often delivered message ids are flushed from the outbox
+FLUSH_INTERVAL = 0.5
+
+def _seconds(value):
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+class RateLimiter:
+    """Spaces sends to respect a global rate and a per-chat minimum interval."""
+
+    def __init__(self, global_rate, private_interval, group_interval):
+        self._global_interval = 1.0 / global_rate
+        self._private_interval = private_interval
+        self._group_interval = group_interval
+        self._next_global = 0.0
+        self._next_chat = {}
+        self._paused_until = 0.0
+
+    def pause(self, seconds):
+        """Stops all sending for `seconds` (used for RetryAfter)."""
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+
+    async def wait(self, chat_id):
+        """Waits until a message may be sent to `chat_id` and reserves that slot."""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            delay = max(self._paused_until, self._next_global, self._next_chat.get(chat_id, 0.0)) - now
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        # Group and channel ids are negative
+        interval = self._group_interval if chat_id < 0 else self._private_interval
+        self._next_global = max(self._next_global, now) + self._global_interval
+        self._next_chat[chat_id] = now + interval
+        if len(self._next_chat) > 10000:
+            self._next_chat = {c: t for c, t in self._next_chat.items() if t > now}
+
+class MessageDispatcher:
+    def __init__(self):
+        self._bot = None
+        self._task = None
+        self._wakeup = None
+        self._limiter = RateLimiter(OUTBOX_GLOBAL_RATE, OUTBOX_PRIVATE_CHAT_INTERVAL, OUTBOX_GROUP_CHAT_INTERVAL)
+        self._slots = None
+        # Ids being sent, or sent but not yet deleted from the outbox
+        self._in_flight = set()
+        self._active_chats = {}
+        self._delivered = set()
+
+    def start(self, bot):
+        """Starts delivering with `bot`; picks up anything left in the outbox."""
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the dispatcher. Undelivered messages stay in the outbox."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._active_chats.values(), return_exceptions=True)
+            self._task = None
+        await self._flush_delivered()
+
+    async def enqueue(self, messages):
+        """
+        Queues messages for delivery and returns once they are persisted.
+        messages: [{'chat_id': int, 'text': str, 'parse_mode': str|None}, ...]
+        """
+        count = await db.run_async(db.enqueue_outbox, messages)
+        if self._wakeup:
+            self._wakeup.set()
+        return count
+
+    def is_idle(self):
+        """True when nothing is being sent or waiting to be cleared from the outbox."""
+        return not self._in_flight
+
+    async def _run(self):
+        while True:
+            try:
+                await self._flush_delivered()
+                due = await db.run_async(db.get_due_outbox)
+                by_chat = {}
+                for message in due:
+                    if message['id'] not in self._in_flight:
+                        by_chat.setdefault(message['chat_id'], []).append(message)
+                for chat_id, messages in by_chat.items():
+                    if chat_id in self._active_chats:
+                        continue
+                    self._in_flight.update(m['id'] for m in messages)
+                    self._active_chats[chat_id] = asyncio.create_task(self._drain_chat(chat_id, messages))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Dispatcher loop error: {e}")
+
+            self._wakeup.clear()
+            timeout = FLUSH_INTERVAL if self._in_flight or self._delivered else POLL_INTERVAL
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _drain_chat(self, chat_id, messages):
+        try:
+            for message in messages:
+                # The rest wait for the retry, which get_due_outbox holds them back for
+                if not await self._deliver(message):
+                    break
+        finally:
+            # Delivered ids stay in flight until their outbox rows are deleted,
+            # so the next poll cannot pick them up again.
+            for message in messages:
+                if message['id'] not in self._delivered:
+                    self._in_flight.discard(message['id'])
+            self._active_chats.pop(chat_id, None)
+            self._wakeup.set()
+
+    async def _deliver(self, message):
+        """Sends one message. Returns False if it was put back for a later retry."""
+        while True:
+            await self._limiter.wait(message['chat_id'])
+            try:
+                async with self._slots:
+                    await self._bot.send_message(
+                        chat_id=message['chat_id'], text=message['text'], parse_mode=message['parse_mode']
+                    )
+                self._delivered.add(message['id'])
+                return True
+            except RetryAfter as e:
+                retry_after = _seconds(e.retry_after)
+                logger.warning(f"Flood control: pausing outbound messages for {retry_after}s")
+                self._limiter.pause(retry_after)
+            except (Forbidden, BadRequest) as e:
+                # Blocked by the user, chat gone, malformed text: retrying will not help
+                logger.warning(f"Dropping message to {message['chat_id']}: {e}")
+                self._delivered.add(message['id'])
+                return True
+            except Exception as e:
+                attempts = message['attempts'] + 1
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    logger.warning(f"Giving up on message to {message['chat_id']} after {attempts} attempts: {e}")
+                    self._delivered.add(message['id'])
+                    return True
+                logger.warning(f"Failed to send to {message['chat_id']} (attempt {attempts}): {e}")
+                await db.run_async(db.retry_outbox_later, message['id'], 2 ** attempts * 5)
+                return False
+
+    async def _flush_delivered(self):
+        if not self._delivered:
+            return
+        ids, self._delivered = list(self._delivered), set()
+        try:
+            await db.run_async(db.delete_outbox, ids)
+        except Exception:
+            self._delivered.update(ids)
+            raise
+        self._in_flight.difference_update(ids)
+
+dispatcher = MessageDispatcher()
@@ -1,6 +1,8 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 import shekkle_bot.database as db
+from shekkle_bot.concurrency import locks, user_key, bet_key
+from shekkle_bot.dispatcher import dispatcher
 from shekkle_bot.config import ADMIN_IDS
 from datetime import datetime
 import logging
@@ -47,29 +49,74 @@ async def resolve(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
     # Call DB resolve
-    success, message, winners_list = db.resolve_bet(bet_id, outcome, cutoff_dt)
+    # Waits for wagers on this bet that are in flight
+    async with locks.hold(bet_key(bet_id)):
+        success, message, winners_list = await db.run_async(db.resolve_bet, bet_id, outcome, cutoff_dt)
     await update.message.reply_text(message)
 
     if success and winners_list:
-        # Notify winners
-        for winner in winners_list:
-            uid = winner['user_id']
-            payout = winner['payout']
-            profit = winner['profit']
-            
-            msg = (
-                f"🎉 <b>Bet Won!</b> 🎉\n"
-                f"You bet on the winning outcome for Bet #{bet_id}.\n"
-                f"Payout: {payout} (+{profit} profit)"
-            )
-            try:
-                await context.bot.send_message(chat_id=uid, text=msg, parse_mode='HTML')
-            except Exception as e:
-                logger.warning(f"Failed to notify user {uid}: {e}")
+        # Notify winners through the outbox; delivery happens in the background
+        await dispatcher.enqueue(winner_notifications(bet_id, winners_list))
+
+async def resolve_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Admin command to resolve several bets at once, in a single transaction.
+    Usage: /resolvebatch <bet_id>:<A/B> [<bet_id>:<A/B> ...]
+    """
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ You are not authorized to use this command.")
+        return
+
+    usage = "Usage: /resolvebatch <bet_id>:<A/B> [<bet_id>:<A/B> ...]"
+    if not context.args:
+        await update.message.reply_text(usage)
+        return
+
+    resolutions = []
+    for arg in context.args:
+        bet_id_str, _, outcome = arg.partition(':')
+        outcome = outcome.upper()
+        if not bet_id_str.isdigit() or outcome not in ('A', 'B'):
+            await update.message.reply_text(f"Error: Invalid entry '{arg}'.\n{usage}")
+            return
+        resolutions.append((int(bet_id_str), outcome))
+
+    async with locks.hold(*(bet_key(bet_id) for bet_id, _ in resolutions)):
+        success, messages, winners = await db.run_async(db.resolve_bets, resolutions)
+    if not success:
+        bet_id, message = messages[0]
+        where = f" (Bet #{bet_id})" if bet_id is not None else ""
+        await update.message.reply_text(f"❌ Nothing was resolved{where}: {message}")
+        return
+
+    await update.message.reply_text("\n".join(f"Bet #{bet_id}: {message}" for bet_id, message in messages))
+
+    notifications = []
+    for bet_id, winners_list in winners.items():
+        notifications.extend(winner_notifications(bet_id, winners_list))
+    if notifications:
+        await dispatcher.enqueue(notifications)
+
+def winner_notifications(bet_id, winners_list):
+    """Outbox messages telling each winner of `bet_id` their payout."""
+    notifications = []
+    for winner in winners_list:
+        uid = winner['user_id']
+        payout = winner['payout']
+        profit = winner['profit']
+
+        msg = (
+            f"🎉 <b>Bet Won!</b> 🎉\n"
+            f"You bet on the winning outcome for Bet #{bet_id}.\n"
+            f"Payout: {payout} (+{profit} profit)"
+        )
+        notifications.append({'chat_id': uid, 'text': msg, 'parse_mode': 'HTML'})
+    return notifications
 
 async def add_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Admin command to add funds to a user.
+    Admin command to add funds to a user's balance in this chat.
     Usage: /give <user_id|@username> <amount>
     """
     user_id = update.effective_user.id
@@ -83,6 +130,7 @@ async def add_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     target_user_str = context.args[0]
     amount_str = context.args[1]
+    chat_id = update.effective_chat.id
 
     try:
         amount = int(amount_str)
@@ -93,20 +141,21 @@ async def add_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if target is a username or ID
     target_user_id = None
     if target_user_str.startswith('@') or not target_user_str.isdigit():
-        user_obj = db.get_user_by_username(target_user_str)
+        user_obj = await db.run_async(db.get_user_by_username, chat_id, target_user_str)
         if user_obj:
             target_user_id = user_obj.user_id
         else:
-            await update.message.reply_text(f"❌ User {target_user_str} not found in DB.")
+            await update.message.reply_text(f"❌ User {target_user_str} not found in this chat.")
             return
     else:
         target_user_id = int(target_user_str)
-        user_obj = db.get_user(target_user_id)
+        user_obj = await db.run_async(db.get_user, chat_id, target_user_id)
         if not user_obj:
-            await update.message.reply_text(f"❌ User ID {target_user_id} not found in DB.")
+            await update.message.reply_text(f"❌ User ID {target_user_id} not found in this chat.")
             return
 
-    success = db.update_balance(target_user_id, amount)
+    async with locks.hold(user_key(target_user_id)):
+        success = await db.run_async(db.update_balance, chat_id, target_user_id, amount, 'give', user_id)
     
     if success:
         await update.message.reply_text(f"✅ Successfully added {amount} shekkles to {target_user_str}.")
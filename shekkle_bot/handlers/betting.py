@@ -11,7 +11,12 @@ from telegram.ext import (
     CallbackQueryHandler,
 )
 import shekkle_bot.database as db
+from shekkle_bot import jobs
+from shekkle_bot.concurrency import locks, user_key, bet_key
+from shekkle_bot.leader import election
 from shekkle_bot.config import CURRENCY_NAME, DEFAULT_WAGER_AMOUNT
+from shekkle_bot.timestamps import format_local
+from shekkle_bot.handlers.general import economy_unassigned_text
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -19,6 +24,9 @@ logger = logging.getLogger(__name__)
 # Stages
 DESCRIPTION, DEADLINE, OPTION_A, OPTION_B = range(4)
 
+# Bettors named per side in the "View Bets" status message
+BETTORS_LISTED = 20
+
 async def create_bet_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Starts the conversation and asks for the bet description."""
     await update.message.reply_text(
@@ -83,22 +91,29 @@ async def receive_option_b(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Create bet in DB
     user = update.effective_user
-    # Ensure deadline is stored as ISO format string for consistency
+    # A local datetime; create_bet stores it as a UTC epoch
     deadline_val = context.user_data['deadline']
-    if isinstance(deadline_val, datetime):
-        deadline_str = deadline_val.isoformat()
-    else:
-        deadline_str = str(deadline_val)
-
-    new_id = db.create_bet(
-        user.id,
-        context.user_data['description'],
-        deadline_str,
-        context.user_data['option_a'],
-        context.user_data['option_b']
-    )
+
+    try:
+        new_id = await db.run_async(
+            db.create_bet,
+            update.effective_chat.id,
+            user.id,
+            context.user_data['description'],
+            deadline_val,
+            context.user_data['option_a'],
+            context.user_data['option_b']
+        )
+    except db.EconomyUnassigned:
+        await update.message.reply_text(economy_unassigned_text(update.effective_chat.id))
+        context.user_data.clear()
+        return ConversationHandler.END
     
     if new_id:
+        # Other workers leave the timer to the leader, which picks up new deadlines by itself
+        if context.job_queue and election.is_leader:
+            jobs.schedule_deadline(context.job_queue, deadline_val)
+
         keyboard = [
             [
                 InlineKeyboardButton(f"Bet {DEFAULT_WAGER_AMOUNT} {CURRENCY_NAME} on {context.user_data['option_a']}", callback_data=f"wager:{new_id}:A"),
@@ -141,32 +156,35 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def list_bets(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Lists all open bets with pagination."""
-    bets = db.get_open_bets()
-    if not bets:
+    """Lists the chat's open bets with pagination."""
+    page = await db.run_async(db.get_open_bet_page, update.effective_chat.id)
+    if not page:
         await update.message.reply_text("There are currently no open bets.")
         return
 
-    # Call the helper to show the first bet (index 0)
-    await send_bet_page(update.message.reply_text, bets, 0)
-
-async def send_bet_page(send_method, bets, index):
-    bet = bets[index]
+    # Call the helper to show the first bet
+    await send_bet_page(update.message.reply_text, page, 1)
+
+async def send_bet_page(send_method, page, position):
+    bet = page['bet']
+    count = page['count']
+    # The position travels in the callback data and may drift as bets close
+    if page['prev_id'] is None:
+        position = 1
+    elif page['next_id'] is None:
+        position = count
+    position = max(1, min(position, count))
     
-    try:
-        d_str = bet['deadline']
-        if 'T' in d_str:
-            d_str = d_str.replace('T', ' ')
-    except:
-        d_str = str(bet['deadline'])
+    d_str = format_local(bet['deadline'])
 
     # Build navigation buttons at the top or bottom
+    # Callback data carries the neighbour's bet id (keyset) and its display position
     nav_buttons = []
-    if index > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"page_bet:{index-1}"))
-    nav_buttons.append(InlineKeyboardButton(f"{index+1}/{len(bets)}", callback_data="ignore"))
-    if index < len(bets) - 1:
-        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"page_bet:{index+1}"))
+    if page['prev_id'] is not None:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"page_bet:{page['prev_id']}:{position-1}"))
+    nav_buttons.append(InlineKeyboardButton(f"{position}/{count}", callback_data="ignore"))
+    if page['next_id'] is not None:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"page_bet:{page['next_id']}:{position+1}"))
 
     keyboard = [
         nav_buttons,
@@ -200,20 +218,21 @@ async def bet_page_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer()
         return
         
-    _, index_str = query.data.split(':')
-    index = int(index_str)
+    # page_bet:{bet_id}:{position}. Buttons from before keyset paging
+    # (page_bet:{index}) restart at the first bet.
+    parts = query.data.split(':')
+    if len(parts) == 3:
+        bet_id, position = int(parts[1]), int(parts[2])
+    else:
+        bet_id, position = None, 1
     
-    bets = db.get_open_bets()
-    if not bets:
+    page = await db.run_async(db.get_open_bet_page, update.effective_chat.id, bet_id)
+    if not page:
         await query.edit_message_text("There are currently no open bets.")
         return
-
-    # Bound check
-    if index < 0 or index >= len(bets):
-        index = 0
         
     await query.answer()
-    await send_bet_page(query.edit_message_text, bets, index)
+    await send_bet_page(query.edit_message_text, page, position)
 
 async def wager_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles wager button clicks."""
@@ -223,11 +242,18 @@ async def wager_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     bet_id = int(bet_id_str)
     user = update.effective_user
 
-    # Ensure user exists
-    if not db.get_user(user.id):
-        db.add_user(user.id, user.username)
-
-    success, message = db.place_wager(user.id, bet_id, choice, DEFAULT_WAGER_AMOUNT)
+    # Registers the user on their first wager
+    try:
+        async with locks.hold(user_key(user.id), bet_key(bet_id)):
+            success, message = await db.run_async(
+                db.place_wager, update.effective_chat.id, user.id, bet_id, choice, DEFAULT_WAGER_AMOUNT,
+                register=True, username=user.username
+            )
+    except db.EconomyUnassigned:
+        # Too long for an alert
+        await query.answer()
+        await query.message.reply_text(economy_unassigned_text(update.effective_chat.id))
+        return
 
     if success:
         await query.answer(f"✅ Wagered {DEFAULT_WAGER_AMOUNT} {CURRENCY_NAME} on #{bet_id} Choice {choice}.")
@@ -258,11 +284,16 @@ async def wager(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Amount must be positive.")
         return
 
-    # Ensure user exists (in case they haven't started user flow yet)
-    if not db.get_user(user.id):
-        db.add_user(user.id, user.username)
-
-    success, message = db.place_wager(user.id, bet_id, choice, amount)
+    # Registers the user in case they haven't started user flow yet
+    try:
+        async with locks.hold(user_key(user.id), bet_key(bet_id)):
+            success, message = await db.run_async(
+                db.place_wager, update.effective_chat.id, user.id, bet_id, choice, amount,
+                register=True, username=user.username
+            )
+    except db.EconomyUnassigned:
+        await update.message.reply_text(economy_unassigned_text(update.effective_chat.id))
+        return
     
     if success:
         await update.message.reply_text(f"✅ {message}\nWagered {amount} {CURRENCY_NAME} on #{bet_id} Choice {choice}.")
@@ -283,19 +314,14 @@ async def view_bets_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Acknowledge callback immediately
     await query.answer()
 
-    bet = db.get_bet(bet_id)
+    # Pool totals come pre-aggregated; only the biggest bettors per side are listed
+    bet = await db.run_async(db.get_bet_status, update.effective_chat.id, bet_id, BETTORS_LISTED)
     if not bet:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="Bet not found or deleted.")
         return
 
-    wagers = db.get_bet_wagers(bet_id)
-    
-    # Organize wagers by choice
-    pool_a_list = [w for w in wagers if w['choice'] == 'A']
-    pool_b_list = [w for w in wagers if w['choice'] == 'B']
-    
-    amount_a = sum(w['amount'] for w in pool_a_list)
-    amount_b = sum(w['amount'] for w in pool_b_list)
+    amount_a = bet['amount_a']
+    amount_b = bet['amount_b']
     total_pool = amount_a + amount_b
 
     # Calculate theoretical multipliers (Total / Side)
@@ -305,7 +331,7 @@ async def view_bets_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Format wagers list
     # We must escape names too as they can contain html chars
-    def format_wager_list(w_list):
+    def format_wager_list(w_list, bettors):
         if not w_list:
             return "None"
         formatted_entries = []
@@ -314,10 +340,12 @@ async def view_bets_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             safe_name = html.escape(raw_name)
             # escape amount just in case? Numbers are safe though.
             formatted_entries.append(f"{safe_name} ({w['amount']})")
+        if bettors > len(w_list):
+            formatted_entries.append(f"+{bettors - len(w_list)} more")
         return ", ".join(formatted_entries)
 
-    bets_a_str = format_wager_list(pool_a_list)
-    bets_b_str = format_wager_list(pool_b_list)
+    bets_a_str = format_wager_list(bet['top_a'], bet['bettors_a'])
+    bets_b_str = format_wager_list(bet['top_b'], bet['bettors_b'])
 
     # Escape bet details
     desc = html.escape(bet['description'])
@@ -355,4 +383,6 @@ createbet_conv_handler = ConversationHandler(
         OPTION_B: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_option_b)],
     },
     fallbacks=[CommandHandler("cancel", cancel)],
+    name="createbet",
+    persistent=True,
 )
@@ -1,17 +1,40 @@
-from telegram import Update
+import html
+import logging
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
 import shekkle_bot.database as db
+from shekkle_bot.concurrency import locks, user_key
 from shekkle_bot.config import DAILY_REWARD
 
+logger = logging.getLogger(__name__)
+
+def economy_unassigned_text(chat_id):
+    """
+    What the admin has to do when the database refuses to start an economy in
+    `chat_id` (db.EconomyUnassigned) while the balances from before per-chat
+    economies wait for their group.
+    """
+    return (
+        "⚠️ The balances from before this bot kept one economy per chat haven't been assigned to a chat yet. "
+        "If they belong to this one, an admin has to run:\n"
+        f"python -m shekkle_bot.manage move-chat {db.LEGACY_CHAT_ID} {chat_id}"
+    )
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user:
         return
+    # Every chat has its own economy
+    chat_id = update.effective_chat.id
 
     # Ensure user is in DB
-    db.add_user(user.id, user.username)
+    try:
+        await db.run_async(db.add_user, chat_id, user.id, user.username)
+    except db.EconomyUnassigned:
+        await update.message.reply_text(economy_unassigned_text(chat_id))
+        return
     
-    user_obj = db.get_user(user.id)
+    user_obj = await db.run_async(db.get_user, chat_id, user.id)
     balance = user_obj.balance if user_obj else 0
     
     await update.message.reply_text(
@@ -22,15 +45,20 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user:
         return
+    chat_id = update.effective_chat.id
         
-    user_obj = db.get_user(user.id)
+    user_obj = await db.run_async(db.get_user, chat_id, user.id)
     
     if user_obj:
         await update.message.reply_text(f"Your current balance: {user_obj.balance} Shekkles")
     else:
         # If user not found, add them
-        db.add_user(user.id, user.username)
-        user_obj = db.get_user(user.id)
+        try:
+            await db.run_async(db.add_user, chat_id, user.id, user.username)
+        except db.EconomyUnassigned:
+            await update.message.reply_text(economy_unassigned_text(chat_id))
+            return
+        user_obj = await db.run_async(db.get_user, chat_id, user.id)
         if user_obj:
             await update.message.reply_text(f"Your current balance: {user_obj.balance} Shekkles")
         else:
@@ -40,38 +68,54 @@ async def daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user:
         return
+    chat_id = update.effective_chat.id
     
-    # Ensure user exists first
-    if not db.get_user(user.id):
-        db.add_user(user.id, user.username)
+    # One /daily at a time per user, even if sent from several chats at once
+    async with locks.hold(user_key(user.id)):
+        # Ensure user exists first
+        if not await db.run_async(db.get_user, chat_id, user.id):
+            try:
+                await db.run_async(db.add_user, chat_id, user.id, user.username)
+            except db.EconomyUnassigned:
+                await update.message.reply_text(economy_unassigned_text(chat_id))
+                return
+
+        new_balance = None
+        if await db.run_async(db.check_daily_claim, chat_id, user.id):
+            # Checks eligibility again in the same statement that pays out
+            new_balance = await db.run_async(db.perform_daily_claim, chat_id, user.id, DAILY_REWARD)
 
-    if db.check_daily_claim(user.id):
-        new_balance = db.perform_daily_claim(user.id, DAILY_REWARD)
+    if new_balance is not None:
         await update.message.reply_text(
             f"💰 Daily reward claimed! You received {DAILY_REWARD} Shekkles.\n"
             f"New balance: {new_balance} Shekkles"
         )
     else:
-        remaining = db.get_daily_time_remaining_str(user.id)
+        remaining = await db.run_async(db.get_daily_time_remaining_str, chat_id, user.id)
         await update.message.reply_text(
             f"⏳ You have already claimed your daily reward.\n"
             f"Come back in {remaining}."
         )
 
+HISTORY_PAGE_SIZE = 5
+
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if not user:
         return
         
-    records = db.get_user_history(user.id, limit=5)
+    page = await db.run_async(db.get_user_history_page, update.effective_chat.id, user.id, limit=HISTORY_PAGE_SIZE)
     
-    if not records:
+    if not page['items']:
         await update.message.reply_text("You have no resolved bets in your history.")
         return
-        
-    msg = "📜 <b>Your Last 5 Bets</b>\n\n"
-    for r in records:
-        desc = r['description']
+
+    await send_history_page(update.message.reply_text, user.id, page)
+
+async def send_history_page(send_method, user_id, page):
+    msg = "📜 <b>Your Bet History</b>\n\n"
+    for r in page['items']:
+        desc = html.escape(r['description'])
         amount = r['amount']
         choice = r['choice']
         outcome = r['outcome']
@@ -91,5 +135,45 @@ async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += f"<b>Bet #{r['bet_id']}</b>: {desc}\n"
         msg += f"Wager: {amount} on {choice} | Result: {outcome}\n"
         msg += f"{status} {profit_str}\n\n"
-        
-    await update.message.reply_text(msg, parse_mode='HTML')
\ No newline at end of file
+
+    # history:{user_id}:{direction}:{wager_id} - keyset cursors, so paging
+    # stays cheap however far back the user goes
+    nav_buttons = []
+    if page['newer'] is not None:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"history:{user_id}:new:{page['newer']}"))
+    if page['older'] is not None:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"history:{user_id}:old:{page['older']}"))
+    reply_markup = InlineKeyboardMarkup([nav_buttons]) if nav_buttons else None
+
+    await send_method(msg, parse_mode='HTML', reply_markup=reply_markup)
+
+async def history_page_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles the Prev/Next buttons of /history."""
+    query = update.callback_query
+    _, owner_id, direction, wager_id = query.data.split(':')
+    # In groups everyone sees the buttons; only the owner may page
+    if int(owner_id) != query.from_user.id:
+        await query.answer("Use /history to see your own bets.", show_alert=True)
+        return
+
+    chat_id = update.effective_chat.id
+    cursor = {'before': int(wager_id)} if direction == 'old' else {'after': int(wager_id)}
+    page = await db.run_async(db.get_user_history_page, chat_id, int(owner_id), limit=HISTORY_PAGE_SIZE, **cursor)
+    if not page['items']:
+        # The cursor's wager is gone; start over from the newest
+        page = await db.run_async(db.get_user_history_page, chat_id, int(owner_id), limit=HISTORY_PAGE_SIZE)
+    await query.answer()
+    if not page['items']:
+        await query.edit_message_text("You have no resolved bets in your history.")
+        return
+    await send_history_page(query.edit_message_text, int(owner_id), page)
+
+async def chat_migrated(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Keeps a group's economy when Telegram upgrades it to a supergroup, which has a new chat id."""
+    message = update.effective_message
+    if not message or not message.migrate_to_chat_id:
+        return
+    moved = await db.run_async(db.move_chat, message.chat_id, message.migrate_to_chat_id)
+    if moved is None:
+        logger.warning(f"Chat {message.chat_id} became {message.migrate_to_chat_id}, which already has "
+                       f"an economy; the old one was left in place")
@@ -5,8 +5,8 @@ from shekkle_bot.config import CURRENCY_NAME
 import html
 
 async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Shows the top winners."""
-    winners, _ = db.get_leaderboard_data()
+    """Shows the top winners of this chat."""
+    winners = await db.run_async(db.get_top_winners, update.effective_chat.id, 10)
     
     if not winners:
         await update.message.reply_text("No stats available yet.")
@@ -14,8 +14,7 @@ async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     msg = f"🏆 <b>Top Winners</b> 🏆\n\n"
     
-    # Show top 10
-    for i, user in enumerate(winners[:10], 1):
+    for i, user in enumerate(winners, 1):
         username = html.escape(user['username']) if user['username'] else "Unknown"
         profit = user['net_profit']
         won = user['bets_won']
@@ -28,8 +27,8 @@ async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(msg, parse_mode='HTML')
 
 async def show_loserboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Shows the top losers."""
-    _, losers = db.get_leaderboard_data()
+    """Shows the top losers of this chat."""
+    losers = await db.run_async(db.get_top_losers, update.effective_chat.id, 10)
     
     if not losers:
         await update.message.reply_text("No stats available yet.")
@@ -43,7 +42,7 @@ async def show_loserboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("No one is in the red yet! 🎉")
         return
 
-    for i, user in enumerate(actual_losers[:10], 1):
+    for i, user in enumerate(actual_losers, 1):
         username = html.escape(user['username']) if user['username'] else "Unknown"
         profit = user['net_profit']
         
@@ -1,34 +1,81 @@
 import logging
 import datetime
 import html
-from telegram.ext import ContextTypes
-from shekkle_bot.database import get_expired_open_bets, update_bet_status
-from shekkle_bot.config import ADMIN_IDS
+from telegram.ext import ContextTypes, JobQueue
+from shekkle_bot.database import (
+    get_open_bet_deadlines, lock_expired_bets, get_pending_expiry_notices, clear_expiry_notices,
+    reconcile_ledger, archive_resolved_bets, reclaim_space, run_async, shards,
+)
+from shekkle_bot.config import ADMIN_IDS, RECONCILE_BATCH, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH
+from shekkle_bot.dispatcher import dispatcher
+from shekkle_bot import metrics, timestamps
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def schedule_deadline(job_queue: JobQueue, deadline):
+    """
+    Arms a one-shot check_deadlines job for a bet deadline.
+    Deadlines are epochs as stored (or naive local datetimes). Bets that share a
+    deadline share one job, and overdue deadlines collapse into a single
+    immediate job, so expiring bets are locked together in one batch.
+    """
+    deadline = timestamps.to_epoch(deadline)
+
+    if deadline <= timestamps.now():
+        name, when = "deadline:overdue", 0
+    else:
+        name, when = f"deadline:{deadline}", datetime.datetime.fromtimestamp(deadline, datetime.timezone.utc)
+
+    if job_queue.get_jobs_by_name(name):
+        return
+    job_queue.run_once(check_deadlines, when=when, name=name)
+
+async def schedule_open_bets(job_queue: JobQueue):
+    """Re-arms deadline timers for all open bets, e.g. after a restart."""
+    deadlines = await run_async(get_open_bet_deadlines)
+    for deadline in deadlines:
+        schedule_deadline(job_queue, deadline)
+    logger.info(f"Armed deadline timers for {len(deadlines)} distinct deadlines.")
+    # Queue any expiry notices left pending when the bot stopped
+    if await run_async(get_pending_expiry_notices):
+        schedule_deadline(job_queue, timestamps.now())
+
+@metrics.track_job("rearm_deadlines")
+async def rearm_deadlines(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Repeating job on the leader of several workers: arms timers for bets that
+    were created on the other workers, which leave their deadlines to it.
+    """
+    for deadline in await run_async(get_open_bet_deadlines):
+        schedule_deadline(context.job_queue, deadline)
+
+@metrics.track_job("check_deadlines")
 async def check_deadlines(context: ContextTypes.DEFAULT_TYPE):
     """
-    Job to check for betting deadlines.
+    Job run at a bet deadline: locks every expired bet and notifies admins.
+    Bets are locked with their notice marked pending, and the mark is cleared
+    once the notice is in the outbox, so a notice that fails to queue is sent
+    by the retry (or the next run) instead of being lost.
     """
     try:
-        now_iso = datetime.datetime.now().isoformat()
-        expired_bets = get_expired_open_bets(now_iso)
+        for bet in await run_async(lock_expired_bets, timestamps.now()):
+            logger.info(f"Bet {bet['id']} expired. Status updated to LOCKED.")
 
-        if not expired_bets:
+        pending = await run_async(get_pending_expiry_notices)
+        if not pending:
             return
 
-        for bet in expired_bets:
+        notifications = []
+        for bet in pending:
             bet_id = bet['id']
             description = html.escape(bet['description'])
-            
-            # Send notification BEFORE changing status
             if ADMIN_IDS:
                 message = (
                     f"🚨 <b>Bet Expired!</b> 🚨\n\n"
                     f"ID: <code>{bet_id}</code>\n"
+                    f"Chat: <code>{bet['chat_id']}</code>\n"
                     f"Desc: {description}\n\n"
                     f"Please resolve using:\n"
                     f"<code>/resolve {bet_id} A</code>\n"
@@ -36,18 +83,60 @@ async def check_deadlines(context: ContextTypes.DEFAULT_TYPE):
                 )
                 
                 for admin_id in ADMIN_IDS:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=int(admin_id), 
-                            text=message, 
-                            parse_mode='HTML'
-                        )
-                    except Exception as e:
-                        logger.warning(f"Failed to notify admin {admin_id}: {e}")
-
-            # Update status to LOCKED
-            update_bet_status(bet_id, 'LOCKED')
-            logger.info(f"Bet {bet_id} expired. Status updated to LOCKED and admins notified.")
-            
+                    notifications.append({'chat_id': int(admin_id), 'text': message, 'parse_mode': 'HTML'})
+
+        await dispatcher.enqueue(notifications)
+        await run_async(clear_expiry_notices, pending)
+
     except Exception as e:
-        logger.error(f"Error in check_deadlines job: {e}")
\ No newline at end of file
+        logger.error(f"Error in check_deadlines job: {e}")
+        # Nothing else will revisit these bets, so try again shortly
+        if not context.job_queue.get_jobs_by_name("deadline:retry"):
+            context.job_queue.run_once(check_deadlines, when=60, name="deadline:retry")
+
+@metrics.track_job("check_ledger")
+async def check_ledger(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Repeating job: reconciles balances against the ledger entries written since
+    the last run in every shard (taking checkpoints as it goes) and alerts
+    admins on a mismatch.
+    """
+    mismatched = []
+    for shard in shards:
+        while True:
+            result = await run_async(reconcile_ledger, shard=shard)
+            mismatched.extend(result['mismatched'])
+            # A full batch means there may be more to catch up on
+            if result['entries'] < RECONCILE_BATCH:
+                break
+
+    if mismatched and ADMIN_IDS:
+        users = ", ".join(f"<code>{uid}</code> in chat <code>{chat_id}</code>" for chat_id, uid in mismatched[:20])
+        more = f" and {len(mismatched) - 20} more" if len(mismatched) > 20 else ""
+        message = (
+            f"🚨 <b>Ledger mismatch!</b> 🚨\n\n"
+            f"Balances differ from the ledger for {users}{more}."
+        )
+        await dispatcher.enqueue([{'chat_id': int(admin_id), 'text': message, 'parse_mode': 'HTML'}
+                                  for admin_id in ADMIN_IDS])
+
+@metrics.track_job("archive_bets")
+async def archive_bets(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Repeating job: moves bets resolved more than ARCHIVE_AFTER_DAYS ago, with
+    their wagers, to the archive tables one batch per transaction, so handlers
+    get the database in between, then gives the freed space back; shard by shard.
+    """
+    before = timestamps.now() - ARCHIVE_AFTER_DAYS * 24 * 60 * 60
+    for shard in shards:
+        bets = wagers = 0
+        while True:
+            moved = await run_async(archive_resolved_bets, before, shard=shard)
+            bets += moved['bets']
+            wagers += moved['wagers']
+            if moved['bets'] < ARCHIVE_BATCH:
+                break
+        if bets:
+            freed = await run_async(reclaim_space, shard=shard)
+            logger.info(f"Archived {bets} bets with {wagers} wagers in database '{shard}'; "
+                        f"released {freed or 0} free pages.")
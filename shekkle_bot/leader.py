@@ -0,0 +1,109 @@
+"""
+Leader election between bot workers sharing a database.
+
+With MULTI_WORKER several bot processes serve webhook updates behind a load
+balancer, but the scheduled jobs (deadline timers, ledger reconciliation,
+archival), the outbox dispatcher and command menu registration must run in
+one of them only. The workers compete for a lease row in the main database:
+its holder is the leader and renews it every third of LEADER_LEASE_SECONDS.
+When the leader dies, the lease runs out and the next worker to try takes it
+over, at most LEADER_LEASE_SECONDS plus one renewal interval later; a leader
+that shuts down cleanly releases it, so the handover takes one interval at
+most. A leader that cannot renew in time (database unreachable, event loop
+stalled) steps down before its lease expires. The leader's duties are safe to
+overlap with a successor's for a moment anyway: locking expired bets,
+reconciling and archiving are all conditional on the rows they change, and
+the outbox is delivered at least once.
+
+A single worker (MULTI_WORKER off) leads without a lease.
+"""
+import asyncio
+import logging
+import time
+
+import shekkle_bot.database as db
+from shekkle_bot.config import MULTI_WORKER, WORKER_ID, LEADER_LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = "leader"
+
+class LeaderElection:
+    def __init__(self, name=LEASE_NAME, holder=WORKER_ID, lease_seconds=LEADER_LEASE_SECONDS):
+        self.name = name
+        self.holder = holder
+        self.lease_seconds = lease_seconds
+        self.is_leader = False
+        self._on_elected = None
+        self._on_deposed = None
+        self._task = None
+        # Monotonic time until which the lease is known to be ours; a second
+        # short of its expiry, as the database stores whole seconds
+        self._held_until = 0.0
+
+    async def start(self, on_elected, on_deposed):
+        """
+        Starts competing for leadership. `on_elected` and `on_deposed` are
+        coroutine functions that start and stop the leader's duties.
+        """
+        self._on_elected, self._on_deposed = on_elected, on_deposed
+        if not MULTI_WORKER:
+            await self._elect()
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the duties if this worker leads and hands the lease on."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await self._depose()
+            if MULTI_WORKER:
+                try:
+                    await db.run_async(db.release_lease, self.name, self.holder)
+                except Exception as e:
+                    logger.warning(f"Could not release the {self.name} lease: {e}")
+
+    async def _run(self):
+        interval = self.lease_seconds / 3
+        while True:
+            started = time.monotonic()
+            try:
+                held = await asyncio.wait_for(
+                    db.run_async(db.acquire_lease, self.name, self.holder, self.lease_seconds), timeout=interval)
+                if held:
+                    self._held_until = started + self.lease_seconds - 1
+            except Exception as e:
+                logger.warning(f"Could not renew the {self.name} lease: {e!r}")
+                held = self.is_leader and time.monotonic() < self._held_until
+            if held and not self.is_leader:
+                try:
+                    await self._elect()
+                except Exception as e:
+                    logger.error(f"Error while starting the leader's duties: {e}")
+                    # Leave no duties half started; they are tried again on the next renewal
+                    await self._depose()
+            elif not held and self.is_leader:
+                await self._depose()
+            # Renew early enough to step down in time if the next attempt fails too
+            delay = interval
+            if self.is_leader:
+                delay = min(interval, max(self._held_until - time.monotonic(), 0))
+            await asyncio.sleep(delay)
+
+    async def _elect(self):
+        logger.info(f"Worker {self.holder} is now the leader")
+        self.is_leader = True
+        await self._on_elected()
+
+    async def _depose(self):
+        logger.info(f"Worker {self.holder} is no longer the leader")
+        self.is_leader = False
+        try:
+            await self._on_deposed()
+        except Exception as e:
+            logger.error(f"Error while stopping the leader's duties: {e}")
+
+election = LeaderElection()
@@ -1,23 +1,39 @@
+import asyncio
+import hashlib
+import json
 import logging
-import os
+from urllib.parse import urlparse
 from telegram import BotCommand, BotCommandScopeChat, BotCommandScopeDefault
-from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler
-from shekkle_bot.config import TOKEN, ADMIN_IDS
-from shekkle_bot.database import init_db
+from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
+from shekkle_bot.config import (
+    TOKEN, ADMIN_IDS, BOT_API_URL, METRICS_HOST, METRICS_PORT, RUN_MODE, CONCURRENT_UPDATES, PERSISTENCE_INTERVAL,
+    RECONCILE_INTERVAL, ARCHIVE_INTERVAL, ARCHIVE_AFTER_DAYS, MULTI_WORKER, DEADLINE_RESCAN_INTERVAL,
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+)
+from shekkle_bot.database import init_db, get_setting, set_setting, run_async, has_unassigned_economy, LEGACY_CHAT_ID
 from shekkle_bot.handlers import general, betting, admin, leaderboard
-from shekkle_bot import jobs
+from shekkle_bot import jobs, metrics
+from shekkle_bot.concurrency import PerUserUpdateProcessor
+from shekkle_bot.persistence import DatabasePersistence
+from shekkle_bot.dispatcher import dispatcher
+from shekkle_bot.leader import election
 
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
-async def post_init(application):
+# Stored hash of the command menus last registered with Telegram
+COMMANDS_SETTING = "commands_hash"
+
+def command_scopes():
+    """The command menus: one for everyone, plus one in each admin's private chat."""
     user_commands = [
         BotCommand("start", "Join"),
         BotCommand("daily", "Claim reward"),
         BotCommand("balance", "Check funds"),
-        BotCommand("history", "View last 5 bets"),
+        BotCommand("history", "View your bet history"),
         BotCommand("createbet", "New bet"),
         BotCommand("bets", "List open bets"),
         BotCommand("leaderboard", "Top winners"),
@@ -26,35 +42,143 @@ async def post_init(application):
     
     admin_commands = user_commands + [
         BotCommand("resolve", "Settle bet (Admin)"),
+        BotCommand("resolvebatch", "Settle several bets (Admin)"),
         BotCommand("give", "Add funds (Admin)"),
     ]
-    
-    # Set commands for general users (default scope)
-    await application.bot.set_my_commands(user_commands, scope=BotCommandScopeDefault())
-    
-    # Set commands for admins specifically in their private chat
-    for admin_id in ADMIN_IDS:
-        try:
-            await application.bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(chat_id=admin_id))
-        except Exception as e:
-            logging.warning(f"Could not set commands for admin {admin_id}: {e}")
+
+    scopes = [(BotCommandScopeDefault(), user_commands)]
+    scopes += [(BotCommandScopeChat(chat_id=admin_id), admin_commands) for admin_id in ADMIN_IDS]
+    return scopes
+
+def commands_hash(bot_id, scopes):
+    payload = [bot_id] + [[scope.to_dict(), [command.to_dict() for command in commands]]
+                          for scope, commands in scopes]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+async def register_commands(bot):
+    """
+    Sets the command menus, all scopes at once. Telegram keeps them between
+    restarts, so this is skipped when they haven't changed since the last
+    successful registration.
+    """
+    scopes = command_scopes()
+    digest = commands_hash(bot.id, scopes)
+    if await run_async(get_setting, COMMANDS_SETTING) == digest:
+        logging.info("Command menus unchanged, not registering them")
+        return
+
+    results = await asyncio.gather(*(bot.set_my_commands(commands, scope=scope) for scope, commands in scopes),
+                                   return_exceptions=True)
+    failed = False
+    for (scope, _), result in zip(scopes, results):
+        if isinstance(result, Exception):
+            failed = True
+            if isinstance(scope, BotCommandScopeChat):
+                logging.warning(f"Could not set commands for admin {scope.chat_id}: {result}")
+            else:
+                logging.warning(f"Could not set commands: {result}")
+    # Retried on the next start if anything failed
+    if not failed:
+        await run_async(set_setting, COMMANDS_SETTING, digest)
+
+@metrics.track_job("register_commands")
+async def register_commands_job(context):
+    await register_commands(context.bot)
+
+async def start_leader_duties(application):
+    """Starts what only one worker may run: menu registration, the outbox and the scheduled jobs."""
+    # Polling starts right after post_init; register the menus alongside it
+    if application.job_queue:
+        application.job_queue.run_once(register_commands_job, when=0, name="register_commands")
+    else:
+        await register_commands(application.bot)
+
+    # Deliver queued notifications, including any left over from before a restart
+    dispatcher.start(application.bot)
+
+    # Re-arm deadline timers for bets that are still open
+    if application.job_queue:
+        await jobs.schedule_open_bets(application.job_queue)
+        # Check balances against the ledger and take checkpoints in the background
+        if RECONCILE_INTERVAL:
+            application.job_queue.run_repeating(jobs.check_ledger, interval=RECONCILE_INTERVAL,
+                                                first=RECONCILE_INTERVAL, name="check_ledger")
+        # Move old resolved bets out of the hot tables
+        if ARCHIVE_INTERVAL and ARCHIVE_AFTER_DAYS:
+            application.job_queue.run_repeating(jobs.archive_bets, interval=ARCHIVE_INTERVAL,
+                                                first=ARCHIVE_INTERVAL, name="archive_bets")
+        # Pick up the deadlines of bets created on the other workers
+        if MULTI_WORKER:
+            application.job_queue.run_repeating(jobs.rearm_deadlines, interval=DEADLINE_RESCAN_INTERVAL,
+                                                first=DEADLINE_RESCAN_INTERVAL, name="rearm_deadlines")
+
+async def stop_leader_duties(application):
+    """Stops the duties of start_leader_duties() when this worker is no longer the leader."""
+    if application.job_queue:
+        for job in application.job_queue.jobs():
+            job.schedule_removal()
+    await dispatcher.stop()
+
+async def post_init(application):
+    # With a single worker, it leads from the start
+    await election.start(lambda: start_leader_duties(application), lambda: stop_leader_duties(application))
+
+def tls_context():
+    """
+    The TLS context for Bot API requests. Built once and shared by both HTTP
+    clients: loading the CA bundle is most of the cost of creating each.
+    """
+    import ssl
+    import certifi
+    import httpx
+    if hasattr(httpx, 'create_ssl_context'):
+        # httpx 0.28+, honouring SSL_CERT_FILE/SSL_CERT_DIR as its clients do
+        return httpx.create_ssl_context()
+    return ssl.create_default_context(cafile=certifi.where())
+
+async def post_shutdown(application):
+    await election.stop()
 
 
 def main():
     if not TOKEN:
         raise ValueError("No TOKEN provided in .env file.")
+    if RUN_MODE not in ('polling', 'webhook'):
+        raise ValueError(f"RUN_MODE must be 'polling' or 'webhook', not '{RUN_MODE}'.")
+    if RUN_MODE == 'webhook' and not WEBHOOK_URL:
+        raise ValueError("RUN_MODE=webhook requires WEBHOOK_URL.")
+    if MULTI_WORKER and RUN_MODE != 'webhook':
+        # Telegram hands updates to one getUpdates caller at a time
+        raise ValueError("MULTI_WORKER requires RUN_MODE=webhook.")
 
     # Initialize the database
     init_db()
+    if has_unassigned_economy():
+        logging.error(f"The balances from before per-chat economies are still in chat {LEGACY_CHAT_ID}, and /start "
+                      f"and /balance won't register anyone new until they are assigned: run "
+                      f"python -m shekkle_bot.manage move-chat {LEGACY_CHAT_ID} <group chat id>")
 
     # Build the application
-    application = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
+    # Bot API calls go through a request object that times them per handler
+    tls = {'verify': tls_context()}
+    builder = (ApplicationBuilder().token(TOKEN).request(metrics.InstrumentedRequest(httpx_kwargs=tls))
+               .get_updates_request(HTTPXRequest(connection_pool_size=1, httpx_kwargs=tls))
+               .post_init(post_init).post_shutdown(post_shutdown))
+    # Conversations in progress and user_data survive restarts
+    builder = builder.persistence(DatabasePersistence(update_interval=PERSISTENCE_INTERVAL))
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    if CONCURRENT_UPDATES > 1:
+        # Different users' updates run in parallel; each user's stay in order
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+    application = builder.build()
 
     # Add General Handlers
     application.add_handler(CommandHandler("start", general.start))
     application.add_handler(CommandHandler("balance", general.balance))
     application.add_handler(CommandHandler("daily", general.daily))
     application.add_handler(CommandHandler("history", general.history))
+    application.add_handler(MessageHandler(filters.StatusUpdate.MIGRATE, general.chat_migrated))
     
     # Add Leaderboard Handlers
     application.add_handler(CommandHandler("leaderboard", leaderboard.show_leaderboard))
@@ -68,19 +192,34 @@ def main():
     application.add_handler(CallbackQueryHandler(betting.wager_button, pattern='^wager:'))
     application.add_handler(CallbackQueryHandler(betting.view_bets_button, pattern='^view_bets:'))
     application.add_handler(CallbackQueryHandler(betting.bet_page_button, pattern='^page_bet:'))
+    application.add_handler(CallbackQueryHandler(general.history_page_button, pattern='^history:'))
     application.add_handler(CallbackQueryHandler(lambda u, c: u.callback_query.answer(), pattern='^ignore$'))
 
     # Add Admin Handlers
     application.add_handler(CommandHandler("resolve", admin.resolve))
+    application.add_handler(CommandHandler("resolvebatch", admin.resolve_batch))
     application.add_handler(CommandHandler("give", admin.add_funds))
 
-    # Job Queue
-    if application.job_queue:
-        application.job_queue.run_repeating(jobs.check_deadlines, interval=60, first=10)
+    # Record latency, SQL and Bot API usage for every handler above
+    metrics.instrument_application(application)
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_HOST, METRICS_PORT)
+    # A user's next update may reach any worker; not instrumented, so added after
+    if MULTI_WORKER:
+        application.persistence.share_between_workers(application)
 
     # Run the bot
     print("Bot is running...")
-    application.run_polling()
+    if RUN_MODE == 'webhook':
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH if WEBHOOK_PATH is not None else urlparse(WEBHOOK_URL).path.lstrip('/'),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET or None,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,200 @@
+"""
+Maintenance commands for the bot's database.
+
+Usage: python -m shekkle_bot.manage <command>
+"""
+import argparse
+import sys
+
+from sqlalchemy import event
+
+import shekkle_bot.database as db
+from shekkle_bot import timestamps
+from shekkle_bot.leader import LEASE_NAME
+from shekkle_bot.config import RECONCILE_BATCH, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH
+
+# Chat whose shard the query plans are checked on
+PLAN_CHAT_ID = 0
+
+# Hot-path queries that must be answered from an index, by the function that issues them.
+HOT_PATHS = {
+    'get_bet_wagers': lambda: db.get_bet_wagers(PLAN_CHAT_ID, 0),
+    'get_user_history': lambda: db.get_user_history(PLAN_CHAT_ID, 0),
+    'get_user_history_page': lambda: db.get_user_history_page(PLAN_CHAT_ID, 0, before=1),
+    'get_open_bets': lambda: db.get_open_bets(PLAN_CHAT_ID),
+    'get_open_bet_page': lambda: db.get_open_bet_page(PLAN_CHAT_ID, 1),
+    'get_expired_open_bets': lambda: db.get_expired_open_bets(timestamps.now()),
+    'get_user_by_username': lambda: db.get_user_by_username(PLAN_CHAT_ID, '@nobody'),
+    'get_top_winners': lambda: db.get_top_winners(PLAN_CHAT_ID),
+    'get_balance_at': lambda: db.get_balance_at(PLAN_CHAT_ID, 0, timestamps.now()),
+    'chat_for_bet': lambda: db.chat_for_bet(1),
+}
+
+def query_plans():
+    """
+    Runs each hot-path function, captures the SQL it issues and yields
+    (name, plan details, scans) for every statement: the EXPLAIN QUERY PLAN
+    lines, and those of them that are full table or index scans. SQLite only.
+    """
+    # Routes the chat first, so assigning it a shard isn't part of any plan
+    shard = db.shard_for_chat(PLAN_CHAT_ID)
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters, conn.engine))
+
+    # Every shard has the same schema; the main database answers the directory lookups
+    engines = {db.engine, db.read_engine, shard.engine, shard.read_engine}
+    readers = {each.engine: each.read_engine for each in db.shards.values()}
+    for name, call in HOT_PATHS.items():
+        captured.clear()
+        for target in engines:
+            event.listen(target, 'before_cursor_execute', capture)
+        try:
+            call()
+        finally:
+            for target in engines:
+                event.remove(target, 'before_cursor_execute', capture)
+
+        for statement, parameters, target in captured:
+            with readers.get(target, target).connect() as conn:
+                plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+            details = [row[-1] for row in plan]
+            yield name, details, [d for d in details if d.startswith('SCAN')]
+
+def check_query_plans():
+    """
+    Prints the query plan of each hot-path query and flags full table or
+    index scans. Returns the number of queries that scan.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        print(f"Query plan check only supports SQLite (engine is {db.engine.dialect.name}).")
+        return 0
+    failures = 0
+    for name, details, scans in query_plans():
+        status = "FAIL" if scans else "ok"
+        print(f"[{status}] {name}: {'; '.join(details)}")
+        failures += bool(scans)
+    return failures
+
+def reconcile_ledger():
+    """
+    Checks every ledger entry not yet reconciled in every shard, batch by batch.
+    Returns the number of users whose balance differs from the ledger.
+    """
+    entries, mismatched = 0, set()
+    for shard in db.shards:
+        while True:
+            result = db.reconcile_ledger(shard=shard)
+            entries += result['entries']
+            mismatched.update(result['mismatched'])
+            if result['entries'] < RECONCILE_BATCH:
+                break
+    print(f"Reconciled {entries} ledger entries.")
+    for chat_id, user_id in sorted(mismatched):
+        print(f"[FAIL] user {user_id} in chat {chat_id}: balance {db.get_user(chat_id, user_id).balance} "
+              f"differs from the ledger ({db.get_balance_at(chat_id, user_id, timestamps.now())})")
+    return len(mismatched)
+
+def print_balance_history(chat_id, user_id, days):
+    for item in db.get_balance_history(chat_id, user_id, timestamps.now() - days * 24 * 60 * 60):
+        reason = item['reason'] or 'start'
+        ref = f" #{item['ref_id']}" if item['ref_id'] is not None else ""
+        print(f"{timestamps.format_local(item['at'], '%Y-%m-%d %H:%M:%S')}  {item['amount']:>+8}  {item['balance']:>8}  {reason}{ref}")
+
+def archive_bets(days):
+    """Archives every bet resolved more than `days` ago, batch by batch, and reclaims the space; shard by shard."""
+    before = timestamps.now() - days * 24 * 60 * 60
+    for shard in db.shards:
+        bets = wagers = 0
+        while True:
+            moved = db.archive_resolved_bets(before, shard=shard)
+            bets += moved['bets']
+            wagers += moved['wagers']
+            if moved['bets'] < ARCHIVE_BATCH:
+                break
+        print(f"[{shard}] Archived {bets} bets with {wagers} wagers.")
+        freed = db.reclaim_space(shard=shard)
+        if freed is not None:
+            print(f"[{shard}] Released {freed} free pages.")
+
+def print_shards():
+    for name, chats in db.get_shard_loads().items():
+        target = db.shards[name].engine.url.render_as_string(hide_password=True) if name in db.shards else "NOT CONFIGURED"
+        print(f"{name:<12} {chats:>6} chats  {target}")
+
+def move_chat(from_chat_id, to_chat_id):
+    moved = db.move_chat(from_chat_id, to_chat_id)
+    if moved is None:
+        print(f"Chat {to_chat_id} already has an economy of its own; nothing was moved.")
+        return False
+    print(f"Moved {moved} users of chat {from_chat_id} to chat {to_chat_id}.")
+    return True
+
+def print_leader():
+    lease = db.get_lease(LEASE_NAME)
+    now = timestamps.now()
+    if lease is None or lease['expires_at'] <= now:
+        print("No worker holds the leader lease.")
+        return
+    print(f"Leader: {lease['holder']} since {timestamps.format_local(lease['acquired_at'])}, "
+          f"lease expires in {lease['expires_at'] - now}s.")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m shekkle_bot.manage", description="Shekkle bot maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="Apply pending schema migrations")
+    commands.add_parser("rebuild-stats", help="Recompute the leaderboard stats tables from all resolved wagers")
+    commands.add_parser("check-query-plans", help="Verify that hot-path queries use their indexes")
+    commands.add_parser("reconcile-ledger", help="Check balances against the ledger and take checkpoints")
+    history = commands.add_parser("balance-history", help="Show a user's balance in a chat over time from the ledger")
+    history.add_argument("chat_id", type=int)
+    history.add_argument("user_id", type=int)
+    history.add_argument("--days", type=int, default=7)
+    archive = commands.add_parser("archive-bets", help="Move old resolved bets and their wagers to the archive tables")
+    archive.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    commands.add_parser("vacuum", help="Compact the SQLite files and enable incremental vacuum (stop the bot first)")
+    commands.add_parser("shards", help="List the databases and how many chats each holds")
+    move = commands.add_parser("move-chat", help="Hand a chat's economy to another chat id, e.g. chat 0 "
+                                                 "(the economy from before per-chat economies) to a group")
+    move.add_argument("from_chat_id", type=int)
+    move.add_argument("to_chat_id", type=int)
+    commands.add_parser("leader", help="Show which worker runs the background jobs (MULTI_WORKER)")
+    args = parser.parse_args(argv)
+
+    db.init_db()
+
+    if args.command == "migrate":
+        print(f"Schema is at version {db.migrations.current_version(db.engine)}.")
+    elif args.command == "rebuild-stats":
+        count = sum(db.rebuild_user_stats(shard) for shard in db.shards)
+        print(f"Rebuilt stats for {count} users.")
+    elif args.command == "check-query-plans":
+        if check_query_plans():
+            sys.exit(1)
+    elif args.command == "reconcile-ledger":
+        if reconcile_ledger():
+            sys.exit(1)
+    elif args.command == "balance-history":
+        print_balance_history(args.chat_id, args.user_id, args.days)
+    elif args.command == "archive-bets":
+        archive_bets(args.days)
+    elif args.command == "vacuum":
+        for name, shard in db.shards.items():
+            if shard.engine.dialect.name != 'sqlite':
+                print(f"[{name}] vacuum only supports SQLite (engine is {shard.engine.dialect.name}).")
+                continue
+            db.vacuum_database(name)
+            print(f"[{name}] Database compacted; auto_vacuum is INCREMENTAL.")
+    elif args.command == "shards":
+        print_shards()
+    elif args.command == "move-chat":
+        if not move_chat(args.from_chat_id, args.to_chat_id):
+            sys.exit(1)
+    elif args.command == "leader":
+        print_leader()
+
+
+if __name__ == '__main__':
+    main()
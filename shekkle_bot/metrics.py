@@ -0,0 +1,250 @@
+"""
+Lightweight runtime metrics in the Prometheus text format.
+
+Every handler registered in main.py is wrapped to record a latency histogram
+and errors under a label derived from its command or callback pattern. While
+a handler (or a job) runs, its label lives in a context variable, which
+db.run_async carries into the DB worker thread, so SQL statements counted
+from the engine's before_cursor_execute event, time spent awaiting the
+database and time spent in Bot API requests are attributed to it. Work
+outside handlers (the outbox dispatcher, startup) is labelled "background".
+The user cache's hit, miss and eviction counters are read at every scrape.
+
+Recording is a few dict updates under a lock, cheap enough for a Raspberry
+Pi. The numbers are served as plain text on METRICS_HOST:METRICS_PORT/metrics.
+"""
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.ext import CallbackQueryHandler, CommandHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; the +Inf bucket is implicit
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = contextvars.ContextVar('shekkle_metrics_handler', default='background')
+_lock = threading.Lock()
+
+class _Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+_handler_latency = {}     # handler -> _Histogram
+_job_latency = {}         # job -> _Histogram
+_handler_errors = {}      # handler -> count
+_job_errors = {}          # job -> count
+_db_queries = {}          # handler -> SQL statements executed
+_db_seconds = {}          # handler -> seconds spent awaiting the database
+_telegram_requests = {}   # (handler, method) -> Bot API requests
+_telegram_seconds = {}    # (handler, method) -> seconds spent in Bot API requests
+_user_cache = None        # the database layer's UserCache, see watch_user_cache()
+
+def current_label():
+    return _current.get()
+
+def _add(counter, key, amount=1):
+    with _lock:
+        counter[key] = counter.get(key, 0) + amount
+
+def _observe(histograms, key, seconds):
+    with _lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram()
+        histogram.observe(seconds)
+
+# --- Recording ---
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """before_cursor_execute listener counting SQL statements per handler."""
+    _add(_db_queries, _current.get())
+
+def record_db_time(seconds):
+    _add(_db_seconds, _current.get(), seconds)
+
+def watch_user_cache(cache):
+    """Exports the counters of `cache` (a cache.UserCache) with the other metrics."""
+    global _user_cache
+    _user_cache = cache
+
+def track_handler(label, callback):
+    """Wraps a handler callback to record its latency and errors under `label`."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        token = _current.set(label)
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            _add(_handler_errors, label)
+            raise
+        finally:
+            _observe(_handler_latency, label, time.perf_counter() - start)
+            _current.reset(token)
+    return wrapper
+
+def track_job(name):
+    """Decorator recording a job callback's run duration and errors."""
+    def decorate(callback):
+        @functools.wraps(callback)
+        async def wrapper(context):
+            token = _current.set(f"job:{name}")
+            start = time.perf_counter()
+            try:
+                return await callback(context)
+            except Exception:
+                _add(_job_errors, name)
+                raise
+            finally:
+                _observe(_job_latency, name, time.perf_counter() - start)
+                _current.reset(token)
+        return wrapper
+    return decorate
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records time spent in each Bot API method."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            key = (_current.get(), url.rsplit('/', 1)[-1])
+            with _lock:
+                _telegram_requests[key] = _telegram_requests.get(key, 0) + 1
+                _telegram_seconds[key] = _telegram_seconds.get(key, 0) + time.perf_counter() - start
+
+def _label(handler):
+    if isinstance(handler, CommandHandler):
+        return "/" + sorted(handler.commands)[0]
+    if isinstance(handler, CallbackQueryHandler) and handler.pattern is not None:
+        pattern = getattr(handler.pattern, 'pattern', handler.pattern)
+        if isinstance(pattern, str):
+            return pattern.strip('^$')
+    return getattr(handler.callback, '__name__', type(handler).__name__)
+
+def _instrument(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for child in nested:
+            _instrument(child)
+    else:
+        handler.callback = track_handler(_label(handler), handler.callback)
+
+def instrument_application(application):
+    """Wraps every handler registered on `application`. Call once, after adding handlers."""
+    for group in application.handlers.values():
+        for handler in group:
+            _instrument(handler)
+
+# --- Exposition ---
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _histogram_lines(name, help_text, label_name, histograms):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for key, histogram in sorted(histograms.items()):
+        label = f'{label_name}="{_escape(key)}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{label}}} {histogram.total:.6f}")
+        lines.append(f"{name}_count{{{label}}} {histogram.count}")
+    return lines
+
+def _counter_lines(name, help_text, label_names, counter):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    for key, value in sorted(counter.items()):
+        values = key if isinstance(key, tuple) else (key,)
+        labels = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(label_names, values))
+        lines.append(f"{name}{{{labels}}} {value:.6f}" if isinstance(value, float) else f"{name}{{{labels}}} {value}")
+    return lines
+
+def _user_cache_lines():
+    if _user_cache is None:
+        return []
+    stats = _user_cache.stats()
+    lines = []
+    for name, key, help_text in (("hits", 'hits', "User lookups answered from the cache."),
+                                 ("misses", 'misses', "User lookups that went to the database."),
+                                 ("evictions", 'evictions', "Users dropped from the full cache.")):
+        lines += [f"# HELP shekkle_user_cache_{name}_total {help_text}",
+                  f"# TYPE shekkle_user_cache_{name}_total counter",
+                  f"shekkle_user_cache_{name}_total {stats[key]}"]
+    for name, key, help_text in (("entries", 'size', "Users in the cache."),
+                                 ("max_entries", 'max_size', "USER_CACHE_SIZE; 0 when the cache is off.")):
+        lines += [f"# HELP shekkle_user_cache_{name} {help_text}",
+                  f"# TYPE shekkle_user_cache_{name} gauge",
+                  f"shekkle_user_cache_{name} {stats[key]}"]
+    return lines
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    # The cache has a lock of its own
+    cache_lines = _user_cache_lines()
+    with _lock:
+        lines = []
+        lines += _histogram_lines("shekkle_handler_duration_seconds", "Handler run time.",
+                                  "handler", _handler_latency)
+        lines += _counter_lines("shekkle_handler_errors_total", "Handler runs that raised.",
+                                ("handler",), _handler_errors)
+        lines += _counter_lines("shekkle_db_queries_total", "SQL statements executed.",
+                                ("handler",), _db_queries)
+        lines += _counter_lines("shekkle_db_seconds_total", "Time spent awaiting database calls.",
+                                ("handler",), _db_seconds)
+        lines += _counter_lines("shekkle_telegram_requests_total", "Bot API requests.",
+                                ("handler", "method"), _telegram_requests)
+        lines += _counter_lines("shekkle_telegram_seconds_total", "Time spent in Bot API requests.",
+                                ("handler", "method"), _telegram_seconds)
+        lines += _histogram_lines("shekkle_job_duration_seconds", "Scheduled job run time.",
+                                  "job", _job_latency)
+        lines += _counter_lines("shekkle_job_errors_total", "Job runs that raised.",
+                                ("job",), _job_errors)
+    return "\n".join(lines + cache_lines) + "\n"
+
+def start_http_server(host, port):
+    """Serves render() at http://host:port/metrics from a daemon thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            data = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not started on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="shekkle-metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,460 @@
+"""
+Versioned schema migrations.
+
+Every migration is registered with a version number and runs once, in its own
+transaction, with a Connection to apply DDL/DML. Applied versions are recorded
+in the schema_version table, so startup only has to read the current version.
+
+Migrations describe the schema as it was at that version; never edit one that
+has shipped, add a new one instead. A migration may return the name of a
+backfill that database.init_db should run once the schema is fully upgraded
+(backfills use the current code, so they must not run against an old schema).
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, BigInteger, String, LargeBinary, ForeignKey, Index, PrimaryKeyConstraint,
+    inspect, text,
+)
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+def migration(version, description):
+    """Registers a migration function under `version`."""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+def _reflected(conn, *table_names):
+    """MetaData holding the named existing tables, so new tables can reference them."""
+    metadata = MetaData()
+    metadata.reflect(conn, only=table_names)
+    return metadata
+
+def _columns(conn, table_name):
+    return {c['name'] for c in inspect(conn).get_columns(table_name)}
+
+# --- Migrations ---
+
+@migration(1, "initial tables")
+def _initial_tables(conn):
+    metadata = MetaData()
+    Table('users', metadata,
+          Column('user_id', Integer, primary_key=True, autoincrement=False),
+          Column('username', String),
+          Column('balance', Integer),
+          Column('last_daily', String, nullable=True))
+    Table('bets', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=True),
+          Column('creator_id', Integer),
+          Column('description', String),
+          Column('deadline', String),
+          Column('option_a', String),
+          Column('option_b', String),
+          Column('outcome', String, nullable=True),
+          Column('status', String),
+          Column('cutoff_at', String, nullable=True),
+          Column('resolved_at', String, nullable=True))
+    Table('wagers', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=True),
+          Column('user_id', Integer, ForeignKey('users.user_id')),
+          Column('bet_id', Integer, ForeignKey('bets.id')),
+          Column('choice', String),
+          Column('amount', Integer),
+          Column('placed_at', String),
+          Column('refunded', Integer),
+          Column('payout', Integer, nullable=True))
+    # Databases created before migrations existed already have these tables.
+    metadata.create_all(conn, checkfirst=True)
+
+@migration(2, "wagers.payout column")
+def _wager_payout(conn):
+    if 'payout' not in _columns(conn, 'wagers'):
+        conn.execute(text("ALTER TABLE wagers ADD COLUMN payout INTEGER"))
+
+@migration(3, "user_stats table")
+def _user_stats(conn):
+    metadata = _reflected(conn, 'users')
+    Table('user_stats', metadata,
+          Column('user_id', Integer, ForeignKey('users.user_id'), primary_key=True, autoincrement=False),
+          Column('net_profit', Integer, nullable=False),
+          Column('bets_placed', Integer, nullable=False),
+          Column('bets_won', Integer, nullable=False),
+          Index('ix_user_stats_net_profit', 'net_profit'))
+    metadata.create_all(conn, checkfirst=True)
+    return 'user_stats'
+
+@migration(4, "hot-path indexes")
+def _hot_path_indexes(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_wagers_bet_refunded_choice ON wagers (bet_id, refunded, choice)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_wagers_user_placed ON wagers (user_id, placed_at)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_bets_status_deadline ON bets (status, deadline)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_users_username ON users (username)"))
+
+@migration(5, "64-bit Telegram user ids")
+def _bigint_user_ids(conn):
+    # Telegram ids no longer fit in 32 bits. SQLite INTEGER is already 64-bit.
+    if conn.dialect.name != 'postgresql':
+        return
+    for table, column in (('users', 'user_id'), ('bets', 'creator_id'),
+                          ('wagers', 'user_id'), ('user_stats', 'user_id')):
+        conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT"))
+
+@migration(6, "outbox table")
+def _outbox(conn):
+    metadata = MetaData()
+    Table('outbox', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=True),
+          Column('chat_id', BigInteger, nullable=False),
+          Column('text', String, nullable=False),
+          Column('parse_mode', String, nullable=True),
+          Column('attempts', Integer, nullable=False),
+          Column('next_attempt_at', String, nullable=False),
+          Column('created_at', String, nullable=False),
+          Index('ix_outbox_next_attempt', 'next_attempt_at'))
+    metadata.create_all(conn, checkfirst=True)
+
+@migration(7, "open bets keyset index")
+def _bets_status_id_index(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_bets_status_id ON bets (status, id)"))
+
+@migration(8, "bet pool aggregates")
+def _bet_pools(conn):
+    metadata = _reflected(conn, 'users', 'bets')
+    Table('bet_pools', metadata,
+          Column('bet_id', Integer, ForeignKey('bets.id'), primary_key=True, autoincrement=False),
+          Column('amount_a', Integer, nullable=False),
+          Column('amount_b', Integer, nullable=False),
+          Column('bettors_a', Integer, nullable=False),
+          Column('bettors_b', Integer, nullable=False))
+    Table('bet_pool_entries', metadata,
+          Column('bet_id', Integer, ForeignKey('bets.id'), nullable=False),
+          Column('choice', String, nullable=False),
+          Column('user_id', BigInteger, ForeignKey('users.user_id'), nullable=False),
+          Column('amount', Integer, nullable=False),
+          PrimaryKeyConstraint('bet_id', 'choice', 'user_id'),
+          Index('ix_bet_pool_entries_amount', 'bet_id', 'choice', 'amount'))
+    metadata.create_all(conn, checkfirst=True)
+    return 'bet_pools'
+
+@migration(9, "conversation and user_data persistence")
+def _persistence(conn):
+    metadata = MetaData()
+    Table('conversation_states', metadata,
+          Column('name', String, nullable=False),
+          Column('key', String, nullable=False),
+          Column('state', String, nullable=False),
+          PrimaryKeyConstraint('name', 'key'))
+    Table('user_data', metadata,
+          Column('user_id', BigInteger, primary_key=True, autoincrement=False),
+          Column('data', LargeBinary, nullable=False))
+    metadata.create_all(conn, checkfirst=True)
+
+@migration(10, "balance ledger")
+def _ledger(conn):
+    metadata = MetaData()
+    Table('ledger', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=True),
+          Column('user_id', BigInteger, nullable=False),
+          Column('amount', Integer, nullable=False),
+          Column('reason', String, nullable=False),
+          Column('ref_id', BigInteger, nullable=True),
+          Column('created_at', String, nullable=False),
+          Index('ix_ledger_user_id', 'user_id', 'id'))
+    Table('balance_checkpoints', metadata,
+          Column('user_id', BigInteger, nullable=False),
+          Column('ledger_id', Integer, nullable=False),
+          Column('balance', Integer, nullable=False),
+          Column('as_of', String, nullable=False),
+          PrimaryKeyConstraint('user_id', 'ledger_id'))
+    Table('job_cursors', metadata,
+          Column('name', String, primary_key=True),
+          Column('position', Integer, nullable=False))
+    metadata.create_all(conn, checkfirst=True)
+    return 'ledger'
+
+@migration(11, "history keyset index")
+def _history_keyset_index(conn):
+    # Pages of /history are keyed on (placed_at, id); SQLite has the rowid in
+    # every index anyway, PostgreSQL needs it spelled out
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_wagers_user_placed_id ON wagers (user_id, placed_at, id)"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_wagers_user_placed"))
+
+def _rebuild_sqlite_table(conn, table_name, bigint_columns):
+    """
+    Recreates a SQLite table with `bigint_columns` declared BIGINT, keeping its
+    rows and indexes. SQLite can't change a column's type in place, and numbers
+    written to a VARCHAR column would be stored as text.
+    """
+    indexes = inspect(conn).get_indexes(table_name)
+    metadata = MetaData()
+    metadata.reflect(conn)
+    rebuilt = metadata.tables[table_name].to_metadata(metadata, name=f"{table_name}__new")
+    rebuilt.indexes.clear()
+    for column in bigint_columns:
+        rebuilt.c[column].type = BigInteger()
+    rebuilt.create(conn)
+    names = ", ".join(c.name for c in rebuilt.columns)
+    conn.execute(text(f"INSERT INTO {rebuilt.name} ({names}) SELECT {names} FROM {table_name}"))
+    conn.execute(text(f"DROP TABLE {table_name}"))
+    conn.execute(text(f"ALTER TABLE {rebuilt.name} RENAME TO {table_name}"))
+    for index in indexes:
+        unique = "UNIQUE " if index['unique'] else ""
+        conn.execute(text(f"CREATE {unique}INDEX {index['name']} ON {table_name} "
+                          f"({', '.join(index['column_names'])})"))
+
+# Rows migration 12 parses per round trip
+_EPOCH_BATCH = 5000
+
+def _legacy_epoch(value):
+    """
+    Migration 12's parser, kept here so that changes to shekkle_bot.timestamps
+    can't change what the migration does: naive ISO strings are local time,
+    with or without seconds, 'T' or space separated. None and '' give None.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = value.strip()
+    if value.lstrip('-').isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp())
+
+def _to_epoch_columns(conn, table_name, keys, columns):
+    """
+    Converts ISO-string timestamp `columns` to BIGINT UTC epochs in place. The
+    values are parsed _EPOCH_BATCH rows at a time, in key order, into a scratch
+    table matched to the rows by `keys`; once the columns have their new type,
+    one UPDATE fills them from it.
+    """
+    scratch = f"{table_name}__epochs"
+    metadata = MetaData()
+    Table(scratch, metadata,
+          *[Column(key, BigInteger, primary_key=True, autoincrement=False) for key in keys],
+          *[Column(column, BigInteger) for column in columns])
+    metadata.create_all(conn)
+
+    names = (*keys, *columns)
+    key_list = ", ".join(keys)
+    page = text(f"SELECT {', '.join(names)} FROM {table_name} ORDER BY {key_list} LIMIT {_EPOCH_BATCH}")
+    after = text(f"SELECT {', '.join(names)} FROM {table_name} "
+                 f"WHERE ({key_list}) > ({', '.join(f':k_{key}' for key in keys)}) "
+                 f"ORDER BY {key_list} LIMIT {_EPOCH_BATCH}")
+    store = text(f"INSERT INTO {scratch} ({', '.join(names)}) VALUES ({', '.join(f':{n}' for n in names)})")
+    rows = conn.execute(page).all()
+    while rows:
+        values = []
+        for row in rows:
+            epochs = [_legacy_epoch(value) for value in row[len(keys):]]
+            if any(epoch is not None for epoch in epochs):
+                values.append(dict(zip(names, (*row[:len(keys)], *epochs))))
+        if values:
+            conn.execute(store, values)
+        rows = conn.execute(after, {f"k_{key}": value for key, value in zip(keys, rows[-1])}).all()
+
+    if conn.dialect.name == 'postgresql':
+        not_null = {c['name'] for c in inspect(conn).get_columns(table_name) if not c['nullable']}
+        for column in columns:
+            conn.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {column} DROP NOT NULL, "
+                              f"ALTER COLUMN {column} TYPE BIGINT USING NULL"))
+    else:
+        not_null = set()
+        _rebuild_sqlite_table(conn, table_name, columns)
+
+    # Rows without a row in the scratch table had no timestamps
+    match = " AND ".join(f"e.{key} = {table_name}.{key}" for key in keys)
+    assignments = ", ".join(f"{column} = (SELECT e.{column} FROM {scratch} e WHERE {match})" for column in columns)
+    conn.execute(text(f"UPDATE {table_name} SET {assignments}"))
+    conn.execute(text(f"DROP TABLE {scratch}"))
+    for column in columns:
+        if column in not_null:
+            conn.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {column} SET NOT NULL"))
+
+@migration(12, "integer epoch timestamps")
+def _epoch_timestamps(conn):
+    # Stored so far as ISO strings of naive local time, in a few formats
+    _to_epoch_columns(conn, 'users', ['user_id'], ['last_daily'])
+    _to_epoch_columns(conn, 'bets', ['id'], ['deadline', 'cutoff_at', 'resolved_at'])
+    _to_epoch_columns(conn, 'wagers', ['id'], ['placed_at'])
+    _to_epoch_columns(conn, 'ledger', ['id'], ['created_at'])
+    _to_epoch_columns(conn, 'balance_checkpoints', ['user_id', 'ledger_id'], ['as_of'])
+    _to_epoch_columns(conn, 'outbox', ['id'], ['next_attempt_at', 'created_at'])
+
+@migration(13, "bot settings")
+def _bot_settings(conn):
+    metadata = MetaData()
+    Table('bot_settings', metadata,
+          Column('name', String, primary_key=True),
+          Column('value', String, nullable=False))
+    metadata.create_all(conn, checkfirst=True)
+
+@migration(14, "archive tables")
+def _archive_tables(conn):
+    metadata = MetaData()
+    Table('bets_archive', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=False),
+          Column('creator_id', BigInteger),
+          Column('description', String),
+          Column('deadline', BigInteger),
+          Column('option_a', String),
+          Column('option_b', String),
+          Column('outcome', String, nullable=True),
+          Column('status', String),
+          Column('cutoff_at', BigInteger, nullable=True),
+          Column('resolved_at', BigInteger, nullable=True),
+          Column('amount_a', Integer, nullable=False),
+          Column('amount_b', Integer, nullable=False),
+          Column('bettors_a', Integer, nullable=False),
+          Column('bettors_b', Integer, nullable=False))
+    Table('wagers_archive', metadata,
+          Column('id', Integer, primary_key=True, autoincrement=False),
+          Column('user_id', BigInteger),
+          Column('bet_id', Integer),
+          Column('choice', String),
+          Column('amount', Integer),
+          Column('placed_at', BigInteger),
+          Column('refunded', Integer),
+          Column('payout', Integer, nullable=True),
+          Index('ix_wagers_archive_user_placed_id', 'user_id', 'placed_at', 'id'),
+          Index('ix_wagers_archive_bet_id', 'bet_id'))
+    metadata.create_all(conn, checkfirst=True)
+
+def _add_chat_key(conn, table_name, primary_key):
+    """
+    Adds chat_id (0 for existing rows) to `table_name` as the first column of
+    its primary key `primary_key`. SQLite can't alter a primary key, so the
+    table is rebuilt with its rows and indexes; on PostgreSQL the foreign keys
+    that reference it (which need the old key to stay unique) are dropped.
+    """
+    if conn.dialect.name == 'postgresql':
+        inspector = inspect(conn)
+        for referencing in inspector.get_table_names():
+            for fk in inspector.get_foreign_keys(referencing):
+                if fk['referred_table'] == table_name:
+                    conn.execute(text(f'ALTER TABLE {referencing} DROP CONSTRAINT "{fk["name"]}"'))
+        pk_name = inspector.get_pk_constraint(table_name)['name']
+        conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN chat_id BIGINT NOT NULL DEFAULT 0"))
+        conn.execute(text(f'ALTER TABLE {table_name} DROP CONSTRAINT "{pk_name}"'))
+        conn.execute(text(f"ALTER TABLE {table_name} ADD PRIMARY KEY ({', '.join(primary_key)})"))
+        return
+
+    indexes = inspect(conn).get_indexes(table_name)
+    old = _reflected(conn, table_name).tables[table_name]
+    metadata = MetaData()
+    # The old single-column keys are the ones losing their uniqueness: no foreign keys are carried over
+    columns = [Column(c.name, c.type, nullable=c.nullable) for c in old.columns]
+    rebuilt = Table(f"{table_name}__new", metadata,
+                    Column('chat_id', BigInteger, nullable=False, server_default=text('0')),
+                    *columns, PrimaryKeyConstraint(*primary_key))
+    rebuilt.create(conn)
+    names = ", ".join(c.name for c in old.columns)
+    conn.execute(text(f"INSERT INTO {rebuilt.name} ({names}) SELECT {names} FROM {table_name}"))
+    conn.execute(text(f"DROP TABLE {table_name}"))
+    conn.execute(text(f"ALTER TABLE {rebuilt.name} RENAME TO {table_name}"))
+    for index in indexes:
+        unique = "UNIQUE " if index['unique'] else ""
+        conn.execute(text(f"CREATE {unique}INDEX {index['name']} ON {table_name} "
+                          f"({', '.join(index['column_names'])})"))
+
+@migration(15, "per-chat economies")
+def _per_chat_economies(conn):
+    _add_chat_key(conn, 'users', ['chat_id', 'user_id'])
+    _add_chat_key(conn, 'user_stats', ['chat_id', 'user_id'])
+    _add_chat_key(conn, 'balance_checkpoints', ['chat_id', 'user_id', 'ledger_id'])
+    # A constant default: neither backend rewrites the (possibly large) tables
+    for table in ('bets', 'wagers', 'ledger', 'bets_archive', 'wagers_archive'):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN chat_id BIGINT NOT NULL DEFAULT 0"))
+
+    for old, table, new, columns in (
+            ('ix_users_username', 'users', 'ix_users_chat_username', 'chat_id, username'),
+            ('ix_user_stats_net_profit', 'user_stats', 'ix_user_stats_chat_net_profit', 'chat_id, net_profit'),
+            ('ix_bets_status_id', 'bets', 'ix_bets_chat_status_id', 'chat_id, status, id'),
+            ('ix_wagers_user_placed_id', 'wagers', 'ix_wagers_chat_user_placed_id', 'chat_id, user_id, placed_at, id'),
+            ('ix_ledger_user_id', 'ledger', 'ix_ledger_chat_user_id', 'chat_id, user_id, id'),
+            ('ix_wagers_archive_user_placed_id', 'wagers_archive', 'ix_wagers_archive_chat_user_placed_id',
+             'chat_id, user_id, placed_at, id')):
+        conn.execute(text(f"DROP INDEX IF EXISTS {old}"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {new} ON {table} ({columns})"))
+
+    # The directory of chats and bets; only the main database's copy is used
+    metadata = MetaData()
+    Table('chat_shards', metadata,
+          Column('chat_id', BigInteger, primary_key=True, autoincrement=False),
+          Column('shard', String, nullable=False),
+          Column('created_at', BigInteger, nullable=False))
+    Table('bet_routes', metadata,
+          Column('bet_id', Integer, primary_key=True, autoincrement=True),
+          Column('chat_id', BigInteger, nullable=False))
+    metadata.create_all(conn, checkfirst=True)
+    # Existing bets keep their ids, and the existing economy stays in this database as chat 0
+    conn.execute(text("INSERT INTO bet_routes (bet_id, chat_id) "
+                      "SELECT id, 0 FROM bets UNION SELECT id, 0 FROM bets_archive"))
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("SELECT setval(pg_get_serial_sequence('bet_routes', 'bet_id'), "
+                          "COALESCE(MAX(bet_id), 0) + 1, false) FROM bet_routes"))
+    if conn.execute(text("SELECT 1 FROM users UNION SELECT 1 FROM bet_routes")).first():
+        conn.execute(text("INSERT INTO chat_shards (chat_id, shard, created_at) VALUES (0, 'main', :now)"),
+                     {'now': int(datetime.now().timestamp())})
+
+@migration(16, "worker leases")
+def _worker_leases(conn):
+    metadata = MetaData()
+    Table('leases', metadata,
+          Column('name', String, primary_key=True),
+          Column('holder', String, nullable=False),
+          Column('acquired_at', BigInteger, nullable=False),
+          Column('expires_at', BigInteger, nullable=False))
+    metadata.create_all(conn, checkfirst=True)
+
+@migration(17, "pending bet expiry notices")
+def _expiry_pending(conn):
+    conn.execute(text("ALTER TABLE bets ADD COLUMN expiry_pending INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_bets_expiry_pending ON bets (expiry_pending)"))
+
+@migration(18, "outbox by chat")
+def _outbox_by_chat(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_outbox_chat_id ON outbox (chat_id, id)"))
+
+# --- Runner ---
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, description VARCHAR, applied_at VARCHAR)"
+    ))
+
+def current_version(engine):
+    """Returns the highest applied migration version (0 for a new database)."""
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+        return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def upgrade(engine):
+    """
+    Applies all pending migrations in order.
+    Returns the set of backfill names requested by the applied migrations.
+    """
+    version = current_version(engine)
+    backfills = set()
+    for mig_version, description, func in MIGRATIONS:
+        if mig_version <= version:
+            continue
+        with engine.begin() as conn:
+            backfill = func(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)"),
+                {'v': mig_version, 'd': description, 't': datetime.now().isoformat()}
+            )
+        if backfill:
+            backfills.add(backfill)
+        logger.info(f"Applied migration {mig_version}: {description}")
+    return backfills
@@ -1,46 +1,255 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float
+from sqlalchemy import Column, Integer, BigInteger, String, LargeBinary, ForeignKey, Float, Index, PrimaryKeyConstraint, text
 from sqlalchemy.orm import relationship, declarative_base
 from shekkle_bot.config import INITIAL_BALANCE
 
 Base = declarative_base()
 
+# Every chat has its own economy: balances, bets, wagers, stats and ledger rows
+# carry the chat_id they belong to. Rows from before per-chat economies have chat 0.
+def _chat_id_column(**kwargs):
+    return Column(BigInteger, nullable=False, server_default=text('0'), **kwargs)
+
 class User(Base):
+    """A user's account in one chat's economy."""
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_chat_username', 'chat_id', 'username'),
+    )
 
-    user_id = Column(Integer, primary_key=True)
+    chat_id = _chat_id_column(primary_key=True, autoincrement=False)
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
     username = Column(String)
     balance = Column(Integer, default=INITIAL_BALANCE)
-    last_daily = Column(String, nullable=True)
+    last_daily = Column(BigInteger, nullable=True) # UTC epoch seconds, like every timestamp below
 
-    wagers = relationship("Wager", back_populates="user")
+    wagers = relationship("Wager", back_populates="user",
+                          primaryjoin="and_(User.chat_id == foreign(Wager.chat_id), "
+                                      "User.user_id == foreign(Wager.user_id))")
 
 class Bet(Base):
     __tablename__ = 'bets'
+    __table_args__ = (
+        Index('ix_bets_status_deadline', 'status', 'deadline'),
+        Index('ix_bets_chat_status_id', 'chat_id', 'status', 'id'),
+        Index('ix_bets_expiry_pending', 'expiry_pending'),
+    )
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    creator_id = Column(Integer)
+    id = Column(Integer, primary_key=True, autoincrement=False) # from bet_routes, unique across shards
+    chat_id = _chat_id_column()
+    creator_id = Column(BigInteger)
     description = Column(String)
-    deadline = Column(String) # Stored as ISO format string
+    deadline = Column(BigInteger)
     option_a = Column(String)
     option_b = Column(String)
     outcome = Column(String, nullable=True) # 'A' or 'B'
     status = Column(String, default='OPEN') # 'OPEN', 'LOCKED', 'RESOLVED'
-    cutoff_at = Column(String, nullable=True)
-    resolved_at = Column(String, nullable=True)
+    cutoff_at = Column(BigInteger, nullable=True)
+    resolved_at = Column(BigInteger, nullable=True)
+    # 1 from locking the bet at its deadline until the admins' notice is queued
+    expiry_pending = Column(Integer, nullable=False, default=0, server_default=text('0'))
 
     wagers = relationship("Wager", back_populates="bet")
 
 class Wager(Base):
     __tablename__ = 'wagers'
+    __table_args__ = (
+        Index('ix_wagers_bet_refunded_choice', 'bet_id', 'refunded', 'choice'),
+        Index('ix_wagers_chat_user_placed_id', 'chat_id', 'user_id', 'placed_at', 'id'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer, ForeignKey('users.user_id'))
+    chat_id = _chat_id_column() # the bet's chat
+    user_id = Column(BigInteger)
     bet_id = Column(Integer, ForeignKey('bets.id'))
     choice = Column(String) # 'A' or 'B'
     amount = Column(Integer)
-    placed_at = Column(String)
+    placed_at = Column(BigInteger)
     refunded = Column(Integer, default=0) # 0 = active, 1 = refunded
     payout = Column(Integer, nullable=True) # Amount won (including stake)
 
-    user = relationship("User", back_populates="wagers")
+    user = relationship("User", back_populates="wagers",
+                        primaryjoin="and_(User.chat_id == foreign(Wager.chat_id), "
+                                    "User.user_id == foreign(Wager.user_id))")
     bet = relationship("Bet", back_populates="wagers")
+
+
+class UserStats(Base):
+    """Per-user betting totals in one chat, maintained by resolve_bet for the leaderboards."""
+    __tablename__ = 'user_stats'
+    __table_args__ = (
+        Index('ix_user_stats_chat_net_profit', 'chat_id', 'net_profit'),
+    )
+
+    chat_id = _chat_id_column(primary_key=True, autoincrement=False)
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    net_profit = Column(Integer, default=0, nullable=False)
+    bets_placed = Column(Integer, default=0, nullable=False)
+    bets_won = Column(Integer, default=0, nullable=False)
+
+
+class BetPool(Base):
+    """Running pool totals per bet, maintained by place_wager and resolve_bet."""
+    __tablename__ = 'bet_pools'
+
+    bet_id = Column(Integer, ForeignKey('bets.id'), primary_key=True, autoincrement=False)
+    amount_a = Column(Integer, default=0, nullable=False)
+    amount_b = Column(Integer, default=0, nullable=False)
+    bettors_a = Column(Integer, default=0, nullable=False)
+    bettors_b = Column(Integer, default=0, nullable=False)
+
+class BetPoolEntry(Base):
+    """One user's total stake on one side of a bet (users of the bet's chat)."""
+    __tablename__ = 'bet_pool_entries'
+    __table_args__ = (
+        PrimaryKeyConstraint('bet_id', 'choice', 'user_id'),
+        Index('ix_bet_pool_entries_amount', 'bet_id', 'choice', 'amount'),
+    )
+
+    bet_id = Column(Integer, ForeignKey('bets.id'), nullable=False)
+    choice = Column(String, nullable=False) # 'A' or 'B'
+    user_id = Column(BigInteger, nullable=False)
+    amount = Column(Integer, nullable=False)
+
+class OutboxMessage(Base):
+    """A notification waiting to be delivered by the outbound dispatcher."""
+    __tablename__ = 'outbox'
+    __table_args__ = (
+        Index('ix_outbox_next_attempt', 'next_attempt_at'),
+        Index('ix_outbox_chat_id', 'chat_id', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(String, nullable=False)
+    parse_mode = Column(String, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(BigInteger, nullable=False)
+    created_at = Column(BigInteger, nullable=False)
+
+class ConversationState(Base):
+    """State of one ConversationHandler conversation, kept by DatabasePersistence."""
+    __tablename__ = 'conversation_states'
+    __table_args__ = (
+        PrimaryKeyConstraint('name', 'key'),
+    )
+
+    name = Column(String, nullable=False) # ConversationHandler name
+    key = Column(String, nullable=False) # JSON list, e.g. [chat_id, user_id]
+    state = Column(String, nullable=False) # JSON
+
+class UserData(Base):
+    """A user's context.user_data, pickled, kept by DatabasePersistence."""
+    __tablename__ = 'user_data'
+
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    data = Column(LargeBinary, nullable=False)
+
+class LedgerEntry(Base):
+    """
+    One credit (positive amount) or debit (negative) of a user's balance.
+    Append-only: users.balance always equals the sum of the user's entries in that chat.
+    """
+    __tablename__ = 'ledger'
+    __table_args__ = (
+        Index('ix_ledger_chat_user_id', 'chat_id', 'user_id', 'id'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = _chat_id_column()
+    user_id = Column(BigInteger, nullable=False)
+    amount = Column(Integer, nullable=False)
+    reason = Column(String, nullable=False) # 'opening', 'signup', 'daily', 'wager', 'refund', 'payout', 'give', 'adjustment'
+    ref_id = Column(BigInteger, nullable=True) # wager id for wager/refund/payout, admin id for give
+    created_at = Column(BigInteger, nullable=False)
+
+class BalanceCheckpoint(Base):
+    """A user's balance as of one of their ledger entries, so history never has to be replayed from the start."""
+    __tablename__ = 'balance_checkpoints'
+    __table_args__ = (
+        PrimaryKeyConstraint('chat_id', 'user_id', 'ledger_id'),
+    )
+
+    chat_id = _chat_id_column()
+    user_id = Column(BigInteger, nullable=False)
+    ledger_id = Column(Integer, nullable=False) # last entry included in the balance
+    balance = Column(Integer, nullable=False)
+    as_of = Column(BigInteger, nullable=False) # created_at of that entry
+
+class JobCursor(Base):
+    """How far an incremental background job has got, e.g. the last reconciled ledger id."""
+    __tablename__ = 'job_cursors'
+
+    name = Column(String, primary_key=True)
+    position = Column(Integer, nullable=False)
+
+class ArchivedBet(Base):
+    """
+    A RESOLVED bet moved out of `bets` by archive_resolved_bets, with the pool
+    totals its bet_pools row held.
+    """
+    __tablename__ = 'bets_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    chat_id = _chat_id_column()
+    creator_id = Column(BigInteger)
+    description = Column(String)
+    deadline = Column(BigInteger)
+    option_a = Column(String)
+    option_b = Column(String)
+    outcome = Column(String, nullable=True)
+    status = Column(String)
+    cutoff_at = Column(BigInteger, nullable=True)
+    resolved_at = Column(BigInteger, nullable=True)
+    amount_a = Column(Integer, nullable=False)
+    amount_b = Column(Integer, nullable=False)
+    bettors_a = Column(Integer, nullable=False)
+    bettors_b = Column(Integer, nullable=False)
+
+class ArchivedWager(Base):
+    """A wager on an archived bet, moved out of `wagers` with it; ids are kept."""
+    __tablename__ = 'wagers_archive'
+    __table_args__ = (
+        Index('ix_wagers_archive_chat_user_placed_id', 'chat_id', 'user_id', 'placed_at', 'id'),
+        Index('ix_wagers_archive_bet_id', 'bet_id'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    chat_id = _chat_id_column()
+    user_id = Column(BigInteger)
+    bet_id = Column(Integer)
+    choice = Column(String)
+    amount = Column(Integer)
+    placed_at = Column(BigInteger)
+    refunded = Column(Integer)
+    payout = Column(Integer, nullable=True)
+
+class BotSetting(Base):
+    """Small pieces of bot state kept across restarts, e.g. the hash of the registered command menus."""
+    __tablename__ = 'bot_settings'
+
+    name = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+
+class Lease(Base):
+    """A lease held by one bot worker at a time, e.g. the leadership that runs the scheduled jobs."""
+    __tablename__ = 'leases'
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False) # WORKER_ID
+    acquired_at = Column(BigInteger, nullable=False)
+    expires_at = Column(BigInteger, nullable=False)
+
+class ChatShard(Base):
+    """Directory (main database only): which shard holds a chat's economy."""
+    __tablename__ = 'chat_shards'
+
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    shard = Column(String, nullable=False) # 'main' or a DB_SHARDS name
+    created_at = Column(BigInteger, nullable=False)
+
+class BetRoute(Base):
+    """Directory (main database only): hands out bet ids, unique across shards, and the chat of each bet."""
+    __tablename__ = 'bet_routes'
+
+    bet_id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
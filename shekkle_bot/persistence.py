@@ -0,0 +1,215 @@
+"""
+ConversationHandler state and user_data stored in the bot's own database, so
+a restart (update.sh, systemd) doesn't drop users halfway through /createbet.
+
+python-telegram-bot hands the persistence only what changed since its last
+run: conversations whose state moved, and users who sent an update. Users
+whose user_data is unchanged (almost all of them) are skipped by comparing
+against what was last stored; the remaining changes of one run are buffered
+and written together in a single transaction. Entries are stored one row per
+conversation and per user, so nothing is rewritten that didn't change, and
+startup is one SELECT per table.
+
+With MULTI_WORKER a user's next update may reach another worker, so
+share_between_workers() adds handlers that read the update's conversation
+states and user_data back before any other handler runs and write what it
+changed as soon as the last one is done. PTB has no public way to set a
+conversation's state, so this reaches into ConversationHandler as of the
+python-telegram-bot version pinned in requirements.txt (TESTED_PTB_VERSION);
+tests/test_persistence.py breaks if an upgrade changes it.
+"""
+import asyncio
+import json
+import logging
+import pickle
+
+import telegram
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput, TypeHandler
+
+import shekkle_bot.database as db
+
+logger = logging.getLogger(__name__)
+
+# Handler groups of share_between_workers(), before and after all others
+RELOAD_GROUP = -100
+SAVE_GROUP = 100
+# The python-telegram-bot minor version whose ConversationHandler internals share_between_workers() relies on
+TESTED_PTB_VERSION = (22, 8)
+
+def _conversation_key(handler, update):
+    """The key `handler` files the update's conversation under, or None if it has none."""
+    chat, user = update.effective_chat, update.effective_user
+    if (handler.per_chat and chat is None) or (handler.per_user and user is None):
+        return None
+    return tuple(([chat.id] if handler.per_chat else []) + ([user.id] if handler.per_user else []))
+
+def _conversation_states(handler):
+    """The handler's conversation states, as the TrackingDict PTB fills them into."""
+    states = getattr(handler, '_conversations', None)
+    if not (hasattr(states, 'update_no_track') and isinstance(getattr(states, 'data', None), dict)):
+        raise RuntimeError(
+            f"python-telegram-bot {telegram.__version__} changed ConversationHandler's internals; "
+            f"MULTI_WORKER is tested with {'.'.join(map(str, TESTED_PTB_VERSION))}"
+        )
+    return states
+
+class DatabasePersistence(BasePersistence):
+    """Persists conversations and user_data; chat_data, bot_data and callback data are not kept."""
+
+    def __init__(self, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._stored_user_data = {}     # user_id -> pickled data as last written
+        self._conversations = {}        # (name, key_json) -> state_json or None, not yet written
+        self._user_data = {}            # user_id -> pickled data or None, not yet written
+        self._batch = None              # task writing the current batch
+
+    # --- Loading ---
+
+    async def get_conversations(self, name):
+        rows = await db.run_async(db.load_conversations, name)
+        conversations = {tuple(json.loads(key)): json.loads(state) for key, state in rows.items()}
+        logger.info(f"Restored {len(conversations)} '{name}' conversations")
+        return conversations
+
+    async def get_user_data(self):
+        rows = await db.run_async(db.load_user_data)
+        self._stored_user_data = dict(rows)
+        return {user_id: pickle.loads(data) for user_id, data in rows.items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- Changes ---
+
+    async def update_conversation(self, name, key, new_state):
+        self._conversations[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        await self._write_soon()
+
+    async def update_user_data(self, user_id, data):
+        pickled = pickle.dumps(data) if data else None
+        if self._stored_user_data.get(user_id) == pickled:
+            return
+        self._set_user_data(user_id, pickled)
+        await self._write_soon()
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._stored_user_data or user_id in self._user_data:
+            self._set_user_data(user_id, None)
+            await self._write_soon()
+
+    def _set_user_data(self, user_id, pickled):
+        if pickled is None:
+            self._stored_user_data.pop(user_id, None)
+        else:
+            self._stored_user_data[user_id] = pickled
+        self._user_data[user_id] = pickled
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Writing ---
+
+    async def _write_soon(self):
+        """
+        Waits for the batch that includes the change just buffered. PTB runs all
+        update_* calls of one persistence run concurrently, so they join a
+        single batch that is written once they have all been buffered.
+        """
+        if self._batch is None:
+            self._batch = asyncio.get_running_loop().create_task(self._write_batch())
+        await asyncio.shield(self._batch)
+
+    async def _write_batch(self):
+        # Let the rest of this persistence run buffer its changes first
+        await asyncio.sleep(0)
+        self._batch = None
+        conversations, self._conversations = self._conversations, {}
+        user_data, self._user_data = self._user_data, {}
+        if not conversations and not user_data:
+            return
+        try:
+            await db.run_async(db.save_bot_state, conversations, user_data)
+        except Exception:
+            # Keep the changes for the next run, unless they have been superseded
+            self._conversations = {**conversations, **self._conversations}
+            self._user_data = {**user_data, **self._user_data}
+            raise
+
+    async def flush(self):
+        if self._batch is not None:
+            await asyncio.gather(self._batch, return_exceptions=True)
+        if self._conversations or self._user_data:
+            self._batch = asyncio.get_running_loop().create_task(self._write_batch())
+            await self._batch
+
+    # --- Several workers ---
+
+    def share_between_workers(self, application):
+        """Adds the handlers that keep this worker's state in step with the other workers'. Call last."""
+        if telegram.__version_info__[:2] != TESTED_PTB_VERSION:
+            logger.warning(f"MULTI_WORKER relies on ConversationHandler internals of python-telegram-bot "
+                           f"{'.'.join(map(str, TESTED_PTB_VERSION))}, not {telegram.__version__}")
+        application.add_handler(TypeHandler(Update, self._reload_update_state), group=RELOAD_GROUP)
+        application.add_handler(TypeHandler(Update, self._save_update_state), group=SAVE_GROUP)
+
+    async def _reload_update_state(self, update, context):
+        conversations = {}
+        for group in context.application.handlers.values():
+            for handler in group:
+                if not isinstance(handler, ConversationHandler) or not handler.persistent or handler.per_message:
+                    continue
+                key = _conversation_key(handler, update)
+                if key is not None:
+                    conversations[(handler.name, json.dumps(list(key)))] = (handler, key)
+        user = update.effective_user
+        states, data = await db.run_async(db.load_update_state, list(conversations), user.id if user else None)
+
+        # Untracked, so it isn't written back
+        for name_key, (handler, key) in conversations.items():
+            state = states.get(name_key)
+            if state is None:
+                _conversation_states(handler).data.pop(key, None)
+            else:
+                _conversation_states(handler).update_no_track({key: json.loads(state)})
+        # Unless changes of this user's are still waiting to be written
+        if user is not None and context.user_data is not None and user.id not in self._user_data:
+            context.user_data.clear()
+            if data:
+                context.user_data.update(pickle.loads(data))
+                self._stored_user_data[user.id] = data
+            else:
+                self._stored_user_data.pop(user.id, None)
+
+    async def _save_update_state(self, update, context):
+        if update.effective_user:
+            # PTB marks the user_data as changed only after the last handler group
+            context.application.mark_data_for_update_persistence(user_ids=update.effective_user.id)
+        await context.application.update_persistence()
@@ -0,0 +1,41 @@
+"""
+Timestamps are stored as integer UTC epoch seconds in every table, so range
+scans and comparisons are plain integer operations and nothing is parsed on
+the hot paths. Conversion happens at the edges: user input and display use
+naive local datetimes, as the bot always has.
+"""
+import time
+from datetime import datetime
+
+DISPLAY_FORMAT = "%Y-%m-%d %H:%M"
+
+def now():
+    """The current time as an integer UTC epoch."""
+    return int(time.time())
+
+def to_epoch(value):
+    """
+    Integer UTC epoch for a datetime, an ISO string or an epoch number. Naive
+    datetimes and strings are local time; ISO strings may use 'T' or a space
+    and may leave out seconds. None and '' give None.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.lstrip('-').isdigit():
+            return int(value)
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    raise TypeError(f"Not a timestamp: {value!r}")
+
+def to_local(epoch):
+    """Naive local datetime for an epoch, or None."""
+    return None if epoch is None else datetime.fromtimestamp(epoch)
+
+def format_local(epoch, fmt=DISPLAY_FORMAT):
+    """Local time of an epoch for messages, e.g. '2025-06-01 18:00'."""
+    return "" if epoch is None else datetime.fromtimestamp(epoch).strftime(fmt)
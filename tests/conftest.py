@@ -0,0 +1,102 @@
+"""
+Test fixtures.
+
+Tests that take `database` run once on SQLite and once on PostgreSQL, each
+against a fresh database migrated to the current schema. PostgreSQL comes from
+TEST_DATABASE_URL (a server URL whose user may create databases, e.g.
+postgresql+psycopg2://postgres@localhost/postgres) or, without it, a throwaway
+local server started with pgserver (requirements-dev.txt). If neither is
+available the PostgreSQL runs are skipped.
+"""
+import logging
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# shekkle_bot.config reads the environment on import; keep the tests off any real database
+_TMP = tempfile.mkdtemp(prefix="shekkle-test-")
+os.environ.update(DB_PATH=os.path.join(_TMP, "default.db"), DATABASE_URL="", DB_SHARDS="", MULTI_WORKER="",
+                  ADMIN_IDS="")
+
+from sqlalchemy import create_engine, text  # noqa: E402
+from sqlalchemy.engine import make_url  # noqa: E402
+
+import shekkle_bot.database as db  # noqa: E402
+
+BACKENDS = ("sqlite", "postgresql")
+
+
+@pytest.fixture(scope="session")
+def postgres_server_url():
+    """URL of a PostgreSQL server to create test databases on."""
+    url = os.getenv("TEST_DATABASE_URL")
+    if url:
+        yield url
+        return
+    try:
+        import pgserver
+    except ImportError:
+        pytest.skip("PostgreSQL tests need TEST_DATABASE_URL or pgserver")
+    server = pgserver.get_server(os.path.join(_TMP, "pgdata"), cleanup_mode='stop')
+    host = make_url(server.get_uri()).query['host']
+    try:
+        yield f"postgresql+psycopg2://postgres@/postgres?host={host}"
+    finally:
+        server.cleanup()
+        # pgserver logs again at exit, after pytest has closed its log capture
+        logging.getLogger("pgserver").disabled = True
+
+
+@pytest.fixture(params=BACKENDS)
+def database_url(request, tmp_path):
+    """URL of an empty database on each backend; PostgreSQL databases are dropped afterwards."""
+    if request.param == "sqlite":
+        yield f"sqlite:///{tmp_path / 'test.db'}"
+        return
+    server_url = make_url(request.getfixturevalue("postgres_server_url"))
+    name = f"shekkle_test_{uuid.uuid4().hex[:12]}"
+    admin = create_engine(server_url, isolation_level="AUTOCOMMIT")
+    with admin.connect() as conn:
+        conn.execute(text(f'CREATE DATABASE "{name}"'))
+    try:
+        yield server_url.set(database=name).render_as_string(hide_password=False)
+    finally:
+        with admin.connect() as conn:
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)'))
+        admin.dispose()
+
+
+@pytest.fixture
+def database(database_url):
+    """
+    shekkle_bot.database pointed at a fresh database, with the routing and user
+    caches emptied. Yields the backend name.
+    """
+    saved = dict(db.shards), db.engine, db.read_engine
+    shard = db.Shard(db.MAIN_SHARD, database_url)
+    # Modules that imported `shards` keep the same dict
+    db.shards.clear()
+    db.shards[db.MAIN_SHARD] = shard
+    db.engine, db.read_engine = shard.engine, shard.read_engine
+    _reset_caches()
+    db.init_db()
+    try:
+        yield shard.engine.dialect.name
+    finally:
+        shard.Session.remove()
+        shard.ReadSession.remove()
+        shard.engine.dispose()
+        shard.read_engine.dispose()
+        db.shards.clear()
+        db.shards.update(saved[0])
+        db.engine, db.read_engine = saved[1], saved[2]
+        _reset_caches()
+
+
+def _reset_caches():
+    db._chat_routes.clear()
+    db.user_cache.clear()
+    db._open_bet_counts.clear()
+    db._legacy_economy = None
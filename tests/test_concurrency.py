@@ -0,0 +1,16 @@
+"""The handler stress run of benchmarks/concurrency_stress.py, smaller, on every backend."""
+import pytest
+
+from benchmarks import concurrency_stress
+from shekkle_bot.handlers import admin
+
+pytestmark = pytest.mark.usefixtures("database")
+
+
+def test_parallel_handlers_conserve_balances_and_ledger(monkeypatch):
+    monkeypatch.setattr(admin, "ADMIN_IDS", [concurrency_stress.ADMIN_ID])
+    report = concurrency_stress.stress(users=30, bets=4, operations=400, rounds=2, checkpoint_every=5)
+    assert report['failures'] == []
+    assert report['accounted_total'] == report['expected_total']
+    assert report['ledger_mismatches'] == 0
+    assert report['wagers'] and report['checkpoints']
@@ -0,0 +1,331 @@
+"""Wagers, settlement, the ledger and leases, on every backend (see conftest.py)."""
+import threading
+
+import pytest
+
+import shekkle_bot.database as db
+from shekkle_bot import metrics, migrations, timestamps
+from shekkle_bot.config import INITIAL_BALANCE
+
+pytestmark = pytest.mark.usefixtures("database")
+
+CHAT = -1001
+FAR_FUTURE = "2099-01-01T00:00:00"
+
+
+def balance(user_id, chat_id=CHAT):
+    return db.get_user(chat_id, user_id).balance
+
+
+def open_bet(creator=1, chat_id=CHAT):
+    return db.create_bet(chat_id, creator, "Test bet", FAR_FUTURE, "Yes", "No")
+
+
+def users(*user_ids, chat_id=CHAT):
+    for user_id in user_ids:
+        db.add_user(chat_id, user_id, f"user{user_id}")
+
+
+def assert_ledger_matches(chat_id=CHAT):
+    result = db.reconcile_ledger(settle=0)
+    assert result['mismatched'] == []
+    for user_id in db.get_all_users(chat_id):
+        assert db.get_balance_at(chat_id, user_id, timestamps.now()) == balance(user_id, chat_id)
+
+
+# --- Users ---
+
+def test_get_user_by_username_reads_through_the_cache():
+    users(1)
+    db.user_cache.clear()
+    user = db.get_user_by_username(CHAT, "@user1")
+    assert (user.chat_id, user.user_id, user.username, user.balance) == (CHAT, 1, "user1", INITIAL_BALANCE)
+    assert db.user_cache.get(CHAT, 1) == user
+    assert db.get_user_by_username(CHAT, "user1") == user
+    assert db.get_user_by_username(CHAT - 1, "user1") is None
+    assert db.get_user_by_username(CHAT, "@nobody") is None
+
+
+def test_legacy_economy_is_unassigned_until_moved():
+    users(1, 2, chat_id=db.LEGACY_CHAT_ID)
+    assert db.has_unassigned_economy()
+    assert db.move_chat(db.LEGACY_CHAT_ID, CHAT) == 2
+    assert not db.has_unassigned_economy()
+    assert balance(1) == INITIAL_BALANCE
+
+
+# --- Chat routing ---
+
+@pytest.fixture
+def second_shard(tmp_path):
+    shard = db.Shard("second", f"sqlite:///{tmp_path / 'second.db'}")
+    migrations.upgrade(shard.engine)
+    db.shards[shard.name] = shard
+    yield shard
+    shard.engine.dispose()
+    shard.read_engine.dispose()
+
+
+def test_reads_do_not_route_chats():
+    assert db.get_user(CHAT, 1) is None
+    assert db.get_open_bets(CHAT) == []
+    assert db.get_shard_loads() == {db.MAIN_SHARD: 0}
+    users(1)
+    assert db.get_shard_loads() == {db.MAIN_SHARD: 1}
+
+
+@pytest.mark.parametrize("database_url", ["sqlite"], indirect=True)
+def test_routes_moved_by_another_worker_are_followed(monkeypatch, second_shard):
+    monkeypatch.setattr(db, "MULTI_WORKER", True)
+    new_chat = CHAT - 1
+    users(1)
+    # This worker sees the new chat id first, and routes it to the emptier shard
+    db.update_balance(new_chat, 1, 0)
+    assert db.shard_for_chat(new_chat) is second_shard
+
+    # ...and another worker moves the group's economy to it
+    with monkeypatch.context() as m:
+        m.setattr(db, "_chat_routes", {})
+        assert db.move_chat(CHAT, new_chat) == 1
+    assert db.shard_for_chat(new_chat) is db.shards[db.MAIN_SHARD]
+    assert balance(1, new_chat) == INITIAL_BALANCE
+
+
+# --- place_wager ---
+
+def test_place_wager_debits_stake_and_updates_pool():
+    users(1, 2)
+    bet_id = open_bet()
+    assert db.place_wager(CHAT, 1, bet_id, 'A', 30) == (True, "Wager placed successfully.")
+    assert db.place_wager(CHAT, 2, bet_id, 'B', 10)[0]
+    assert db.place_wager(CHAT, 1, bet_id, 'A', 5)[0]
+
+    assert balance(1) == INITIAL_BALANCE - 35
+    assert balance(2) == INITIAL_BALANCE - 10
+    status = db.get_bet_status(CHAT, bet_id)
+    assert (status['amount_a'], status['bettors_a'], status['amount_b'], status['bettors_b']) == (35, 1, 10, 1)
+    assert status['top_a'][0]['amount'] == 35
+    assert db.get_bet_wagers(CHAT, bet_id) == [
+        {'user_id': 1, 'choice': 'A', 'amount': 30, 'username': "user1"},
+        {'user_id': 2, 'choice': 'B', 'amount': 10, 'username': "user2"},
+        {'user_id': 1, 'choice': 'A', 'amount': 5, 'username': "user1"},
+    ]
+    assert_ledger_matches()
+
+
+def test_place_wager_rejects_without_debiting():
+    users(1)
+    bet_id = open_bet()
+    assert db.place_wager(CHAT, 1, bet_id, 'A', INITIAL_BALANCE + 1) == (False, "Insufficient funds.")
+    assert db.place_wager(CHAT, 1, 999_999, 'A', 1) == (False, "Bet not found.")
+    # Bets of other chats are not found
+    assert db.place_wager(CHAT - 1, 1, bet_id, 'A', 1, register=True) == (False, "Bet not found.")
+    db.update_bet_status(CHAT, bet_id, 'LOCKED')
+    assert db.place_wager(CHAT, 1, bet_id, 'A', 1) == (False, "Bet is not open.")
+
+    expired = db.create_bet(CHAT, 1, "Expired", timestamps.now() - 60, "Yes", "No")
+    assert db.place_wager(CHAT, 1, expired, 'A', 1) == (False, "Deadline has passed.")
+    assert balance(1) == INITIAL_BALANCE
+    assert db.get_bet_wagers(CHAT, bet_id) == []
+    assert_ledger_matches()
+
+
+def test_place_wager_registers_new_user_once():
+    users(1)
+    bet_id = open_bet()
+    assert db.place_wager(CHAT, 7, bet_id, 'B', 20, register=True, username="newbie")[0]
+    assert db.place_wager(CHAT, 7, bet_id, 'B', 20, register=True, username="newbie")[0]
+    assert balance(7) == INITIAL_BALANCE - 40
+    signups = [e for e in db.get_balance_history(CHAT, 7, 0) if e['reason'] == 'signup']
+    assert len(signups) == 1
+    assert_ledger_matches()
+
+
+def test_concurrent_wagers_never_overdraw():
+    users(1)
+    bet_id = open_bet()
+    results = []
+
+    def wager():
+        results.append(db.place_wager(CHAT, 1, bet_id, 'A', 30)[0])
+
+    threads = [threading.Thread(target=wager) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results.count(True) == INITIAL_BALANCE // 30
+    assert balance(1) == INITIAL_BALANCE % 30
+    assert_ledger_matches()
+
+
+# --- resolve_bets ---
+
+def test_resolve_bets_pays_winners_pro_rata():
+    users(1, 2, 3)
+    first, second = open_bet(), open_bet()
+    db.place_wager(CHAT, 1, first, 'A', 30)
+    db.place_wager(CHAT, 2, first, 'A', 10)
+    db.place_wager(CHAT, 3, first, 'B', 40)
+    db.place_wager(CHAT, 3, second, 'A', 25)
+
+    ok, messages, winners = db.resolve_bets([(first, 'A'), (second, 'B')])
+    assert ok
+    assert messages == [(first, "Resolved A. 2 winners (x2.00)."), (second, "No winners. All refunded.")]
+    assert winners[first] == [{'user_id': 1, 'payout': 60, 'profit': 30},
+                              {'user_id': 2, 'payout': 20, 'profit': 10}]
+    assert winners[second] == []
+    assert (balance(1), balance(2), balance(3)) == (INITIAL_BALANCE + 30, INITIAL_BALANCE + 10, INITIAL_BALANCE - 40)
+    assert db.get_bet(CHAT, first)['status'] == 'RESOLVED'
+
+    assert db.resolve_bets([(first, 'B')]) == (False, [(first, "Bet already resolved")], {})
+    assert balance(1) == INITIAL_BALANCE + 30
+    assert_ledger_matches()
+
+
+def test_resolve_bets_is_all_or_nothing():
+    users(1, 2)
+    bet_id = open_bet()
+    db.place_wager(CHAT, 1, bet_id, 'A', 10)
+    db.place_wager(CHAT, 2, bet_id, 'B', 10)
+
+    assert db.resolve_bets([(bet_id, 'A'), (999_999, 'B')]) == (False, [(999_999, "Bet not found")], {})
+    assert db.resolve_bets([(bet_id, 'C')])[0] is False
+    assert db.resolve_bets([(bet_id, 'A'), (bet_id, 'B')])[0] is False
+    assert db.get_bet(CHAT, bet_id)['status'] == 'OPEN'
+    assert (balance(1), balance(2)) == (INITIAL_BALANCE - 10, INITIAL_BALANCE - 10)
+
+
+def test_resolve_bet_refunds_wagers_after_cutoff():
+    users(1, 2)
+    bet_id = open_bet()
+    db.place_wager(CHAT, 1, bet_id, 'A', 10)
+    cutoff = timestamps.now() - 1
+    ok, message, winners = db.resolve_bet(bet_id, 'B', cutoff)
+    assert ok
+    assert message.startswith("⚠️ Refunded 1 wagers (10) after cutoff.")
+    assert balance(1) == INITIAL_BALANCE
+    assert_ledger_matches()
+
+
+# --- Ledger ---
+
+def test_reconcile_ledger_flags_balances_changed_behind_its_back():
+    users(1, 2)
+    db.update_balance(CHAT, 1, 5)
+    assert db.reconcile_ledger(settle=0)['mismatched'] == []
+
+    with db.get_db(chat_id=CHAT) as session:
+        session.execute(db.update(db.User).where(db.User.user_id == 2).values(balance=db.User.balance + 1))
+        session.commit()
+    db.update_balance(CHAT, 2, 1)
+    assert db.reconcile_ledger(settle=0)['mismatched'] == [(CHAT, 2)]
+
+
+def test_reconcile_ledger_takes_checkpoints():
+    users(1)
+    for _ in range(4):
+        db.update_balance(CHAT, 1, 10)
+    result = db.reconcile_ledger(checkpoint_every=3, settle=0)
+    assert result['mismatched'] == [] and result['checkpoints'] == 1
+    db.update_balance(CHAT, 1, -5)
+    assert db.reconcile_ledger(checkpoint_every=3, settle=0)['checkpoints'] == 0
+    assert db.get_balance_at(CHAT, 1, timestamps.now()) == INITIAL_BALANCE + 35
+    history = db.get_balance_history(CHAT, 1, 0)
+    assert [e['amount'] for e in history[1:]] == [INITIAL_BALANCE, 10, 10, 10, 10, -5]
+    assert history[-1]['balance'] == INITIAL_BALANCE + 35
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Makes timestamps.now() return clock[0]."""
+    current = [timestamps.now()]
+    monkeypatch.setattr(timestamps, "now", lambda: current[0])
+    return current
+
+
+def test_reconcile_ledger_waits_for_entries_to_settle(clock):
+    users(1, 2)
+    clock[0] += 60
+    assert db.reconcile_ledger(settle=60)['entries'] == 2
+
+    # Entry 100 has committed, 90 (an earlier id) is still in flight
+    with db.get_db(chat_id=CHAT) as session:
+        session.execute(db.update(db.User).where(db.User.user_id == 1).values(balance=db.User.balance + 5))
+        session.add(db.LedgerEntry(id=100, chat_id=CHAT, user_id=1, amount=5, reason='give', created_at=clock[0]))
+        session.commit()
+    clock[0] += 1
+    assert db.reconcile_ledger(settle=60)['entries'] == 0
+    with db.get_db(chat_id=CHAT) as session:
+        session.execute(db.update(db.User).where(db.User.user_id == 2).values(balance=db.User.balance + 7))
+        session.add(db.LedgerEntry(id=90, chat_id=CHAT, user_id=2, amount=7, reason='give', created_at=clock[0] - 1))
+        session.commit()
+
+    clock[0] += 60
+    result = db.reconcile_ledger(settle=60)
+    assert (result['entries'], result['users'], result['mismatched']) == (2, 2, [])
+    assert db.reconcile_ledger(settle=60)['entries'] == 0
+
+
+# --- Leases ---
+
+
+def test_lease_is_exclusive_until_it_expires(clock):
+    assert db.acquire_lease("leader", "a", 10)
+    assert not db.acquire_lease("leader", "b", 10)
+    acquired = db.get_lease("leader")['acquired_at']
+
+    clock[0] += 5
+    assert db.acquire_lease("leader", "a", 10)
+    assert db.get_lease("leader") == {'holder': "a", 'acquired_at': acquired, 'expires_at': clock[0] + 10}
+
+    clock[0] += 9
+    assert not db.acquire_lease("leader", "b", 10)
+    clock[0] += 1
+    assert db.acquire_lease("leader", "b", 10)
+    assert db.get_lease("leader")['holder'] == "b"
+    assert not db.acquire_lease("leader", "a", 10)
+
+
+def test_released_lease_is_free_at_once(clock):
+    assert db.get_lease("leader") is None
+    assert db.acquire_lease("leader", "a", 10)
+    # Only the holder can release it
+    db.release_lease("leader", "b")
+    assert not db.acquire_lease("leader", "b", 10)
+    db.release_lease("leader", "a")
+    assert db.acquire_lease("leader", "b", 10)
+
+
+def test_lease_has_one_holder_under_contention():
+    results = {}
+    barrier = threading.Barrier(6)
+
+    def compete(holder):
+        barrier.wait()
+        results[holder] = db.acquire_lease("leader", holder, 30)
+
+    threads = [threading.Thread(target=compete, args=(f"w{i}",)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    winners = [holder for holder, won in results.items() if won]
+    assert len(winners) == 1
+    assert db.get_lease("leader")['holder'] == winners[0]
+
+
+# --- Metrics ---
+
+def test_user_cache_counters_are_exported():
+    users(1)
+    db.user_cache.clear()
+    db.get_user(CHAT, 1)
+    db.get_user(CHAT, 1)
+    stats = db.user_cache.stats()
+    text = metrics.render()
+    assert f"shekkle_user_cache_hits_total {stats['hits']}" in text
+    assert f"shekkle_user_cache_misses_total {stats['misses']}" in text
+    assert f"shekkle_user_cache_entries {stats['size']}" in text
+    assert stats['hits'] >= 1 and stats['misses'] >= 1
@@ -0,0 +1,61 @@
+"""Outbox delivery order, with a stand-in for the bot."""
+import asyncio
+import time
+
+import pytest
+from telegram.error import NetworkError
+
+import shekkle_bot.database as db
+from shekkle_bot import timestamps
+from shekkle_bot.dispatcher import MessageDispatcher, RateLimiter
+
+pytestmark = pytest.mark.usefixtures("database")
+
+
+class FlakyBot:
+    """Records sent texts; the first attempt at each text in `fail_once` raises NetworkError."""
+
+    def __init__(self, fail_once=()):
+        self.sent = []
+        self.fail_once = set(fail_once)
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        if text in self.fail_once:
+            self.fail_once.discard(text)
+            raise NetworkError("connection reset")
+        self.sent.append((chat_id, text))
+
+
+async def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.05)
+
+
+def test_retry_holds_back_later_messages_to_the_chat(monkeypatch):
+    clock = [timestamps.now()]
+    monkeypatch.setattr(timestamps, "now", lambda: clock[0])
+
+    async def scenario():
+        dispatcher = MessageDispatcher()
+        dispatcher._limiter = RateLimiter(1000, 0, 0)
+        bot = FlakyBot(fail_once={"first"})
+        await dispatcher.enqueue([{'chat_id': 5, 'text': "first"}, {'chat_id': 5, 'text': "second"},
+                                  {'chat_id': 6, 'text': "other chat"}])
+        dispatcher.start(bot)
+        try:
+            await wait_for(lambda: bot.sent and dispatcher.is_idle())
+            # "first" waits for its retry and "second" waits for "first"; other chats go on
+            assert bot.sent == [(6, "other chat")]
+            assert db.get_due_outbox() == []
+
+            clock[0] += 60
+            dispatcher._wakeup.set()
+            await wait_for(lambda: len(bot.sent) == 3 and dispatcher.is_idle())
+            assert bot.sent[1:] == [(5, "first"), (5, "second")]
+        finally:
+            await dispatcher.stop()
+        assert db.get_due_outbox() == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,75 @@
+"""Handlers of handlers/general.py, called with stand-ins for PTB's Update and context."""
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import shekkle_bot.database as db
+from shekkle_bot.config import INITIAL_BALANCE
+from shekkle_bot.handlers import betting, general
+
+pytestmark = pytest.mark.usefixtures("database")
+
+CHAT = -1001
+
+
+class Message:
+    def __init__(self, text=""):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class CallbackQuery:
+    def __init__(self, data):
+        self.data = data
+        self.message = Message()
+
+    async def answer(self, text=None, **kwargs):
+        pass
+
+
+def command(handler, user_id, chat_id=CHAT, args=(), user_data=None):
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id, username=f"user{user_id}",
+                                                            first_name=f"User {user_id}"),
+                             effective_chat=SimpleNamespace(id=chat_id), message=Message(" ".join(args)),
+                             callback_query=CallbackQuery(" ".join(args)))
+    context = SimpleNamespace(args=list(args), user_data=dict(user_data or {}), job_queue=None)
+    asyncio.run(handler(update, context))
+    return update.message.replies + update.callback_query.message.replies
+
+
+def test_balance_waits_for_the_legacy_economy_to_be_assigned():
+    db.add_user(db.LEGACY_CHAT_ID, 1, "user1")
+    db.update_balance(db.LEGACY_CHAT_ID, 1, 50)
+
+    for handler in (general.balance, general.start):
+        [reply] = command(handler, 1)
+        assert f"move-chat {db.LEGACY_CHAT_ID} {CHAT}" in reply
+    assert db.get_user(CHAT, 1) is None
+
+    db.move_chat(db.LEGACY_CHAT_ID, CHAT)
+    assert command(general.balance, 1) == [f"Your current balance: {INITIAL_BALANCE + 50} Shekkles"]
+    assert command(general.balance, 2) == [f"Your current balance: {INITIAL_BALANCE} Shekkles"]
+
+
+def test_new_chats_wait_for_the_legacy_economy_to_be_assigned():
+    db.add_user(db.LEGACY_CHAT_ID, 1, "user1")
+    bet = {'description': "Rain?", 'deadline': datetime.now() + timedelta(days=1), 'option_a': "Yes",
+           'option_b': "No"}
+
+    for handler, args, user_data in ((general.daily, (), None),
+                                     (betting.wager, ("1", "A", "10"), None),
+                                     (betting.wager_button, ("wager:1:A",), None),
+                                     (betting.receive_option_b, ("No",), bet)):
+        [reply] = command(handler, 2, args=args, user_data=user_data)
+        assert f"move-chat {db.LEGACY_CHAT_ID} {CHAT}" in reply
+    assert db.get_user(CHAT, 2) is None
+    assert db.get_open_bets(CHAT) == []
+
+    # Nothing started an economy in the group, so the old one can still be handed over
+    assert db.move_chat(db.LEGACY_CHAT_ID, CHAT) == 1
+    assert command(general.daily, 2)[0].startswith("💰 Daily reward claimed!")
@@ -0,0 +1,88 @@
+"""Scheduled jobs, run directly with a stand-in for PTB's job context."""
+import asyncio
+
+import pytest
+
+import shekkle_bot.database as db
+from shekkle_bot import jobs, timestamps
+
+pytestmark = pytest.mark.usefixtures("database")
+
+CHAT = -1001
+ADMINS = [900, 901]
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.scheduled = []
+
+    def get_jobs_by_name(self, name):
+        return [job for job in self.scheduled if job[0] == name]
+
+    def run_once(self, callback, when, name=None):
+        self.scheduled.append((name, when))
+
+
+class FakeContext:
+    def __init__(self):
+        self.job_queue = FakeJobQueue()
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    """Messages check_deadlines queues; set outbox.fail to make queueing raise."""
+    class Outbox(list):
+        fail = False
+
+    sent = Outbox()
+
+    async def enqueue(messages):
+        if sent.fail:
+            raise RuntimeError("outbox unavailable")
+        sent.extend(messages)
+        return len(messages)
+
+    monkeypatch.setattr(jobs.dispatcher, "enqueue", enqueue)
+    monkeypatch.setattr(jobs, "ADMIN_IDS", ADMINS)
+    return sent
+
+
+def expired_bet():
+    return db.create_bet(CHAT, 1, "Expired", timestamps.now() - 1, "Yes", "No")
+
+
+def test_check_deadlines_locks_and_notifies_once(outbox):
+    bet_id = expired_bet()
+    asyncio.run(jobs.check_deadlines(FakeContext()))
+    assert db.get_bet(CHAT, bet_id)['status'] == 'LOCKED'
+    assert sorted(m['chat_id'] for m in outbox) == ADMINS
+    assert f"<code>{bet_id}</code>" in outbox[0]['text']
+
+    asyncio.run(jobs.check_deadlines(FakeContext()))
+    assert len(outbox) == len(ADMINS)
+
+
+def test_check_deadlines_keeps_notice_when_queueing_fails(outbox):
+    bet_id = expired_bet()
+    outbox.fail = True
+    context = FakeContext()
+    asyncio.run(jobs.check_deadlines(context))
+    assert db.get_bet(CHAT, bet_id)['status'] == 'LOCKED'
+    assert context.job_queue.get_jobs_by_name("deadline:retry")
+
+    # The retry finds the bet locked already and still sends its notice
+    outbox.fail = False
+    asyncio.run(jobs.check_deadlines(context))
+    assert [m['chat_id'] for m in outbox] == ADMINS
+    assert db.get_pending_expiry_notices() == []
+
+
+def test_schedule_open_bets_picks_up_pending_notices(outbox):
+    expired_bet()
+    outbox.fail = True
+    asyncio.run(jobs.check_deadlines(FakeContext()))
+
+    # As on a restart: no open bets, but a notice still to send
+    job_queue = FakeJobQueue()
+    asyncio.run(jobs.schedule_open_bets(job_queue))
+    assert job_queue.get_jobs_by_name("deadline:overdue")
@@ -0,0 +1,117 @@
+"""Leader election between workers (MULTI_WORKER), several elections on one event loop."""
+import asyncio
+import time
+
+import pytest
+
+import shekkle_bot.database as db
+from shekkle_bot import leader
+
+pytestmark = pytest.mark.usefixtures("database")
+
+LEASE_SECONDS = 3
+
+
+class Worker:
+    """A worker whose only duty is to count ticks of a background job while it leads."""
+
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+        self.election = leader.LeaderElection(holder=name, lease_seconds=LEASE_SECONDS)
+        self.job = None
+
+    async def start(self):
+        await self.election.start(self.elected, self.deposed)
+
+    async def elected(self):
+        self.log.append(('elected', self.name, time.monotonic()))
+        self.job = asyncio.create_task(self.tick())
+
+    async def deposed(self):
+        self.log.append(('deposed', self.name, time.monotonic()))
+        self.job.cancel()
+        await asyncio.gather(self.job, return_exceptions=True)
+
+    async def tick(self):
+        while True:
+            self.log.append(('tick', self.name, time.monotonic()))
+            await asyncio.sleep(0.05)
+
+    async def kill(self):
+        """Dies without a word: the lease is neither renewed nor released."""
+        self.election._task.cancel()
+        self.job.cancel()
+        await asyncio.gather(self.election._task, self.job, return_exceptions=True)
+        self.election._task = None
+        self.log.append(('killed', self.name, time.monotonic()))
+
+
+async def wait_for_leader(workers, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        leaders = [w for w in workers if w.election.is_leader]
+        if leaders:
+            return leaders
+        await asyncio.sleep(0.05)
+    return []
+
+
+def leadership(log):
+    """[(name, start, end)] of each term, from the log."""
+    terms, started = [], {}
+    for event, name, at in log:
+        if event == 'elected':
+            started[name] = at
+        elif event in ('deposed', 'killed') and name in started:
+            terms.append((name, started.pop(name), at))
+    return terms + [(name, at, float('inf')) for name, at in started.items()]
+
+
+def test_lease_fails_over_and_only_the_leader_runs_jobs(monkeypatch):
+    monkeypatch.setattr(leader, "MULTI_WORKER", True)
+    log = []
+
+    async def run():
+        workers = [Worker(f"w{i}", log) for i in range(3)]
+        for worker in workers:
+            await worker.start()
+        try:
+            [first] = await wait_for_leader(workers, LEASE_SECONDS)
+            await asyncio.sleep(LEASE_SECONDS)
+            # Still the only leader after several renewals
+            assert [w for w in workers if w.election.is_leader] == [first]
+
+            killed_at = time.monotonic()
+            await first.kill()
+            alive = [w for w in workers if w is not first]
+            [second] = await wait_for_leader(alive, LEASE_SECONDS * 2)
+            takeover = time.monotonic() - killed_at
+            assert db.get_lease(leader.LEASE_NAME)['holder'] == second.name
+
+            # A clean shutdown releases the lease, so the handover is quick
+            stopped_at = time.monotonic()
+            await second.election.stop()
+            [third] = await wait_for_leader([w for w in alive if w is not second], LEASE_SECONDS)
+            handover = time.monotonic() - stopped_at
+            await asyncio.sleep(0.5)
+            return takeover, handover
+        finally:
+            for worker in workers:
+                if worker.election._task:
+                    await worker.election.stop()
+
+    takeover, handover = asyncio.run(run())
+    # The dead leader's lease has to run out first; one renewal interval after that at most
+    assert takeover <= LEASE_SECONDS + LEASE_SECONDS / 3 + 0.5
+    assert handover <= LEASE_SECONDS / 3 + 0.5
+
+    terms = leadership(log)
+    assert len({name for name, _, _ in terms}) == 3
+    # Terms never overlap, and every job tick falls in its worker's term
+    terms.sort(key=lambda term: term[1])
+    for (_, _, end), (_, start, _) in zip(terms, terms[1:]):
+        assert end <= start
+    for event, name, at in log:
+        if event == 'tick':
+            assert any(term_name == name and start <= at <= end for term_name, start, end in terms)
@@ -0,0 +1,54 @@
+"""Schema migrations run against databases left at an older version, on every backend."""
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+from shekkle_bot import migrations
+
+
+@pytest.fixture
+def engine(database_url):
+    engine = create_engine(database_url)
+    yield engine
+    engine.dispose()
+
+
+def upgrade_to(engine, version, monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(migrations, "MIGRATIONS", [mig for mig in migrations.MIGRATIONS if mig[0] <= version])
+        migrations.upgrade(engine)
+
+
+def epoch(value):
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+def test_epoch_migration_converts_every_format_in_batches(engine, monkeypatch):
+    upgrade_to(engine, 11, monkeypatch)
+    last_daily = ["2025-06-01T18:00:00.123456", "2025-06-01 18:00", "2025-06-01T18:00:30", None, ""]
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users (user_id, username, balance, last_daily) VALUES (:u, :n, 100, :d)"),
+                     [{'u': i + 1, 'n': f"user{i + 1}", 'd': value} for i, value in enumerate(last_daily)])
+        conn.execute(text("INSERT INTO bets (id, creator_id, description, deadline, option_a, option_b, status, "
+                          "resolved_at) VALUES (1, 1, 'Bet', '2099-01-01 12:00', 'Yes', 'No', 'OPEN', NULL)"))
+        conn.execute(text("INSERT INTO ledger (user_id, amount, reason, created_at) "
+                          "VALUES (1, 100, 'opening', '2025-06-01T18:00:00')"))
+        conn.execute(text("INSERT INTO balance_checkpoints (user_id, ledger_id, balance, as_of) "
+                          "VALUES (1, 1, 100, '2025-06-01T18:00:00')"))
+
+    monkeypatch.setattr(migrations, "_EPOCH_BATCH", 2)
+    upgrade_to(engine, 12, monkeypatch)
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT last_daily FROM users ORDER BY user_id")).scalars().all() == \
+            [epoch("2025-06-01T18:00:00"), epoch("2025-06-01T18:00:00"), epoch("2025-06-01T18:00:30"), None, None]
+        assert conn.execute(text("SELECT deadline, resolved_at FROM bets")).one() == (epoch("2099-01-01T12:00"), None)
+        assert conn.execute(text("SELECT created_at FROM ledger")).scalar() == epoch("2025-06-01T18:00:00")
+        assert conn.execute(text("SELECT as_of FROM balance_checkpoints")).scalar() == epoch("2025-06-01T18:00:00")
+        # No scratch tables left behind
+        assert "users__epochs" not in inspect(conn).get_table_names()
+
+    # The rest of the migrations apply on top
+    migrations.upgrade(engine)
+    assert migrations.current_version(engine) == migrations.latest_version()
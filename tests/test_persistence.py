@@ -0,0 +1,90 @@
+"""Conversations shared between workers through DatabasePersistence (MULTI_WORKER)."""
+import asyncio
+import json
+
+import pytest
+from telegram import Update
+from telegram.ext import ApplicationBuilder, CommandHandler, ConversationHandler, MessageHandler, filters
+from telegram.request import BaseRequest
+
+from shekkle_bot.persistence import DatabasePersistence
+
+pytestmark = [pytest.mark.usefixtures("database"),
+              pytest.mark.parametrize("database_url", ["sqlite"], indirect=True)]
+
+CHAT = -1001
+USER = 42
+ASKING = 1
+
+
+class FakeRequest(BaseRequest):
+    """Answers getMe, which Application.initialize() calls; nothing else is sent."""
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        assert url.endswith("/getMe"), url
+        bot = {'id': 1, 'is_bot': True, 'first_name': "Shekkle", 'username': "shekkle_bot"}
+        return 200, json.dumps({'ok': True, 'result': bot}).encode()
+
+
+def worker(answers):
+    """An application with a persistent two-step conversation that appends what it is told to `answers`."""
+    async def ask(update, context):
+        return ASKING
+
+    async def answer(update, context):
+        answers.append(update.effective_message.text)
+        return ConversationHandler.END
+
+    application = (ApplicationBuilder().token("1:TEST").request(FakeRequest()).get_updates_request(FakeRequest())
+                   .updater(None).persistence(DatabasePersistence()).build())
+    application.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("ask", ask)],
+        states={ASKING: [MessageHandler(filters.TEXT & ~filters.COMMAND, answer)]},
+        fallbacks=[], name="ask", persistent=True,
+    ))
+    application.persistence.share_between_workers(application)
+    return application
+
+
+def update(application, update_id, text):
+    message = {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': CHAT, 'type': 'group'},
+        'from': {'id': USER, 'is_bot': False, 'first_name': "Tester"},
+    }
+    if text.startswith("/"):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return Update.de_json({'update_id': update_id, 'message': message}, application.bot)
+
+
+def test_conversation_continues_on_another_worker():
+    answers_a, answers_b = [], []
+
+    async def run():
+        a, b = worker(answers_a), worker(answers_b)
+        await a.initialize()
+        await b.initialize()
+        try:
+            await a.process_update(update(a, 1, "/ask"))
+            # The next step reaches the other worker, which picks the conversation up
+            await b.process_update(update(b, 2, "forty-two"))
+            # ...and ended it for the first one too
+            await a.process_update(update(a, 3, "again"))
+        finally:
+            await a.shutdown()
+            await b.shutdown()
+
+    asyncio.run(run())
+    assert answers_b == ["forty-two"]
+    assert answers_a == []
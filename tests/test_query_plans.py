@@ -0,0 +1,13 @@
+"""Hot-path queries must be answered from an index (what `manage check-query-plans` prints)."""
+import pytest
+
+from shekkle_bot import manage
+
+
+@pytest.mark.parametrize("database_url", ["sqlite"], indirect=True)
+def test_hot_paths_use_indexes(database):
+    plans = list(manage.query_plans())
+    # Every hot path issued at least one query, so none is checked vacuously
+    assert {name for name, _, _ in plans} == set(manage.HOT_PATHS)
+    scans = {name: details for name, details, scans in plans if scans}
+    assert scans == {}